@@ -19,7 +19,7 @@ from .link import Link
 from .param import Param
 from .prior import Prior
 from .simulator import simulate_data
-from .utils import set_floatX
+from .utils import set_compilation_cache, set_floatX
 
 _logger = logging.getLogger("hssm")
 _logger.setLevel(logging.INFO)
@@ -36,6 +36,7 @@ __all__ = [
     "Param",
     "Prior",
     "simulate_data",
+    "set_compilation_cache",
     "set_floatX",
     "show_defaults",
 ]
@@ -25,7 +25,9 @@ class Config:
     list_params: list[str] | None = None
     description: str | None = None
     loglik: LogLik | None = None
-    backend: Literal["jax", "pytensor"] | None = None
+    backend: Literal["jax", "pytensor", "onnxruntime"] | None = None
+    precision: Literal["bfloat16", "float16", "int8"] | None = None
+    chunk_size: int | None = None
     rv: RandomVariable | None = None
     extra_fields: list[str] | None = None
     # Fields with dictionaries are automatically deepcopied
@@ -135,6 +137,16 @@ class Config:
             and user_config.backend is not None
         ):
             self.backend = user_config.backend
+        if (
+            self.loglik_kind == "approx_differentiable"
+            and user_config.precision is not None
+        ):
+            self.precision = user_config.precision
+        if (
+            self.loglik_kind == "approx_differentiable"
+            and user_config.chunk_size is not None
+        ):
+            self.chunk_size = user_config.chunk_size
 
         self.default_priors |= user_config.default_priors
         self.bounds |= user_config.bounds
@@ -150,6 +162,10 @@ class Config:
             raise ValueError("Please provide a log-likelihood function via `loglik`.")
         if self.loglik_kind == "approx_differentiable" and self.backend is None:
             raise ValueError("Please provide `backend` via `model_config`.")
+        if self.precision is not None and self.backend != "jax":
+            raise ValueError("Reduced `precision` requires the `jax` backend.")
+        if self.chunk_size is not None and self.backend != "jax":
+            raise ValueError("`chunk_size` requires the `jax` backend.")
 
     def get_defaults(
         self, param: str
@@ -172,6 +188,8 @@ class ModelConfig:
     list_params: list[str] | None = None
     default_priors: dict[str, ParamSpec] = field(default_factory=dict)
     bounds: dict[str, tuple[float, float]] = field(default_factory=dict)
-    backend: Literal["jax", "pytensor"] | None = None
+    backend: Literal["jax", "pytensor", "onnxruntime"] | None = None
+    precision: Literal["bfloat16", "float16", "int8"] | None = None
+    chunk_size: int | None = None
     rv: RandomVariable | None = None
     extra_fields: list[str] | None = None
@@ -5,7 +5,6 @@ from os import PathLike
 from typing import Callable, Literal, Optional, TypedDict, Union
 
 import bambi as bmb
-import numpy as np
 from pymc import Distribution
 from pytensor.graph.op import Op
 
@@ -14,8 +13,11 @@ from .likelihoods.analytical import (
     ddm_params,
     ddm_sdv_bounds,
     ddm_sdv_params,
+    full_ddm_bounds,
+    full_ddm_params,
     logp_ddm,
     logp_ddm_sdv,
+    logp_full_ddm_analytical,
 )
 from .likelihoods.blackbox import logp_ddm_bbox, logp_ddm_sdv_bbox, logp_full_ddm
 from .param import ParamSpec, _make_default_prior
@@ -184,13 +186,36 @@ default_model_config: DefaultConfigs = {
     },
     "full_ddm": {
         "response": ["rt", "response"],
-        "list_params": ["v", "a", "z", "t", "sv", "sz", "st"],
+        "list_params": full_ddm_params,
         "description": "The full Drift Diffusion Model (DDM)",
         "likelihoods": {
+            "analytical": {
+                "loglik": logp_full_ddm_analytical,
+                "backend": None,
+                "bounds": full_ddm_bounds,
+                "default_priors": {
+                    "t": {
+                        "name": "HalfNormal",
+                        "sigma": 2.0,
+                        "initval": 0.05,
+                    },
+                    "sz": {
+                        "name": "HalfNormal",
+                        "sigma": 0.5,
+                        "initval": 0.1,
+                    },
+                    "st": {
+                        "name": "HalfNormal",
+                        "sigma": 0.5,
+                        "initval": 0.01,
+                    },
+                },
+                "extra_fields": None,
+            },
             "blackbox": {
                 "loglik": logp_full_ddm,
                 "backend": None,
-                "bounds": ddm_sdv_bounds | {"sz": (0, np.inf), "st": (0, np.inf)},
+                "bounds": full_ddm_bounds,
                 "default_priors": {
                     "t": {
                         "name": "HalfNormal",
@@ -199,7 +224,7 @@ default_model_config: DefaultConfigs = {
                     },
                 },
                 "extra_fields": None,
-            }
+            },
         },
     },
     "angle": {
@@ -1,13 +1,183 @@
 """Helper functions for creating blackbox ops."""
 
-from typing import Callable
+import hashlib
+import multiprocessing
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from typing import Any, Callable, Literal
 
+import cloudpickle
 import numpy as np
 import pytensor.tensor as pt
+from pytensor.gradient import grad_not_implemented
 from pytensor.graph import Apply, Op
 
+# Shared memory blocks attached in the worker processes, keyed by name
+_attached_shared_memory: dict[str, shared_memory.SharedMemory] = {}
+# Log-likelihood functions unpickled in the worker processes
+_unpickled_logps: dict[bytes, Callable] = {}
 
-def make_blackbox_op(logp: Callable) -> Op:
+
+def _evaluate_chunk_shared(
+    logp_pickled: bytes,
+    shm_name: str,
+    shape: tuple[int, ...],
+    dtype: str,
+    rows: slice | np.ndarray,
+    dist_params: list[np.ndarray],
+) -> np.ndarray:
+    """Evaluate the log-likelihood on rows of the data stored in shared memory.
+
+    This function runs in the worker processes. The log-likelihood function is
+    pickled with cloudpickle, so that functions defined locally can be used. Both the
+    function and the shared memory block are loaded once per worker and reused for
+    later calls. A new shared memory block means that the data has changed, so the
+    blocks attached earlier are closed.
+    """
+    if logp_pickled not in _unpickled_logps:
+        _unpickled_logps[logp_pickled] = cloudpickle.loads(logp_pickled)
+    logp = _unpickled_logps[logp_pickled]
+
+    if shm_name not in _attached_shared_memory:
+        for name in list(_attached_shared_memory):
+            _attached_shared_memory.pop(name).close()
+        _attached_shared_memory[shm_name] = shared_memory.SharedMemory(name=shm_name)
+    shm = _attached_shared_memory[shm_name]
+    data: np.ndarray = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    return np.asarray(logp(data[rows], *dist_params))
+
+
+def _split_params(
+    dist_params: list[np.ndarray], n_trials: int, start: int, stop: int
+) -> list[np.ndarray]:
+    """Select the part of the parameters that corresponds to a chunk of trials."""
+    return [
+        param[start:stop] if param.ndim > 0 and param.shape[0] == n_trials else param
+        for param in dist_params
+    ]
+
+
+def _hash_arrays(arrays: list[np.ndarray]) -> bytes:
+    """Compute a digest of the shapes, dtypes and contents of a list of arrays."""
+    digest = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        contiguous = np.ascontiguousarray(array)
+        digest.update(f"{contiguous.dtype.str}{contiguous.shape}".encode())
+        digest.update(contiguous.data)
+    return digest.digest()
+
+
+def _finite_difference_grads(
+    evaluate: Callable,
+    data: np.ndarray,
+    dist_params: list[np.ndarray],
+    wrt: list[int],
+    step: float,
+) -> list[np.ndarray]:
+    """Compute trial-wise central finite differences in a single batched call.
+
+    The trials are repeated `2 * len(wrt)` times, and in each block one parameter is
+    shifted up or down by a step relative to its value. All blocks are evaluated
+    with one call to `evaluate`, so that the cost of calling the log-likelihood
+    function is paid only once. The blocks are passed to `evaluate` as indices into
+    the rows of the data. When the trials are evaluated in a single call, the
+    indexed rows, and thus a tiled copy of the data, are materialized before
+    calling the log-likelihood function. When they are evaluated in chunks, only
+    the rows of each chunk are gathered, and the process workers receive the
+    indices alone.
+
+    Parameters
+    ----------
+    evaluate
+        A function with signature evaluate(data, *dist_params, rows=rows) that
+        returns the log-likelihoods of the trials `data[rows]`.
+    data
+        A two-column numpy array with response time and response.
+    dist_params
+        The parameters passed to the log-likelihood function.
+    wrt
+        The indices of the parameters to differentiate with respect to.
+    step
+        The relative step size. The step for a parameter value `x` is
+        `step * max(1, |x|)`.
+
+    Returns
+    -------
+    list[np.ndarray]
+        The derivatives of the trial-wise log-likelihoods with respect to each
+        parameter in `wrt`, each of the same length as `data`.
+    """
+    n_trials = data.shape[0]
+    n_blocks = 2 * len(wrt)
+
+    # The evaluations are done in double precision to limit round-off errors.
+    tiled_params = [
+        np.tile(
+            np.broadcast_to(np.asarray(param, dtype=np.float64), n_trials), n_blocks
+        )
+        for param in dist_params
+    ]
+    steps = []
+    for i, param_idx in enumerate(wrt):
+        param = tiled_params[param_idx]
+        value = param[:n_trials].copy()
+        h = step * np.maximum(1.0, np.abs(value))
+        up = slice(2 * i * n_trials, (2 * i + 1) * n_trials)
+        down = slice((2 * i + 1) * n_trials, (2 * i + 2) * n_trials)
+        param[up] = value + h
+        param[down] = value - h
+        # The actual difference between the shifted values, after rounding
+        steps.append(param[up] - param[down])
+
+    rows = np.tile(np.arange(n_trials), n_blocks)
+    result = np.reshape(
+        evaluate(data, *tiled_params, rows=rows), (n_blocks, n_trials)
+    ).astype(np.float64)
+
+    return [(result[2 * i] - result[2 * i + 1]) / steps[i] for i in range(len(wrt))]
+
+
+class _SharedData:
+    """Holds a copy of the data in a shared memory block."""
+
+    def __init__(self, data: np.ndarray):
+        self.source = data
+        self.shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+        np.ndarray(data.shape, dtype=data.dtype, buffer=self.shm.buf)[:] = data
+        self._finalizer = weakref.finalize(self, _release_shared_memory, self.shm)
+
+    def holds(self, data: np.ndarray) -> bool:
+        """Check whether the block holds a copy of `data`."""
+        return self.source is data or (
+            self.source.dtype == data.dtype
+            and self.source.shape == data.shape
+            and np.array_equal(self.source, data)
+        )
+
+    def release(self):
+        """Release the shared memory block."""
+        self._finalizer()
+
+
+def _release_shared_memory(shm: shared_memory.SharedMemory):
+    """Close and unlink a shared memory block."""
+    shm.close()
+    shm.unlink()
+
+
+def make_blackbox_op(
+    logp: Callable,
+    n_workers: int | None = None,
+    chunk_size: int | None = None,
+    parallel: Literal["thread", "process"] = "thread",
+    grad_method: Literal["finite_differences"] | None = None,
+    fd_step: float = 1e-4,
+    cache_size: int = 0,
+    incremental: bool = False,
+) -> Op:
     """Wrap an arbitrary function in a pytensor Op.
 
     Parameters
@@ -17,16 +187,97 @@ def make_blackbox_op(logp: Callable) -> Op:
         needs to have signature of logp(data, *dist_params) where `data` is a
         two-column numpy array and `dist_params`represents all parameters passed to the
         function.
+    n_workers : optional
+        The number of workers used to evaluate the log-likelihood. If larger than 1,
+        the trials are split into chunks that are evaluated in parallel. This requires
+        that the log-likelihood of each trial only depends on the data and the
+        parameters of that trial. Defaults to None, in which case the function is
+        called once on all trials.
+    chunk_size : optional
+        The number of trials in each chunk. Defaults to None, in which case the trials
+        are split evenly between the workers.
+    parallel : optional
+        Whether the chunks are evaluated on a pool of threads or processes. Threads
+        only speed up functions that release the GIL. With processes, the data is
+        copied once into shared memory, and `logp` must be picklable with
+        cloudpickle. The worker processes are started with the "spawn" method, since
+        forking a process in which JAX is loaded can deadlock, so scripts must guard
+        their entry point with `if __name__ == "__main__":`. Defaults to "thread".
+    grad_method : optional
+        How the gradient of the Op is computed. If "finite_differences", the gradient
+        is approximated with central finite differences with respect to all
+        non-constant parameters. All the shifted parameter values are stacked, so that
+        `logp` is called only once per gradient evaluation. This makes the Op usable
+        with gradient-based samplers such as NUTS. Defaults to None, in which case the
+        Op has no gradient.
+    fd_step : optional
+        The relative step size used for finite differences. The step for a parameter
+        value `x` is `fd_step * max(1, |x|)`. Defaults to 1e-4.
+    cache_size : optional
+        The maximum number of results kept in a least-recently-used cache keyed by a
+        hash of the inputs. Samplers such as `pm.Slice` often evaluate the likelihood
+        with unchanged parameters when another variable of the model is updated, and
+        these calls return the cached result. The memory used is bounded by
+        `cache_size` times the size of the output. The number of cache hits and misses
+        are available as the `cache_hits` and `cache_misses` attributes of the Op.
+        Defaults to 0, in which case no results are cached.
+    incremental : optional
+        Whether to only re-evaluate the trials whose parameters changed since the
+        previous call. When a step method such as `pm.Slice` updates the parameter of a
+        single participant in a hierarchical model, only the trials of that participant
+        are passed to `logp`, and the log-likelihoods of the other trials are reused.
+        This requires that the log-likelihood of each trial only depends on the data
+        and the parameters of that trial. Defaults to False.
 
     Returns
     -------
     Op
         An pytensor op that wraps the log-likelihood function.
     """
+    if parallel not in ["thread", "process"]:
+        raise ValueError(
+            f"`parallel` must be either 'thread' or 'process', but got '{parallel}'."
+        )
+
+    if grad_method not in [None, "finite_differences"]:
+        raise ValueError(
+            "`grad_method` must be either None or 'finite_differences', "
+            + f"but got '{grad_method}'."
+        )
 
     class BlackBoxOp(Op):  # pylint: disable=W0223
         """Wraps an arbitrary function in a pytensor Op."""
 
+        has_grad = grad_method is not None
+
+        def __init__(self):
+            self._executor: Executor | None = None
+            self._shared_data: _SharedData | None = None
+            self._logp_pickled: bytes | None = None
+            self._cache: OrderedDict[bytes, np.ndarray] = OrderedDict()
+            self._data_digest: tuple[Any, bytes] | None = None
+            self.cache_hits = 0
+            self.cache_misses = 0
+            self._previous: tuple[Any, list[np.ndarray], np.ndarray] | None = None
+
+        def __getstate__(self):
+            """Exclude the worker pool, shared memory and cache from pickling."""
+            state = self.__dict__.copy()
+            state["_executor"] = None
+            state["_shared_data"] = None
+            state["_cache"] = OrderedDict()
+            state["_data_digest"] = None
+            state["_previous"] = None
+            return state
+
+        def clear_cache(self):
+            """Empty the cache and reset the hit and miss counters."""
+            self._cache.clear()
+            self._data_digest = None
+            self._previous = None
+            self.cache_hits = 0
+            self.cache_misses = 0
+
         def make_node(self, data, *dist_params):
             """Take the inputs to the Op and puts them in a list.
 
@@ -65,8 +316,231 @@ def make_blackbox_op(logp: Callable) -> Op:
                 output_storage. There is one storage cell for each output of
                 the Op.
             """
-            result = logp(*inputs)
-            output_storage[0][0] = np.asarray(result, dtype=node.outputs[0].dtype)
+            dtype = node.outputs[0].dtype
+            if cache_size <= 0:
+                output_storage[0][0] = self._evaluate_incremental(inputs, dtype)
+                return
+
+            key = self._cache_key(inputs)
+            if key in self._cache:
+                self.cache_hits += 1
+                self._cache.move_to_end(key)
+                result = self._cache[key]
+            else:
+                self.cache_misses += 1
+                result = self._evaluate_incremental(inputs, dtype)
+                self._cache[key] = result
+                if len(self._cache) > cache_size:
+                    self._cache.popitem(last=False)
+            # A copy is returned because later Ops may overwrite their inputs in place.
+            output_storage[0][0] = result.copy()
+
+        def _cache_key(self, inputs: list[Any]) -> bytes:
+            """Hash the inputs. The digest of the data is computed once."""
+            if self.params_only:
+                return _hash_arrays(inputs)
+
+            data, dist_params = inputs[0], inputs[1:]
+            if self._data_digest is None or self._data_digest[0] is not data:
+                self._data_digest = (data, _hash_arrays([data]))
+            return self._data_digest[1] + _hash_arrays(dist_params)
+
+        def grad(self, inputs, output_grads):
+            """Compute the gradient with finite differences, if enabled."""
+            if not self.has_grad or self.params_only:
+                return [
+                    grad_not_implemented(self, i, inp) for i, inp in enumerate(inputs)
+                ]
+
+            data, dist_params = inputs[0], inputs[1:]
+            # Constant parameters, such as extra fields, are not differentiated.
+            wrt = [
+                i
+                for i, param in enumerate(dist_params)
+                if not isinstance(param, pt.TensorConstant)
+            ]
+            if not wrt:
+                return [pt.zeros_like(inp) for inp in inputs]
+
+            grad_op = BlackBoxGradOp(self, wrt)
+            derivatives = grad_op(data, *dist_params)
+            if not isinstance(derivatives, list):
+                derivatives = [derivatives]
+
+            (output_grad,) = output_grads
+            grads = [grad_not_implemented(self, 0, data)]
+            derivative_iter = iter(derivatives)
+            for i, param in enumerate(dist_params):
+                if i not in wrt:
+                    grads.append(pt.zeros_like(param))
+                    continue
+                param_grad = output_grad * next(derivative_iter)
+                # Parameters broadcast over trials receive the sum of the gradients.
+                if param.ndim == 0:
+                    param_grad = param_grad.sum()
+                elif param.type.shape[0] == 1:
+                    param_grad = param_grad.sum(keepdims=True)
+                grads.append(param_grad.astype(param.dtype))
+
+            return grads
+
+        def _evaluate_incremental(self, inputs: list[Any], dtype: str) -> np.ndarray:
+            """Re-evaluate only the trials whose parameters changed, if enabled."""
+            if not incremental or self.params_only:
+                return np.asarray(self._evaluate(*inputs), dtype=dtype)
+
+            data, dist_params = inputs[0], [np.asarray(p) for p in inputs[1:]]
+            n_trials = data.shape[0]
+            previous = self._previous
+            changed: np.ndarray | None = None
+            if (
+                previous is not None
+                and previous[0] is data
+                and previous[2].dtype == dtype
+                and all(
+                    param.shape == last.shape
+                    for param, last in zip(dist_params, previous[1])
+                )
+            ):
+                changed = np.zeros(n_trials, dtype=bool)
+                for param, last in zip(dist_params, previous[1]):
+                    changed |= np.broadcast_to(
+                        (param != last).reshape(-1)
+                        if param.ndim > 0
+                        else param != last,
+                        n_trials,
+                    )
+
+            if changed is None or changed.all():
+                result = np.asarray(self._evaluate(data, *dist_params), dtype=dtype)
+            else:
+                assert previous is not None
+                result = previous[2].copy()
+                if changed.any():
+                    idx = np.flatnonzero(changed)
+                    # The changed trials are passed as indices into the data, so that
+                    # the process pool keeps using the shared copy of the full data.
+                    result[idx] = self._evaluate(
+                        data,
+                        *[
+                            param[idx] if param.ndim > 0 and len(param) > 1 else param
+                            for param in dist_params
+                        ],
+                        rows=idx,
+                    )
+
+            self._previous = (data, [param.copy() for param in dist_params], result)
+            # A copy is returned because later Ops may overwrite their inputs in place.
+            return result.copy()
+
+        def _evaluate(self, *inputs, rows: np.ndarray | None = None) -> np.ndarray:
+            """Evaluate the log-likelihood, in chunks if workers are requested.
+
+            When `rows` is provided, the log-likelihood is evaluated on `data[rows]`,
+            and the parameters that vary by trial must have the length of `rows`.
+            """
+            if self.params_only:
+                return logp(*inputs)
+            if n_workers is not None and n_workers > 1:
+                return self._evaluate_in_chunks(inputs[0], list(inputs[1:]), rows)
+            data = inputs[0] if rows is None else inputs[0][rows]
+            return logp(data, *inputs[1:])
+
+        def _evaluate_in_chunks(
+            self, data: np.ndarray, dist_params: list[Any], rows: np.ndarray | None
+        ) -> np.ndarray:
+            """Split the trials into chunks and evaluate them in parallel."""
+            assert n_workers is not None
+            n_trials = data.shape[0] if rows is None else len(rows)
+            size = chunk_size or -(-n_trials // n_workers)
+            chunks = [
+                (start, min(start + size, n_trials))
+                for start in range(0, n_trials, size)
+            ]
+            if len(chunks) <= 1:
+                return logp(data if rows is None else data[rows], *dist_params)
+
+            def chunk_rows(start: int, stop: int) -> slice | np.ndarray:
+                return slice(start, stop) if rows is None else rows[start:stop]
+
+            if self._executor is None:
+                self._executor = (
+                    ThreadPoolExecutor(max_workers=n_workers)
+                    if parallel == "thread"
+                    else ProcessPoolExecutor(
+                        max_workers=n_workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+                )
+                weakref.finalize(self, self._executor.shutdown, wait=False)
+
+            if parallel == "thread":
+                futures = [
+                    self._executor.submit(
+                        logp,
+                        data[chunk_rows(start, stop)],
+                        *_split_params(dist_params, n_trials, start, stop),
+                    )
+                    for start, stop in chunks
+                ]
+            else:
+                # The data is copied into shared memory once and reused by all calls
+                # with the same data. Only the indices of the rows are sent to the
+                # workers.
+                if self._shared_data is None or not self._shared_data.holds(data):
+                    if self._shared_data is not None:
+                        self._shared_data.release()
+                    self._shared_data = _SharedData(data)
+                if self._logp_pickled is None:
+                    self._logp_pickled = cloudpickle.dumps(logp)
+                futures = [
+                    self._executor.submit(
+                        _evaluate_chunk_shared,
+                        self._logp_pickled,
+                        self._shared_data.shm.name,
+                        data.shape,
+                        data.dtype.str,
+                        chunk_rows(start, stop),
+                        _split_params(dist_params, n_trials, start, stop),
+                    )
+                    for start, stop in chunks
+                ]
+
+            return np.concatenate(
+                [np.reshape(future.result(), -1) for future in futures]
+            )
+
+    class BlackBoxGradOp(Op):  # pylint: disable=W0223
+        """Computes trial-wise finite-difference derivatives of a BlackBoxOp."""
+
+        __props__ = ("forward_op", "wrt")
+
+        def __init__(self, forward_op: BlackBoxOp, wrt: list[int]):
+            self.forward_op = forward_op
+            self.wrt = tuple(wrt)
+
+        def make_node(self, data, *dist_params):
+            """Create an Apply node with one output per differentiated parameter."""
+            inputs = [pt.as_tensor_variable(data)] + [
+                pt.as_tensor_variable(dist_param) for dist_param in dist_params
+            ]
+            outputs = [pt.vector() for _ in self.wrt]
+
+            return Apply(self, inputs, outputs)
+
+        def perform(self, node, inputs, output_storage):
+            """Compute the derivatives with one batched call of the likelihood."""
+            derivatives = _finite_difference_grads(
+                self.forward_op._evaluate,
+                inputs[0],
+                list(inputs[1:]),
+                list(self.wrt),
+                fd_step,
+            )
+            for storage, derivative, output in zip(
+                output_storage, derivatives, node.outputs
+            ):
+                storage[0] = derivative.astype(output.dtype)
 
     blackbox_op: Op = BlackBoxOp()
     return blackbox_op
@@ -6,6 +6,9 @@ generation ops.
 """
 
 import logging
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import AbstractContextManager, nullcontext
 from os import PathLike
 from pathlib import Path
 from typing import Any, Callable, Literal, Type
@@ -25,10 +28,14 @@ from ssms.config import model_config as ssms_model_config
 from ..utils import download_hf
 from .blackbox import make_blackbox_op
 from .onnx import (
+    make_jax_fused_logp,
+    make_jax_logp_and_partials_from_onnx,
     make_jax_logp_funcs_from_onnx,
     make_jax_logp_ops,
+    make_onnxruntime_logp,
     make_pytensor_logp,
 )
+from .onnx.precision import Precision, check_precision
 
 LogLikeFunc = Callable[..., ArrayLike]
 LogLikeGrad = Callable[..., ArrayLike]
@@ -82,6 +89,54 @@ def apply_param_bounds_to_loglik(
     return logp
 
 
+def get_unique_param_rows(param_groups: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Find the unique rows of the parameters from the group of each trial.
+
+    This is used by `assemble_callables` to evaluate the missing-data networks once
+    per unique row of the parameters.
+
+    Parameters
+    ----------
+    param_groups
+        A 1D integer array with the group of each trial. Trials with the same group
+        share the same values for all parameters.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The index of the first trial of each group, which can be used to select the
+        unique rows of the parameters, and the index of the group of each trial, which
+        can be used to gather the results computed for the unique rows back to the
+        trials.
+    """
+    _, unique_idx, inverse_idx = np.unique(
+        np.asarray(param_groups), return_index=True, return_inverse=True
+    )
+    return unique_idx, inverse_idx.reshape(-1)
+
+
+def select_unique_param_rows(
+    dist_params: list[Any], unique_idx: np.ndarray
+) -> list[Any]:
+    """Select the unique rows of the parameters that vary by trial.
+
+    Parameters
+    ----------
+    dist_params
+        The distribution parameters. Scalar parameters are returned unchanged.
+    unique_idx
+        The index of the first trial of each group of trials that share the same
+        parameter values.
+
+    Returns
+    -------
+    list
+        The parameters, with the vector parameters reduced to their unique rows.
+    """
+    dist_params = [pt.as_tensor_variable(param) for param in dist_params]
+    return [param if param.ndim == 0 else param[unique_idx] for param in dist_params]
+
+
 # AF-TODO: define clip params
 
 
@@ -125,8 +180,127 @@ def ensure_positive_ndt(data, logp, list_params, dist_params):
     )
 
 
+def _add_lapse(logp: Any, lapse_logp: Any, p_outlier: Any):
+    """Mix the log-likelihoods with the lapse distribution in log space.
+
+    Parameters
+    ----------
+    logp
+        The log-likelihoods of the model.
+    lapse_logp
+        The log-densities of the lapse distribution.
+    p_outlier
+        The probability of a lapse.
+
+    Returns
+    -------
+        The log of `(1 - p_outlier) * exp(logp) + p_outlier * exp(lapse_logp)`.
+    """
+    is_model = pt.eq(p_outlier, 0)
+    is_lapse = pt.eq(p_outlier, 1)
+    # At 0 and 1 one of the log-weights is -inf and its gradient is not finite, so
+    # only that log-weight is replaced by a constant -inf. The mixture then reduces
+    # to the pure component, and its gradient with respect to p_outlier comes from
+    # the other log-weight.
+    log_p = pt.switch(is_model, -np.inf, pt.log(pt.switch(is_model, 1.0, p_outlier)))
+    log_1mp = pt.switch(
+        is_lapse, -np.inf, pt.log1p(-pt.switch(is_lapse, 0.0, p_outlier))
+    )
+
+    log_model = log_1mp + logp
+    log_lapse = log_p + lapse_logp
+    # The larger term is factored out, so that the sum does not underflow when both
+    # terms are very negative, and so that a -inf term adds exactly 0.
+    log_max = pt.maximum(log_model, log_lapse)
+
+    return log_max + pt.log(pt.exp(log_model - log_max) + pt.exp(log_lapse - log_max))
+
+
+def _simulate(
+    theta: np.ndarray,
+    model_name: str,
+    n_samples: int,
+    seed: int,
+    kwargs: dict[str, Any],
+) -> np.ndarray:
+    """Simulate from an ssm_simulators model and stack the rts and the choices."""
+    sim_out = simulator(
+        theta=theta,
+        model=model_name,
+        n_samples=n_samples,
+        random_state=seed,
+        **kwargs,
+    )
+
+    return np.column_stack([sim_out["rts"], sim_out["choices"]])
+
+
+def _make_simulation_executor(n_workers: int) -> ProcessPoolExecutor:
+    """Make a pool of processes for `_simulate_in_parallel`.
+
+    The processes are spawned rather than forked, because forking a process in which
+    JAX has started its threads can deadlock. As a result, scripts that simulate in
+    parallel must protect their entry point with `if __name__ == "__main__":`.
+    """
+    return ProcessPoolExecutor(
+        max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def _simulate_in_parallel(
+    executor: Executor,
+    theta: np.ndarray,
+    model_name: str,
+    n_samples: int,
+    seed: int,
+    n_shards: int,
+    kwargs: dict[str, Any],
+    split_samples: bool,
+) -> np.ndarray:
+    """Split a simulation into shards that are run in a pool of processes.
+
+    The samples are split into contiguous shards if `split_samples` is True, and the
+    rows of `theta` otherwise, with one sample per row. Each shard is simulated with
+    its own seed spawned from `seed`, so the results only depend on `seed` and
+    `n_shards`, and they are copied into one output array in the order of the shards.
+    """
+    n_total = n_samples if split_samples else theta.shape[0]
+    size = -(-n_total // n_shards)
+    bounds = [(start, min(start + size, n_total)) for start in range(0, n_total, size)]
+    seeds = [
+        int(seed_seq.generate_state(1)[0])
+        for seed_seq in np.random.SeedSequence(seed).spawn(len(bounds))
+    ]
+
+    futures = [
+        (
+            executor.submit(
+                _simulate, theta, model_name, stop - start, shard_seed, kwargs
+            )
+            if split_samples
+            else executor.submit(
+                _simulate, theta[start:stop], model_name, 1, shard_seed, kwargs
+            )
+        )
+        for (start, stop), shard_seed in zip(bounds, seeds)
+    ]
+
+    sims_out: np.ndarray | None = None
+    for (start, stop), future in zip(bounds, futures):
+        result = future.result()
+        if sims_out is None:
+            sims_out = np.empty((n_total, 2), dtype=result.dtype)
+        sims_out[start:stop] = result
+
+    assert sims_out is not None
+    return sims_out
+
+
 def make_ssm_rv(
-    model_name: str, list_params: list[str], lapse: bmb.Prior | None = None
+    model_name: str,
+    list_params: list[str],
+    lapse: bmb.Prior | None = None,
+    n_workers: int | None = None,
 ) -> Type[RandomVariable]:
     """Build a RandomVariable Op according to the list of parameters.
 
@@ -140,6 +314,17 @@ def make_ssm_rv(
         A list of str of all parameters for this `RandomVariable`.
     lapse : optional
         A bmb.Prior object representing the lapse distribution.
+    n_workers : optional
+        The number of processes used to simulate from the model. When larger than 1,
+        the trials, or the samples if all parameters are scalars, are split into
+        `n_workers` shards that are simulated in parallel, each with a seed derived
+        from the random generator passed to `rng_fn`. The results are reproducible
+        for the same seed and `n_workers`. This can be changed later by setting the
+        `_n_workers` attribute of the returned class. The pool of processes is the
+        executor set as the `_executor` attribute of the class, e.g., by
+        `HSSM.sample_posterior_predictive`, or otherwise a pool that only lives for
+        one call to `rng_fn`. Defaults to None, in which case the simulation runs in
+        the current process.
 
     Returns
     -------
@@ -171,6 +356,8 @@ def make_ssm_rv(
         _print_name: tuple[str, str] = ("SSM", "\\operatorname{SSM}")
         _list_params = list_params
         _lapse = lapse
+        _n_workers = n_workers
+        _executor: Executor | None = None
 
         # PyTensor, as of version 2.12, enforces a check to ensure that
         # at least one parameter has the same ndims as the support.
@@ -306,15 +493,31 @@ def make_ssm_rv(
                 else:
                     n_samples = size // new_data_size
 
-            sim_out = simulator(
-                theta=theta,
-                model=model_name,
-                n_samples=n_samples,
-                random_state=seed,
-                **kwargs,
+            n_shards = min(
+                cls._n_workers or 1, n_samples if is_all_scalar else theta.shape[0]
             )
-
-            sims_out = np.column_stack([sim_out["rts"], sim_out["choices"]])
+            # Several samples from each row of `theta` are not split, because the
+            # simulator returns them grouped by sample.
+            if n_shards > 1 and (is_all_scalar or n_samples == 1):
+                # A pool made for this call is shut down when the call returns
+                executor_context: AbstractContextManager[Executor]
+                if cls._executor is None:
+                    executor_context = _make_simulation_executor(n_shards)
+                else:
+                    executor_context = nullcontext(cls._executor)
+                with executor_context as executor:
+                    sims_out = _simulate_in_parallel(
+                        executor,
+                        theta,
+                        model_name,
+                        n_samples,
+                        seed,
+                        n_shards,
+                        kwargs,
+                        split_samples=is_all_scalar,
+                    )
+            else:
+                sims_out = _simulate(theta, model_name, n_samples, seed, kwargs)
 
             if not is_all_scalar:
                 sims_out = sims_out.reshape(
@@ -364,6 +567,7 @@ def make_distribution(
     bounds: dict | None = None,
     lapse: bmb.Prior | None = None,
     extra_fields: list[np.ndarray] | None = None,
+    weights: np.ndarray | None = None,
 ) -> Type[pm.Distribution]:
     """Make a `pymc.Distribution`.
 
@@ -393,6 +597,10 @@ def make_distribution(
     extra_fields : optional
         An optional list of arrays that are stored in the class created and will be
         used in likelihood calculation. Defaults to None.
+    weights : optional
+        An optional 1D array of the same length as the data. The log-likelihood of
+        each row is multiplied by its weight, e.g., the number of times the row occurs
+        in a dataset where duplicated rows are collapsed. Defaults to None.
 
     Returns
     -------
@@ -405,15 +613,7 @@ def make_distribution(
         if list_params[-1] != "p_outlier":
             list_params.append("p_outlier")
 
-        data_vector = pt.dvector()
-        lapse_logp = pm.logp(
-            get_distribution_from_prior(lapse).dist(**lapse.args),
-            data_vector,
-        )
-        lapse_func = pytensor.function(
-            [data_vector],
-            lapse_logp,
-        )
+        lapse_dist = get_distribution_from_prior(lapse).dist(**lapse.args)
 
     class SSMDistribution(pm.Distribution):
         """Wiener first-passage time (WFPT) log-likelihood for LANs."""
@@ -425,6 +625,7 @@ def make_distribution(
         rv_op = random_variable()
         params = list_params
         _extra_fields = extra_fields
+        _weights = weights
 
         @classmethod
         def dist(cls, **kwargs):  # pylint: disable=arguments-renamed
@@ -449,14 +650,12 @@ def make_distribution(
             if list_params[-1] == "p_outlier":
                 p_outlier = dist_params[-1]
                 dist_params = dist_params[:-1]
-                lapse_logp = lapse_func(data[:, 0].eval())
+                # The log-density of the lapse distribution only depends on the data,
+                # so it is constant-folded when the graph is compiled.
+                lapse_logp = pm.logp(lapse_dist, pt.as_tensor_variable(data)[:, 0])
                 # AF-TODO potentially apply clipping here
                 logp = loglik(data, *dist_params, *extra_fields)
-                logp = pt.log(
-                    (1.0 - p_outlier) * pt.exp(logp)
-                    + p_outlier * pt.exp(lapse_logp)
-                    + 1e-29
-                )
+                logp = _add_lapse(logp, lapse_logp, p_outlier)
             else:
                 logp = loglik(data, *dist_params, *extra_fields)
 
@@ -467,7 +666,12 @@ def make_distribution(
 
             # Ensure that non-decision time is always smaller than rt.
             # Assuming that the non-decision time parameter is always named "t".
-            return ensure_positive_ndt(data, logp, list_params, dist_params)
+            logp = ensure_positive_ndt(data, logp, list_params, dist_params)
+
+            if SSMDistribution._weights is not None:
+                logp = logp * pm.floatX(SSMDistribution._weights)
+
+            return logp
 
     return SSMDistribution
 
@@ -522,9 +726,12 @@ class SSMFamily(bmb.Family):
 def make_likelihood_callable(
     loglik: pytensor.graph.Op | Callable | PathLike | str,
     loglik_kind: Literal["analytical", "approx_differentiable", "blackbox"],
-    backend: Literal["pytensor", "jax", "other"] | None,
+    backend: Literal["pytensor", "jax", "onnxruntime", "other"] | None,
     params_is_reg: list[bool] | None = None,
     params_only: bool | None = None,
+    precision: Precision | None = None,
+    precision_grid: np.ndarray | None = None,
+    chunk_size: int | None = None,
 ) -> pytensor.graph.Op | Callable:
     """Make a callable for the likelihood function.
 
@@ -540,13 +747,27 @@ def make_likelihood_callable(
         The kind of the log-likelihood for the model. This parameter controls
         how the likelihood function is wrapped.
     backend : Optional
-        The backend to use for the log-likelihood function.
+        The backend to use for the log-likelihood function. With `onnxruntime`, the
+        ONNX model is run by onnxruntime in a BlackBoxOp without gradients.
     params_is_reg : Optional
         A list of boolean values indicating whether the parameters are regression
         parameters. Defaults to None.
     params_only : Optional
         Whether the missing data likelihood is takes its first argument as the data.
         Defaults to None.
+    precision : Optional
+        The precision of the matrix multiplications of a LAN with the `jax` backend.
+        One of `"bfloat16"`, `"float16"`, or `"int8"`. Defaults to None, in which
+        case the LAN is evaluated in full precision.
+    precision_grid : Optional
+        The inputs of the LAN at which the reduced-precision outputs are compared to
+        the full-precision outputs. An error is raised if they differ by more than
+        `hssm.distribution_utils.onnx.precision.DEFAULT_PRECISION_ATOL`. Defaults to
+        None, in which case the accuracy is not checked.
+    chunk_size : Optional
+        If provided, a LAN with the `jax` backend is evaluated in blocks of
+        `chunk_size` trials to bound the memory used by its activations. Defaults to
+        None.
     """
     if isinstance(loglik, pytensor.graph.Op):
         return loglik
@@ -581,10 +802,26 @@ def make_likelihood_callable(
 
     onnx_model = onnx.load(str(loglik))
 
+    if backend != "jax" and chunk_size is not None:
+        raise ValueError("`chunk_size` is only supported with the `jax` backend.")
+
+    if precision is not None:
+        if backend != "jax":
+            raise ValueError(
+                "Reduced `precision` is only supported with the `jax` backend."
+            )
+        if precision_grid is not None:
+            check_precision(onnx_model.graph, precision, precision_grid)
+
     if backend == "pytensor":
         lan_logp_pt = make_pytensor_logp(onnx_model)
         return lan_logp_pt
 
+    if backend == "onnxruntime":
+        return make_blackbox_op(
+            make_onnxruntime_logp(onnx_model, params_only=bool(params_only))
+        )
+
     if params_is_reg is None:
         raise ValueError(
             "You set `loglik_kind` to `approx_differentiable` "
@@ -595,17 +832,28 @@ def make_likelihood_callable(
         onnx_model,
         params_is_reg,
         params_only=False if params_only is None else params_only,
+        precision=precision,
+        chunk_size=chunk_size,
     )
     lan_logp_jax = make_jax_logp_ops(logp, logp_grad, logp_nojit)
 
-    return lan_logp_jax
+    if params_only:
+        return lan_logp_jax
+
+    # The log-likelihoods and their gradient are computed in one call to XLA. The
+    # value-only Op is used instead when the gradient is not needed.
+    return make_jax_fused_logp(
+        *make_jax_logp_and_partials_from_onnx(onnx_model, precision, chunk_size),
+        lan_logp_jax,
+    )
 
 
 def make_missing_data_callable(
     loglik: pytensor.graph.Op | Callable | PathLike | str,
-    backend: Literal["pytensor", "jax", "other"] | None = "jax",
+    backend: Literal["pytensor", "jax", "onnxruntime", "other"] | None = "jax",
     params_is_reg: list[bool] | None = None,
     params_only: bool | None = None,
+    chunk_size: int | None = None,
 ) -> pytensor.graph.Op | Callable:
     """Make a secondary network for the likelihood function.
 
@@ -625,7 +873,12 @@ def make_missing_data_callable(
 
     # We assume that the missing data network is always approx_differentiable
     return make_likelihood_callable(
-        loglik, "approx_differentiable", backend, params_is_reg, params_only
+        loglik,
+        "approx_differentiable",
+        backend,
+        params_is_reg,
+        params_only,
+        chunk_size=chunk_size,
     )
 
 
@@ -634,6 +887,9 @@ def assemble_callables(
     missing_data_callable: pytensor.graph.Op | Callable,
     params_only: bool,
     has_deadline: bool,
+    param_groups: np.ndarray | None = None,
+    n_missing: int | None = None,
+    n_trials: int | None = None,
 ) -> Callable:
     """Assemble the likelihood callables into a single callable.
 
@@ -647,7 +903,28 @@ def assemble_callables(
         Whether the missing data likelihood is takes its first argument as the data.
     has_deadline
         Whether the model has a deadline.
+    param_groups : optional
+        An optional 1D integer array indicating the group of each trial with missing
+        data, which come first in the data. Trials in the same group share the same
+        parameter values and, when `params_only` is False, the same deadline. The
+        missing data likelihood is evaluated once per group and the results are
+        gathered back to the trials.
+    n_missing : optional
+        The number of trials with missing data, which come first in the data. When
+        provided, the data are split at a fixed index instead of counting the missing
+        trials every time the likelihood is evaluated, and, when `params_only` is
+        True and all parameters are scalars, the missing data likelihood is evaluated
+        only once for all missing trials. Defaults to None.
+    n_trials : optional
+        The number of trials of the data for which `param_groups` and
+        `n_missing` were computed. They are only used when the static length of the
+        data equals `n_trials`. For other data, e.g., new data passed for posterior
+        predictive sampling, or data of unknown length, the missing trials are counted
+        when the likelihood is evaluated. Defaults to None, in which case
+        `param_groups` and `n_missing` are never used.
     """
+    if n_missing == 0:
+        raise ValueError("No missing data in the data.")
 
     def likelihood_callable(data, *dist_params):
         """Compute the log-likelihoood of the model."""
@@ -655,14 +932,21 @@ def assemble_callables(
         data = pt.as_tensor_variable(data)
         dist_params = [pt.as_tensor_variable(param) for param in dist_params]
 
-        n_missing = pt.sum(pt.eq(data[:, 0], -999.0)).astype(int)
-        if n_missing == 0:
-            raise ValueError("No missing data in the data.")
+        if n_trials is not None and data.type.shape[0] == n_trials:
+            static_n_missing, static_param_groups = n_missing, param_groups
+        else:
+            static_n_missing, static_param_groups = None, None
 
-        observed_data = data[n_missing:, :]
+        split = (
+            pt.sum(pt.eq(data[:, 0], -999.0)).astype(int)
+            if static_n_missing is None
+            else static_n_missing
+        )
+
+        observed_data = data[split:, :]
 
         dist_params_observed = [
-            param if param.ndim == 0 else param[n_missing:] for param in dist_params
+            param if param.ndim == 0 else param[split:] for param in dist_params
         ]
 
         if has_deadline:
@@ -671,19 +955,43 @@ def assemble_callables(
             logp_observed = callable(observed_data, *dist_params_observed)
 
         dist_params_missing = [
-            param if param.ndim == 0 else param[:n_missing] for param in dist_params
+            param if param.ndim == 0 else param[:split] for param in dist_params
         ]
 
-        if params_only:
+        if (
+            params_only
+            and static_n_missing is not None
+            and all(param.ndim == 0 for param in dist_params)
+        ):
+            # All missing trials have the same likelihood
             logp_missing = missing_data_callable(None, *dist_params_missing)
+            logp_missing = pt.broadcast_to(
+                pt.reshape(logp_missing, (1,)), (static_n_missing,)
+            )
+        elif static_param_groups is not None:
+            unique_idx, inverse_idx = get_unique_param_rows(static_param_groups)
+            logp_missing = missing_data_callable(
+                None if params_only else data[unique_idx, -1:],
+                *select_unique_param_rows(dist_params, unique_idx),
+            )
+            logp_missing = logp_missing[inverse_idx]
         else:
-            missing_data = data[:n_missing, -1:]
-            logp_missing = missing_data_callable(missing_data, *dist_params_missing)
-
-        logp = pt.empty_like(data[:, 0], dtype=pytensor.config.floatX)
-        logp = pt.set_subtensor(logp[n_missing:], logp_observed)
-        logp = pt.set_subtensor(logp[:n_missing], logp_missing)
+            logp_missing = missing_data_callable(
+                None if params_only else data[:split, -1:], *dist_params_missing
+            )
 
-        return logp
+        if static_n_missing is None:
+            logp = pt.empty_like(data[:, 0], dtype=pytensor.config.floatX)
+            logp = pt.set_subtensor(logp[split:], logp_observed)
+            logp = pt.set_subtensor(logp[:split], logp_missing)
+            return logp
+
+        # The missing trials come first, so the two parts are simply joined.
+        return pt.concatenate(
+            [
+                logp_missing.astype(pytensor.config.floatX),
+                logp_observed.astype(pytensor.config.floatX),
+            ]
+        )
 
     return likelihood_callable
@@ -1,8 +1,11 @@
 """Utility functions for creating pytensor Ops from onnx model files."""
 
 from .onnx import (
+    make_jax_fused_logp,
+    make_jax_logp_and_partials_from_onnx,
     make_jax_logp_funcs_from_onnx,
     make_jax_logp_ops,
+    make_onnxruntime_logp,
     make_pytensor_logp,
 )
 from .onnx2pt import pt_interpret_onnx
@@ -10,8 +13,11 @@ from .onnx2xla import interpret_onnx
 
 __all__ = [
     "interpret_onnx",
+    "make_jax_fused_logp",
+    "make_jax_logp_and_partials_from_onnx",
     "make_jax_logp_funcs_from_onnx",
     "make_jax_logp_ops",
+    "make_onnxruntime_logp",
     "make_pytensor_logp",
     "pt_interpret_onnx",
 ]
@@ -0,0 +1,206 @@
+"""An on-disk cache of the compiled XLA executables of LAN likelihoods.
+
+JAX only persists compiled executables on GPU and TPU in the versions supported by
+HSSM. This module provides `CachedJit`, a drop-in replacement of `jax.jit` for the
+functions that are called outside of JAX tracing, e.g., in the `perform` method of
+the pytensor Ops. When a cache directory is set with `set_cache_dir`, the executable
+compiled for each combination of argument shapes and dtypes is serialized to that
+directory, and later calls in any process with the same key load it instead of
+tracing and compiling the function again.
+
+The serialized executables are pickles, so loading one from a directory that other
+users can write to would let them run arbitrary code. The cache directory is
+therefore created private to the current user, and directories and files that are
+not owned by the current user or are writable by others are never read.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import platform
+import stat
+from functools import cache
+from pathlib import Path
+from typing import Any, Callable, Hashable
+
+import jax
+import jaxlib
+import numpy as np
+from jax.experimental.serialize_executable import deserialize_and_load, serialize
+
+_logger = logging.getLogger("hssm")
+
+# The directory of the cache. The cache is disabled when it is None.
+_cache_dir: Path | None = None
+
+
+def set_cache_dir(cache_dir: str | os.PathLike | None) -> None:
+    """Set the directory where the compiled executables are cached.
+
+    Parameters
+    ----------
+    cache_dir
+        The directory of the cache, which is created if needed with access only for
+        the current user. If None, the executables are not cached on disk.
+
+    Raises
+    ------
+    ValueError
+        If the directory is not owned by the current user or is writable by others.
+    """
+    global _cache_dir  # pylint: disable=W0603
+    if cache_dir is None:
+        _cache_dir = None
+        return
+
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+    if not _is_private(cache_dir.stat()):
+        raise ValueError(
+            f"The cache directory {cache_dir} must be owned by the current user and "
+            + "must not be writable by other users."
+        )
+    _cache_dir = cache_dir
+
+
+def _is_private(stats: os.stat_result) -> bool:
+    """Check that a file is owned by the current user and not writable by others."""
+    if not hasattr(os, "getuid"):
+        # Ownership is not reported by `os.stat` on Windows.
+        return True
+    return stats.st_uid == os.getuid() and not stats.st_mode & (
+        stat.S_IWGRP | stat.S_IWOTH
+    )
+
+
+def _abstract_signature(args: tuple, kwargs: dict) -> str:
+    """Describe the structure, shapes and dtypes that an executable is compiled for.
+
+    Python scalars are weakly typed in JAX and are marked as such, because they are
+    compiled differently from arrays of the same dtype.
+    """
+    leaves, treedef = jax.tree_util.tree_flatten((args, kwargs))
+    return repr(
+        (
+            treedef,
+            [
+                (
+                    np.shape(leaf),
+                    jax.dtypes.canonicalize_dtype(np.result_type(leaf)),
+                    isinstance(leaf, (bool, int, float, complex))
+                    or getattr(leaf, "weak_type", False),
+                )
+                for leaf in leaves
+            ],
+        )
+    )
+
+
+@cache
+def _host_fingerprint() -> tuple[str, ...]:
+    """Describe the software and hardware for which the executables are compiled.
+
+    XLA compiles CPU executables for the features of the host CPU, so the CPU flags
+    are part of the key, and executables are not shared between different machines.
+    """
+    backend = jax.lib.xla_bridge.get_backend()
+    cpu_flags = ""
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo", encoding="utf-8") as cpuinfo:
+            cpu_flags = next(
+                (line for line in cpuinfo if line.startswith(("flags", "Features"))), ""
+            )
+    return (
+        jax.__version__,
+        jaxlib.__version__,
+        backend.platform,
+        backend.platform_version,
+        jax.devices()[0].device_kind,
+        platform.machine(),
+        cpu_flags,
+    )
+
+
+class CachedJit:
+    """A jitted function whose executables are also cached on disk.
+
+    Parameters
+    ----------
+    fn
+        The function to be jitted.
+    key
+        A key that identifies the function, e.g., the hash of the ONNX model and the
+        arguments used to make the function. Functions with the same key must compute
+        the same results.
+    """
+
+    def __init__(self, fn: Callable, key: Hashable):
+        self._jitted = jax.jit(fn)
+        self._key = key
+        self._compiled: dict[str, Any] = {}
+        # The executable of the last call, which is tried first.
+        self._last: Any = None
+
+    def __call__(self, *args, **kwargs):
+        """Call the compiled executable for the shapes and dtypes of the arguments."""
+        if _cache_dir is None:
+            return self._jitted(*args, **kwargs)
+
+        # The arguments rarely change between calls, e.g., when sampling. The
+        # executable checks them in C++, which is much cheaper than computing the
+        # signature in Python, and raises a TypeError if they do not match.
+        if self._last is not None:
+            try:
+                return self._last(*args, **kwargs)
+            except TypeError:
+                pass
+
+        signature = _abstract_signature(args, kwargs)
+        compiled = self._compiled.get(signature)
+        if compiled is None:
+            compiled = self._load_or_compile(_cache_dir, signature, args, kwargs)
+            self._compiled[signature] = compiled
+        self._last = compiled
+
+        return compiled(*args, **kwargs)
+
+    def _load_or_compile(
+        self, cache_dir: Path, signature: str, args: tuple, kwargs: dict
+    ):
+        """Load the executable from the cache, or compile it and write it."""
+        digest = hashlib.sha256(
+            repr((self._key, signature, _host_fingerprint())).encode()
+        ).hexdigest()
+        path = cache_dir / f"{digest}.pkl"
+
+        if path.exists():
+            stats = path.lstat()
+            if not stat.S_ISREG(stats.st_mode) or not _is_private(stats):
+                _logger.warning(
+                    "Ignoring the compiled function in %s, which is not owned by the "
+                    + "current user or is writable by other users.",
+                    path,
+                )
+            else:
+                try:
+                    with open(path, "rb") as file:
+                        return deserialize_and_load(*pickle.load(file))
+                except Exception:  # pylint: disable=W0718
+                    _logger.warning(
+                        "Could not load the compiled function from %s. "
+                        + "Compiling it again.",
+                        path,
+                    )
+
+        compiled = self._jitted.lower(*args, **kwargs).compile()
+
+        # The file is written under a temporary name and renamed, so that other
+        # processes never read a partially written file.
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as file:
+            pickle.dump(serialize(compiled), file)
+        os.replace(tmp_path, path)
+
+        return compiled
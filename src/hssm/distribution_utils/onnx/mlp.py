@@ -0,0 +1,277 @@
+"""A fused PyTensor Op for LANs that are dense multilayer perceptrons.
+
+`pt_interpret_onnx` expands an ONNX graph into generic PyTensor ops, so that the
+gradient of a LAN is obtained through autodiff of many small nodes. Most LANs are
+dense MLPs, a chain of `Gemm` layers with `Tanh` or `Relu` activations, optionally
+followed by elementwise output transformations. For these networks, this module
+provides an Op that computes the forward pass with one BLAS matrix multiplication per
+layer and the derivatives of each output with respect to the inputs of the same row
+with a hand-coded backward pass.
+"""
+
+from typing import Callable
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytensor.tensor as pt
+from pytensor.gradient import DisconnectedType, grad_not_implemented
+from pytensor.graph import Apply, Op
+from pytensor.graph.rewriting.basic import node_rewriter
+from pytensor.link.jax.dispatch import jax_funcify
+from pytensor.tensor.rewriting.basic import register_specialize
+
+from .optimize import optimize_graph
+
+# Elementwise ops supported between the dense layers and their JAX implementations
+_JAX_ACTIVATIONS: dict[str, Callable[[jnp.ndarray], jnp.ndarray]] = {
+    "Tanh": jnp.tanh,
+    "Relu": lambda h: jnp.maximum(h, 0),
+    "Neg": lambda h: -h,
+    "Softplus": jax.nn.softplus,
+}
+_ACTIVATIONS = tuple(_JAX_ACTIVATIONS)
+
+Layer = tuple[str, np.ndarray | None, np.ndarray | None]
+
+
+def extract_mlp_layers(graph) -> list[Layer] | None:
+    """Extract the layers of a dense MLP from an ONNX graph.
+
+    Parameters
+    ----------
+    graph
+        The computation graph.
+
+    Returns
+    -------
+    list[Layer] | None
+        A list of `(op_type, weight, bias)` tuples, where `weight` and `bias` are None
+        for elementwise ops, or None if the graph is not a chain of dense layers and
+        supported activations with one input and a single output unit.
+    """
+    optimized = optimize_graph(graph)
+    if len(optimized.inputs) != 1 or len(optimized.outputs) != 1:
+        return None
+
+    layers: list[Layer] = []
+    dense: list[np.ndarray] = []
+    current = optimized.inputs[0]
+    for node in optimized.nodes:
+        if node.inputs[0] != current or len(node.outputs) != 1:
+            return None
+        if node.op_type in ("Gemm", "MatMul"):
+            if node.attrs or node.inputs[1] not in optimized.constants:
+                return None
+            weight = optimized.constants[node.inputs[1]]
+            bias = None
+            if len(node.inputs) > 2 and node.inputs[2]:
+                if node.inputs[2] not in optimized.constants:
+                    return None
+                bias = optimized.constants[node.inputs[2]]
+            if weight.ndim != 2 or (bias is not None and bias.ndim > 1):
+                return None
+            layers.append(("Dense", weight, bias))
+            dense.append(weight)
+        elif node.op_type in _ACTIVATIONS:
+            layers.append((node.op_type, None, None))
+        else:
+            return None
+        current = node.outputs[0]
+
+    if current != optimized.outputs[0] or not dense or dense[-1].shape[1] != 1:
+        return None
+
+    return layers
+
+
+def mlp_forward_backward(
+    layers: list[Layer], x: np.ndarray, compute_grad: bool = True
+) -> tuple[np.ndarray, np.ndarray | None]:
+    """Compute the outputs of an MLP and their derivatives with respect to the inputs.
+
+    Parameters
+    ----------
+    layers
+        The layers returned by `extract_mlp_layers`.
+    x
+        The `(n_rows, n_inputs)` input matrix.
+    compute_grad : optional
+        Whether to compute the derivatives. Defaults to True.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray | None]
+        The `(n_rows,)` outputs, and the `(n_rows, n_inputs)` derivatives of each output
+        with respect to the inputs of the same row, or None if `compute_grad` is False.
+    """
+    h = x
+    # The local derivative of each elementwise op, kept for the backward pass
+    local_grads: list[np.ndarray | float | None] = []
+    for op_type, weight, bias in layers:
+        if op_type == "Dense":
+            if weight is None:
+                raise ValueError("Each dense layer must have a weight matrix.")
+            h = h @ weight
+            if bias is not None:
+                h = h + bias
+            local_grads.append(None)
+        elif op_type == "Tanh":
+            h = np.tanh(h)
+            local_grads.append(1 - h**2 if compute_grad else None)
+        elif op_type == "Relu":
+            local_grads.append((h > 0).astype(h.dtype) if compute_grad else None)
+            h = np.maximum(h, 0)
+        elif op_type == "Neg":
+            h = -h
+            local_grads.append(-1.0)
+        else:  # Softplus
+            if compute_grad:
+                local_grads.append(np.exp(-np.logaddexp(0, -h)).astype(h.dtype))
+            else:
+                local_grads.append(None)
+            h = np.logaddexp(h, 0).astype(h.dtype)
+
+    output = h.reshape(-1)
+    if not compute_grad:
+        return output, None
+
+    g = np.ones_like(h)
+    for (op_type, weight, _), local_grad in zip(
+        reversed(layers), reversed(local_grads)
+    ):
+        if op_type == "Dense":
+            # The weight was checked in the forward pass.
+            assert weight is not None
+            g = g @ weight.T
+        else:
+            g = g * local_grad
+
+    return output, g
+
+
+class MLPLogpOp(Op):
+    """Applies a dense MLP to an input matrix, optionally with the input derivatives.
+
+    With `compute_grad=True`, the second output holds the derivatives of each output
+    with respect to the inputs of the same row, and the gradient of the first output
+    reuses it. The value and the gradient are then computed by one Apply node when both
+    are requested. When the derivatives are not used, the Op is replaced by the
+    value-only version during graph rewriting.
+
+    Parameters
+    ----------
+    layers
+        The layers returned by `extract_mlp_layers`.
+    compute_grad : optional
+        Whether to also output the derivatives. Defaults to True.
+    """
+
+    def __init__(self, layers: list[Layer], compute_grad: bool = True):
+        self.layers = layers
+        self.compute_grad = compute_grad
+
+    def __eq__(self, other):
+        """Check whether two Ops apply the same layers."""
+        return (
+            type(self) is type(other)
+            and self.compute_grad == other.compute_grad
+            and self.layers is other.layers
+        )
+
+    def __hash__(self):
+        """Hash the identity of the layers."""
+        return hash((type(self), self.compute_grad, id(self.layers)))
+
+    def make_node(self, x):
+        """Take the inputs to the Op and puts them in a list.
+
+        Also specifies the output types in a list, then feed them to the Apply node.
+
+        Parameters
+        ----------
+        x
+            The `(n_rows, n_inputs)` input matrix of the network.
+        """
+        x = pt.as_tensor_variable(x)
+        outputs = [pt.vector(dtype=x.dtype)]
+        if self.compute_grad:
+            outputs.append(pt.matrix(dtype=x.dtype))
+
+        return Apply(self, [x], outputs)
+
+    def perform(self, node, inputs, output_storage):
+        """Perform the Apply node.
+
+        Parameters
+        ----------
+        inputs
+            This is a list of data from which the values stored in
+            output_storage are to be computed using non-symbolic language.
+        output_storage
+            This is a list of storage cells where the output
+            is to be stored. A storage cell is a one-element list. It is
+            forbidden to change the length of the list(s) contained in
+            output_storage. There is one storage cell for each output of
+            the Op.
+        """
+        output, derivatives = mlp_forward_backward(
+            self.layers, inputs[0], self.compute_grad
+        )
+        output_storage[0][0] = np.asarray(output, dtype=node.outputs[0].dtype)
+        if self.compute_grad:
+            output_storage[1][0] = np.asarray(derivatives, dtype=node.outputs[1].dtype)
+
+    def grad(self, inputs, output_gradients):
+        """Perform the pytensor.grad() operation.
+
+        Parameters
+        ----------
+        inputs
+            The same as the inputs produced in `make_node`.
+        output_gradients
+            Holds the results of the perform `perform` method.
+        """
+        if not self.compute_grad or any(
+            not isinstance(g.type, DisconnectedType) for g in output_gradients[1:]
+        ):
+            return [grad_not_implemented(self, 0, inputs[0])]
+
+        derivatives = self(*inputs)[1]
+        return [output_gradients[0][:, None] * derivatives]
+
+
+@register_specialize
+@node_rewriter([MLPLogpOp])
+def local_mlp_value_only(fgraph, node):
+    """Replace the fused MLP Op with the value-only Op if the derivatives are unused."""
+    if not node.op.compute_grad or fgraph.clients.get(node.outputs[1]):
+        return None
+    value_op = MLPLogpOp(node.op.layers, compute_grad=False)
+    return {node.outputs[0]: value_op(*node.inputs)}
+
+
+@jax_funcify.register(MLPLogpOp)
+def mlp_logp_dispatch(op, **kwargs):  # pylint: disable=W0613
+    """Convert the MLP to a JAX function for sampling with JAX backend."""
+
+    def forward(x):
+        h = x
+        for op_type, weight, bias in op.layers:
+            if op_type == "Dense":
+                h = h @ weight
+                if bias is not None:
+                    h = h + bias
+            else:
+                h = _JAX_ACTIVATIONS[op_type](h)
+        return h.reshape(-1)
+
+    if not op.compute_grad:
+        return forward
+
+    def forward_backward(x):
+        output, vjp_fn = jax.vjp(forward, x)
+        (derivatives,) = vjp_fn(jnp.ones_like(output))
+        return output, derivatives
+
+    return forward_backward
@@ -4,30 +4,146 @@ This module handles LAN-related operations, such as producing log-likelihood fun
 from onnx model files and wrapping jax log-likelihood functions in pytensor Ops.
 """
 
+import hashlib
 from os import PathLike
-from typing import Callable
+from typing import Callable, cast
 
+import jax
 import jax.numpy as jnp
 import numpy as np
 import onnx
 import pytensor
 import pytensor.tensor as pt
-from jax import grad, jit, vjp, vmap
+from jax import grad, vjp
 from numpy.typing import ArrayLike
+from pytensor.gradient import DisconnectedType, grad_not_implemented
 from pytensor.graph import Apply, Op
+from pytensor.graph.rewriting.basic import node_rewriter
 from pytensor.link.jax.dispatch import jax_funcify
+from pytensor.tensor.rewriting.basic import register_specialize
 
+from .cache import CachedJit
+from .mlp import MLPLogpOp, extract_mlp_layers
 from .onnx2pt import pt_interpret_onnx
 from .onnx2xla import interpret_onnx
+from .precision import Precision, make_reduced_precision_network
 
 LogLikeFunc = Callable[..., ArrayLike]
 LogLikeGrad = Callable[..., ArrayLike]
 
+# The jitted functions made from ONNX models, keyed by the hash of the model,
+# `params_is_reg`, `params_only`, `precision` and `chunk_size`. Reusing the same
+# jitted functions lets JAX reuse the executables it already compiled for the same
+# dtypes and shapes.
+_jax_logp_funcs_cache: dict[
+    tuple[str, tuple[bool, ...], bool, Precision | None, int | None],
+    tuple[LogLikeFunc, LogLikeGrad, LogLikeFunc],
+] = {}
+# The jitted functions that compute the log-likelihoods and their partial derivatives,
+# keyed by the hash of the model, `precision` and `chunk_size`.
+_jax_logp_and_partials_cache: dict[
+    tuple[str, Precision | None, int | None], tuple[LogLikeFunc, LogLikeFunc]
+] = {}
+
+
+class _DeviceArrays:
+    """Keeps copies of the constant inputs of an Op on the JAX device.
+
+    The observed data and the extra fields are constants of the model, so the same
+    numpy arrays are passed to `perform` on every call. They are copied to the device
+    on the first call, and the device copies are passed to the jitted functions
+    afterwards, so that only the parameters are transferred on each call.
+    """
+
+    def __init__(self):
+        self._arrays: dict[int, tuple[np.ndarray, jax.Array]] = {}
+
+    def __getstate__(self):
+        """Do not pickle the device copies."""
+        return {"_arrays": {}}
+
+    def __call__(self, node: Apply, inputs: list) -> list:
+        """Replace the constant array inputs of `node` with their device copies."""
+        return [
+            (
+                self._get(value)
+                if isinstance(var, pt.TensorConstant) and np.ndim(value) > 0
+                else value
+            )
+            for var, value in zip(node.inputs, inputs)
+        ]
+
+    def _get(self, value: np.ndarray) -> jax.Array:
+        cached = self._arrays.get(id(value))
+        if cached is None or cached[0] is not value:
+            cached = (value, jax.device_put(value))
+            self._arrays[id(value)] = cached
+        return cached[1]
+
+
+def _load_model(
+    model: str | PathLike | onnx.ModelProto,
+) -> tuple[onnx.ModelProto, str]:
+    """Load an ONNX model, if needed, and compute the hash of its content."""
+    loaded_model = (
+        onnx.load(str(model)) if isinstance(model, (str, PathLike)) else model
+    )
+    return loaded_model, hashlib.sha256(loaded_model.SerializeToString()).hexdigest()
+
+
+def _map_chunks(fn: Callable, input_matrix: jnp.ndarray, chunk_size: int | None):
+    """Apply a row-wise function to blocks of `chunk_size` rows, one after another.
+
+    The rows are padded with zeros to a multiple of `chunk_size`, and the outputs of
+    `fn`, which all have one leading entry per row, are trimmed back. Only the
+    intermediate values of one block are kept in memory at a time.
+    """
+    n_rows = input_matrix.shape[0]
+    if chunk_size is None or n_rows <= chunk_size:
+        return fn(input_matrix)
+
+    # Bound to a local so that the narrowed type is kept inside the lambda below.
+    size: int = chunk_size
+    n_chunks = -(-n_rows // size)
+    padded = jnp.pad(input_matrix, ((0, n_chunks * size - n_rows), (0, 0)))
+    outputs = jax.lax.map(fn, padded.reshape((n_chunks, size, -1)))
+
+    return jax.tree_util.tree_map(
+        lambda output: output.reshape((n_chunks * size, *output.shape[2:]))[:n_rows],
+        outputs,
+    )
+
+
+def _make_network(
+    loaded_model: onnx.ModelProto,
+    precision: Precision | None,
+    chunk_size: int | None = None,
+) -> Callable[[jnp.ndarray], jnp.ndarray]:
+    """Make the JAX forward pass of a LAN from an input matrix to a vector."""
+    if precision is not None:
+        network = make_reduced_precision_network(loaded_model.graph, precision)
+    else:
+
+        def network(input_matrix: jnp.ndarray) -> jnp.ndarray:
+            return interpret_onnx(loaded_model.graph, input_matrix)[0].reshape(
+                (input_matrix.shape[0],)
+            )
+
+    if chunk_size is None:
+        return network
+
+    # The activations of each block are recomputed in the backward pass instead of
+    # being stored for all blocks.
+    network_remat = jax.checkpoint(network)
+    return lambda input_matrix: _map_chunks(network_remat, input_matrix, chunk_size)
+
 
 def make_jax_logp_funcs_from_onnx(
     model: str | PathLike | onnx.ModelProto,
     params_is_reg: list[bool],
     params_only: bool = False,
+    precision: Precision | None = None,
+    chunk_size: int | None = None,
 ) -> tuple[LogLikeFunc, LogLikeGrad, LogLikeFunc]:
     """Make a jax function and its Vector-Jacobian Product from an ONNX Model.
 
@@ -38,10 +154,24 @@ def make_jax_logp_funcs_from_onnx(
         already loaded.
     params_is_reg:
         A list of booleans indicating whether the parameters are regressions.
-        Parameters that are regressions will not be vectorized in likelihood
-        calculations.
+        Parameters that are not regressions are broadcast to all trials before
+        they are passed to the network.
     params_only:
         If True, the log-likelihood function will only take parameters as input.
+    precision:
+        The precision of the matrix multiplications of the network. One of
+        `"bfloat16"`, `"float16"`, or `"int8"`, with the products accumulated in
+        float32. Only supported for dense multilayer perceptrons. Defaults to None, in
+        which case the network is evaluated in the precision of the inputs. See
+        `hssm.distribution_utils.onnx.precision.check_precision` to check the accuracy
+        of the reduced precision.
+    chunk_size:
+        If provided, the trials are passed through the network in blocks of
+        `chunk_size` trials, one after another, and the activations of each block
+        are recomputed when the VJP is computed. This bounds the memory used by the
+        activations regardless of the number of trials, at the cost of a second
+        forward pass for the VJP. The results are the same. Defaults to None, in
+        which case all trials are passed through the network at once.
 
     Returns
     -------
@@ -50,13 +180,65 @@ def make_jax_logp_funcs_from_onnx(
         forward pass, the second calculates the VJP, and the third is
         the forward-pass that's not jitted. When `params_only` is True, and all
         parameters are scalars, only a scalar function, its gradient, and the non-jitted
-        version of the function are returned.
+        version of the function are returned. The functions are cached, so the same
+        functions are returned for the same model and arguments. See
+        `hssm.set_compilation_cache` to also cache the compiled functions on disk and
+        reuse them across processes.
     """
-    loaded_model = (
-        onnx.load(str(model)) if isinstance(model, (str, PathLike)) else model
+    loaded_model, model_hash = _load_model(model)
+
+    key = (
+        model_hash,
+        tuple(bool(is_reg) for is_reg in params_is_reg),
+        params_only,
+        precision,
+        chunk_size,
     )
+    if key not in _jax_logp_funcs_cache:
+        _jax_logp_funcs_cache[key] = _make_jax_logp_funcs(
+            loaded_model, params_is_reg, params_only, precision, chunk_size, key
+        )
+
+    return _jax_logp_funcs_cache[key]
+
+
+def _make_input_matrix(inputs, params_only: bool) -> jnp.ndarray:
+    """Assemble the parameters and the data into the input matrix of a LAN.
+
+    Scalar parameters are broadcast to all rows. The parameters come first, followed
+    by the columns of the data, if any.
+    """
+    if params_only:
+        data = None
+        dist_params = inputs
+        n_rows = max(jnp.shape(param)[0] for param in inputs if jnp.ndim(param))
+    else:
+        data = inputs[0]
+        dist_params = inputs[1:]
+        n_rows = data.shape[0]
+
+    columns = [jnp.broadcast_to(param, (n_rows,)) for param in dist_params]
+    if data is not None:
+        columns += list(jnp.asarray(data).T)
+    # NOTE: The columns are stacked as rows and transposed. With `jnp.column_stack`,
+    # XLA on CPU returns NaNs from the last layer for 65536 or more rows.
+    return jnp.stack(columns).T
+
+
+def _make_jax_logp_funcs(
+    loaded_model: onnx.ModelProto,
+    params_is_reg: list[bool],
+    params_only: bool,
+    precision: Precision | None,
+    chunk_size: int | None,
+    key: tuple,
+) -> tuple[LogLikeFunc, LogLikeGrad, LogLikeFunc]:
+    """Make the jax functions for `make_jax_logp_funcs_from_onnx`.
 
+    The jitted functions cache their executables on disk under `key`, if enabled.
+    """
     scalars_only = all(not is_reg for is_reg in params_is_reg)
+    network = _make_network(loaded_model, precision, chunk_size)
 
     def logp(*inputs) -> jnp.ndarray:
         """Compute the log-likelihood.
@@ -83,23 +265,37 @@ def make_jax_logp_funcs_from_onnx(
             dist_params = inputs[1:]
             input_vector = jnp.concatenate((jnp.array(dist_params), data))
 
-        return interpret_onnx(loaded_model.graph, input_vector)[0].squeeze()
+        return network(input_vector[None, :])[0]
 
     if params_only and scalars_only:
         logp_vec = lambda *inputs: logp(*inputs).reshape((1,))
-        return jit(logp_vec), jit(grad(logp)), logp_vec
+        return (
+            CachedJit(logp_vec, key + ("logp",)),
+            CachedJit(grad(logp), key + ("grad",)),
+            logp_vec,
+        )
 
-    in_axes: list = [0 if is_regression else None for is_regression in params_is_reg]
-    if not params_only:
-        in_axes = [0] + in_axes
+    def batched_logp(*inputs) -> jnp.ndarray:
+        """Compute the log-likelihoods of all trials in one pass through the network.
 
-    # The vectorization of the logp function
-    vmap_logp = vmap(
-        logp,
-        in_axes=in_axes,
-    )
+        The parameters and data are assembled into a single `(n_trials, n_inputs)`
+        matrix, with scalar parameters broadcast to all trials, so that each layer of
+        the network is applied as one matrix multiplication.
 
-    def vjp_vmap_logp(
+        Parameters
+        ----------
+        inputs
+            A list of data and parameters used in the likelihood computation. Also
+            supports the case where only parameters are passed.
+
+        Returns
+        -------
+        jnp.ndarray
+            The element-wise log-likelihoods.
+        """
+        return network(_make_input_matrix(inputs, params_only))
+
+    def vjp_batched_logp(
         *inputs: list[float | ArrayLike], gz: ArrayLike
     ) -> list[ArrayLike]:
         """Compute the VJP of the log-likelihood function.
@@ -110,18 +306,22 @@ def make_jax_logp_funcs_from_onnx(
             A list of data and parameters used in the likelihood computation. Also
             supports the case where only parameters are passed.
         gz
-            The value of vmap_logp at which the VJP is evaluated, typically is just
-            vmap_logp(data, *dist_params)
+            The value of batched_logp at which the VJP is evaluated, typically is just
+            batched_logp(data, *dist_params)
 
         Returns
         -------
         list[ArrayLike]
             The VJP of the log-likelihood function computed at gz.
         """
-        _, vjp_fn = vjp(vmap_logp, *inputs)
+        _, vjp_fn = vjp(batched_logp, *inputs)
         return vjp_fn(gz) if params_only else vjp_fn(gz)[1:]
 
-    return jit(vmap_logp), jit(vjp_vmap_logp), vmap_logp
+    return (
+        CachedJit(batched_logp, key + ("logp",)),
+        CachedJit(vjp_batched_logp, key + ("vjp",)),
+        batched_logp,
+    )
 
 
 def make_jax_logp_ops(
@@ -151,6 +351,9 @@ def make_jax_logp_ops(
     class LANLogpOp(Op):  # pylint: disable=W0223
         """Wraps a JAX function in an pytensor Op."""
 
+        def __init__(self):
+            self._device_arrays = _DeviceArrays()
+
         def make_node(self, data, *dist_params):
             """Take the inputs to the Op and puts them in a list.
 
@@ -192,7 +395,7 @@ def make_jax_logp_ops(
                 output_storage. There is one storage cell for each output of
                 the Op.
             """
-            result = logp(*inputs)
+            result = logp(*self._device_arrays(node, inputs))
             output_storage[0][0] = np.asarray(result, dtype=node.outputs[0].dtype)
 
         def grad(self, inputs, output_gradients):
@@ -233,6 +436,9 @@ def make_jax_logp_ops(
     class LANLogpVJPOp(Op):  # pylint: disable=W0223
         """Wraps the VJP operation of a jax function in an pytensor op."""
 
+        def __init__(self):
+            self._device_arrays = _DeviceArrays()
+
         def make_node(self, data, *dist_params, gz):
             """Take the inputs to the Op and puts them in a list.
 
@@ -278,6 +484,7 @@ def make_jax_logp_ops(
                 output_storage. There is one storage cell for each output of
                 the Op.
             """
+            inputs = self._device_arrays(node, inputs)
             if self.params_only:
                 results = logp_vjp(*inputs[:-1], gz=inputs[-1])
             else:
@@ -304,20 +511,335 @@ def make_jax_logp_ops(
     return lan_logp_op
 
 
+def make_jax_logp_and_partials_from_onnx(
+    model: str | PathLike | onnx.ModelProto,
+    precision: Precision | None = None,
+    chunk_size: int | None = None,
+) -> tuple[LogLikeFunc, LogLikeFunc]:
+    """Make a jax function that computes log-likelihoods and their partial derivatives.
+
+    Each row of the input matrix of a LAN only affects the log-likelihood of the same
+    trial, so the VJP of the network with a vector of ones gives the derivatives of
+    each log-likelihood with respect to the parameters of its trial. The forward pass
+    is computed only once for both.
+
+    Parameters
+    ----------
+    model:
+        A path or url to the ONNX model, or an ONNX Model object that's
+        already loaded.
+    precision:
+        The precision of the matrix multiplications of the network. See
+        `make_jax_logp_funcs_from_onnx`. Defaults to None.
+    chunk_size:
+        If provided, the log-likelihoods and their derivatives are computed for blocks
+        of `chunk_size` trials, one after another, to bound the memory used by the
+        activations. Defaults to None.
+
+    Returns
+    -------
+    tuple[LogLikeFunc, LogLikeFunc]
+        The jitted and non-jitted versions of a function with signature
+        f(data, *dist_params) that returns the element-wise log-likelihoods, followed
+        by their derivatives with respect to each parameter.
+    """
+    loaded_model, model_hash = _load_model(model)
+
+    key = (model_hash, precision, chunk_size)
+    if key in _jax_logp_and_partials_cache:
+        return _jax_logp_and_partials_cache[key]
+
+    network = _make_network(loaded_model, precision)
+
+    def network_and_partials(input_matrix):
+        result, vjp_fn = vjp(network, input_matrix)
+        (partials,) = vjp_fn(jnp.ones_like(result))
+        return result, partials
+
+    def logp_and_partials(data, *dist_params) -> tuple[jnp.ndarray, ...]:
+        input_matrix = _make_input_matrix((data, *dist_params), params_only=False)
+        result, partials = _map_chunks(network_and_partials, input_matrix, chunk_size)
+
+        return (result, *[partials[:, i] for i in range(len(dist_params))])
+
+    _jax_logp_and_partials_cache[key] = (
+        CachedJit(logp_and_partials, key + ("logp_and_partials",)),
+        logp_and_partials,
+    )
+
+    return _jax_logp_and_partials_cache[key]
+
+
+class LANLogpAndPartialsOp(Op):
+    """Computes the LAN log-likelihoods together with their partial derivatives.
+
+    The first output of this Op is the element-wise log-likelihoods. The rest are the
+    element-wise derivatives with respect to each parameter, which are used to compute
+    the gradient of the first output. Because the value and the derivatives are
+    produced by the same Apply node in one call to XLA, the network is only evaluated
+    once when both the log-likelihood and its gradient are requested. When the
+    derivatives are not used, the Op is replaced by the value-only Op during graph
+    rewriting.
+
+    Parameters
+    ----------
+    logp_and_partials
+        The jitted function returned by `make_jax_logp_and_partials_from_onnx`.
+    logp_and_partials_nojit
+        The non-jitted version of `logp_and_partials`, used with the JAX backend.
+    value_op
+        The Op returned by `make_jax_logp_ops` for the same model, which only computes
+        the log-likelihoods.
+    """
+
+    def __init__(
+        self,
+        logp_and_partials: LogLikeFunc,
+        logp_and_partials_nojit: LogLikeFunc,
+        value_op: Op,
+    ):
+        self.logp_and_partials = logp_and_partials
+        self.logp_and_partials_nojit = logp_and_partials_nojit
+        self.value_op = value_op
+        self._device_arrays = _DeviceArrays()
+
+    def make_node(self, data, *dist_params):
+        """Take the inputs to the Op and puts them in a list.
+
+        Also specifies the output types in a list, then feed them to the Apply node.
+
+        Parameters
+        ----------
+        data
+            A two-column numpy array with response time and response.
+        dist_params
+            A list of parameters used in the likelihood computation. The parameters
+            can be a mix of scalars and arrays.
+        """
+        inputs = [pt.as_tensor_variable(data)] + [
+            pt.as_tensor_variable(dist_param) for dist_param in dist_params
+        ]
+        outputs = [pt.vector() for _ in inputs]
+
+        return Apply(self, inputs, outputs)
+
+    def perform(self, node, inputs, output_storage):
+        """Perform the Apply node.
+
+        Parameters
+        ----------
+        inputs
+            This is a list of data from which the values stored in
+            output_storage are to be computed using non-symbolic language.
+        output_storage
+            This is a list of storage cells where the output
+            is to be stored. A storage cell is a one-element list. It is
+            forbidden to change the length of the list(s) contained in
+            output_storage. There is one storage cell for each output of
+            the Op.
+        """
+        results = self.logp_and_partials(*self._device_arrays(node, inputs))
+
+        for i, result in enumerate(results):
+            output_storage[i][0] = np.asarray(result, dtype=node.outputs[i].dtype)
+
+    def grad(self, inputs, output_gradients):
+        """Perform the pytensor.grad() operation.
+
+        Parameters
+        ----------
+        inputs
+            The same as the inputs produced in `make_node`.
+        output_gradients
+            Holds the results of the perform `perform` method.
+        """
+        if any(not isinstance(g.type, DisconnectedType) for g in output_gradients[1:]):
+            return [grad_not_implemented(self, i, x) for i, x in enumerate(inputs)]
+
+        gz = output_gradients[0]
+        derivatives = self(*inputs)[1:]
+
+        grads = [grad_not_implemented(self, 0, inputs[0])]
+        for param, derivative in zip(inputs[1:], derivatives):
+            g = gz * derivative
+            if param.ndim == 0:
+                g = pt.sum(g)
+            elif param.type.broadcastable[0]:
+                g = pt.sum(g, keepdims=True)
+            grads.append(g.astype(param.dtype))
+
+        return grads
+
+
+@jax_funcify.register(LANLogpAndPartialsOp)
+def lan_logp_and_partials_dispatch(op, **kwargs):  # pylint: disable=W0613
+    """Unwrap the JAX function for sampling with JAX backend."""
+    return op.logp_and_partials_nojit
+
+
+@register_specialize
+@node_rewriter([LANLogpAndPartialsOp])
+def local_lan_logp_value_only(fgraph, node):
+    """Replace the fused Op with the value-only Op if the derivatives are unused."""
+    if any(fgraph.clients.get(output) for output in node.outputs[1:]):
+        return None
+    return {node.outputs[0]: node.op.value_op(*node.inputs)}
+
+
+def make_jax_fused_logp(
+    logp_and_partials: LogLikeFunc,
+    logp_and_partials_nojit: LogLikeFunc,
+    value_op: Op,
+) -> Callable[..., pt.TensorVariable]:
+    """Make a LAN log-likelihood whose value and gradient are computed together.
+
+    Parameters
+    ----------
+    logp_and_partials
+        The jitted function returned by `make_jax_logp_and_partials_from_onnx`.
+    logp_and_partials_nojit
+        The non-jitted version of `logp_and_partials`.
+    value_op
+        The Op returned by `make_jax_logp_ops` for the same model.
+
+    Returns
+    -------
+    Callable
+        A function with signature logp(data, *dist_params) that returns the
+        element-wise log-likelihoods computed by a `LANLogpAndPartialsOp`.
+    """
+    fused_op = LANLogpAndPartialsOp(
+        logp_and_partials, logp_and_partials_nojit, value_op
+    )
+
+    def logp(data, *dist_params) -> pt.TensorVariable:
+        value, *_ = cast(list[pt.TensorVariable], fused_op(data, *dist_params))
+        return value
+
+    return logp
+
+
+def make_onnxruntime_logp(
+    model: str | PathLike | onnx.ModelProto,
+    params_only: bool = False,
+    intra_op_num_threads: int | None = None,
+) -> Callable[..., np.ndarray]:
+    """Make a numpy log-likelihood function that runs an ONNX model in onnxruntime.
+
+    The forward pass is run in an onnxruntime session with all graph optimizations
+    enabled. The input matrix is bound to the session without copying. The function
+    has no gradient and is meant to be wrapped with `make_blackbox_op` for samplers
+    that do not need gradients, for computing element-wise log-likelihoods, or for
+    scoring new data.
+
+    Parameters
+    ----------
+    model
+        A path or url to the ONNX model, or an ONNX Model object that's
+        already loaded.
+    params_only : optional
+        If True, the log-likelihood function will only take parameters as input.
+        Defaults to False.
+    intra_op_num_threads : optional
+        The number of threads used by onnxruntime to run each op. Defaults to None, in
+        which case onnxruntime uses all physical cores.
+
+    Returns
+    -------
+    Callable
+        A function with signature logp(data, *dist_params), or logp(*dist_params) if
+        `params_only` is True, that returns the element-wise log-likelihoods as a
+        numpy array.
+    """
+    try:
+        import onnxruntime  # pylint: disable=C0415
+    except ImportError as e:
+        e.msg = (
+            "The `onnxruntime` backend requires the python library onnxruntime. "
+            + "You can install it by running\n\n"
+            + "\tpip install onnxruntime"
+        )
+        raise e
+
+    loaded_model = onnx.ModelProto()
+    loaded_model.CopyFrom(
+        onnx.load(str(model)) if isinstance(model, (str, PathLike)) else model
+    )
+    # The networks are often exported with a batch size of 1, so the first dimension
+    # of the inputs and outputs is made dynamic.
+    for value_info, min_rank in [
+        *((value_info, 2) for value_info in loaded_model.graph.input),
+        *((value_info, 1) for value_info in loaded_model.graph.output),
+    ]:
+        shape = value_info.type.tensor_type.shape
+        if len(shape.dim) < min_rank:
+            raise ValueError(
+                f"The ONNX model has a {len(shape.dim)}-dimensional tensor "
+                + f"`{value_info.name}`, but the onnxruntime backend expects inputs of "
+                + "shape (n_rows, n_inputs) and outputs with a first dimension of "
+                + "size n_rows."
+            )
+        shape.dim[0].dim_param = "n_rows"
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if intra_op_num_threads is not None:
+        options.intra_op_num_threads = intra_op_num_threads
+    session = onnxruntime.InferenceSession(
+        loaded_model.SerializeToString(),
+        options,
+        providers=["CPUExecutionProvider"],
+    )
+    input_name = session.get_inputs()[0].name
+    output_name = session.get_outputs()[0].name
+    input_dtype = onnx.helper.tensor_dtype_to_np_dtype(
+        loaded_model.graph.input[0].type.tensor_type.elem_type
+    )
+
+    def logp(*inputs) -> np.ndarray:
+        # Without data, the number of rows is given by the trial-wise parameters.
+        data: np.ndarray | None = None if params_only else inputs[0]
+        dist_params = inputs if data is None else inputs[1:]
+        if data is None:
+            n_rows = max(
+                [1] + [np.shape(param)[0] for param in inputs if np.ndim(param)]
+            )
+            n_data_columns = 0
+        else:
+            n_rows, n_data_columns = data.shape
+
+        input_matrix = np.empty(
+            (n_rows, len(dist_params) + n_data_columns), dtype=input_dtype
+        )
+        for i, param in enumerate(dist_params):
+            input_matrix[:, i] = param
+        if data is not None:
+            input_matrix[:, len(dist_params) :] = data
+
+        binding = session.io_binding()
+        binding.bind_cpu_input(input_name, input_matrix)
+        binding.bind_output(output_name)
+        session.run_with_iobinding(binding)
+
+        return binding.copy_outputs_to_cpu()[0].reshape(-1)
+
+    return logp
+
+
 def make_pytensor_logp(
     model: str | PathLike | onnx.ModelProto,
 ) -> Callable[..., ArrayLike]:
     """Convert onnx model file to pytensor.
 
+    If the model is a dense MLP, it is evaluated with `MLPLogpOp`, which computes the
+    log-likelihoods and their gradient with one matrix multiplication per layer.
+    Otherwise, the ONNX graph is converted to generic pytensor ops.
+
     Parameters
     ----------
     model
         A path or url to the ONNX model, or an ONNX Model object that's
         already loaded.
-    params_is_reg:
-        A list of booleans indicating whether the parameters are regressions.
-        Parameters that are regressions will not be vectorized in likelihood
-        calculations.
 
     Returns
     -------
@@ -328,31 +850,40 @@ def make_pytensor_logp(
     loaded_model: onnx.ModelProto = (
         onnx.load(str(model)) if isinstance(model, (str, PathLike)) else model
     )
+    # Dense MLPs are evaluated with a fused Op that has a hand-coded backward pass.
+    mlp_layers = extract_mlp_layers(loaded_model.graph)
 
     def logp(data: np.ndarray | None, *dist_params) -> ArrayLike:
         # Specify input layer of MLP
+        dist_params_tensors = [
+            pt.as_tensor_variable(param).astype(pytensor.config.floatX)
+            for param in dist_params
+        ]
+        data_tensor = None
         if data is not None:
-            data_dim = data.shape[1]
-            inputs = pt.empty((data.shape[0], (len(dist_params) + data_dim)))
-            inputs = pt.set_subtensor(inputs[:, -data_dim:], data)
+            data_tensor = pt.as_tensor_variable(data).astype(pytensor.config.floatX)
+            n_rows = data_tensor.shape[0]
         else:
-            dist_params_tensors = [
-                pt.as_tensor_variable(param) for param in dist_params
-            ]
             n_rows = pt.max(
                 [
                     1 if param.ndim == 0 else param.shape[0]
                     for param in dist_params_tensors
                 ]
             )
-            inputs = pt.empty((n_rows, len(dist_params)))
-        for i, dist_param in enumerate(dist_params):
-            inputs = pt.set_subtensor(
-                inputs[:, i],
-                dist_param,
-            )
+        shape = pt.as_tensor([n_rows])
+        columns = [pt.broadcast_to(param, shape) for param in dist_params_tensors]
+        inputs = pt.stack(columns, axis=1)
+        if data_tensor is not None:
+            inputs = pt.concatenate([inputs, data_tensor], axis=1)
 
         # Returns elementwise log-likelihoods
-        return pt.squeeze(pt_interpret_onnx(loaded_model.graph, inputs)[0])
+        if mlp_layers is not None:
+            mlp_output, *_ = cast(
+                list[pt.TensorVariable], MLPLogpOp(mlp_layers)(inputs)
+            )
+            output = pt.shape_padright(mlp_output)
+        else:
+            output = pt_interpret_onnx(loaded_model.graph, inputs)[0]
+        return pt.squeeze(output)
 
     return logp
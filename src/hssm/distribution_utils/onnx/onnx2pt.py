@@ -9,7 +9,7 @@ any optional inputs, also add these inputs as parameters with default values.
 
 import pytensor.tensor as pt
 
-from .onnx2xla import _asarray, attribute_handlers
+from .optimize import optimize_graph
 
 
 def onnx_add(a, b, axis=None, broadcast=True):
@@ -41,12 +41,17 @@ pt_onnx_ops = {
     "Neg": lambda x: [-x],
     "Exp": lambda x: [pt.exp(x)],
     "Log": lambda x: [pt.log(x)],
+    "Identity": lambda x: [x],
+    "Softplus": lambda x: [pt.softplus(x)],
 }
 
 
 def pt_interpret_onnx(graph, *args):
     """Transform model in onnx to pytensor.
 
+    The graph is simplified by `optimize_graph` the first time it is interpreted, and
+    the optimized graph is reused afterwards.
+
     Parameters
     ----------
     graph
@@ -58,14 +63,14 @@ def pt_interpret_onnx(graph, *args):
     -------
         The result of the computation.
     """
+    optimized = optimize_graph(graph)
     vals = dict(
-        {n.name: a for n, a in zip(graph.input, args)},
-        **{n.name: _asarray(n) for n in graph.initializer},
+        {name: a for name, a in zip(optimized.inputs, args)},
+        **optimized.constants_for("pytensor", pt.constant),
     )
-    for node in graph.node:
-        args = (vals[name] for name in node.input)
-        attrs = {a.name: attribute_handlers[a.type](a) for a in node.attribute}
-        outputs = pt_onnx_ops[node.op_type](*args, **attrs)
-        for name, output in zip(node.output, outputs):
+    for node in optimized.nodes:
+        args = (vals[name] for name in node.inputs)
+        outputs = pt_onnx_ops[node.op_type](*args, **node.attrs)
+        for name, output in zip(node.outputs, outputs):
             vals[name] = output
-    return [vals[n.name] for n in graph.output]
+    return [vals[name] for name in optimized.outputs]
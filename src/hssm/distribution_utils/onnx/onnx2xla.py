@@ -35,28 +35,12 @@ the number of inputs specified in the Opset document above. If there are any opt
 inputs, also add these inputs as parameters with default values.
 """
 
+import jax
 import jax.numpy as jnp
-import onnx
 from jax import lax
-from onnx import numpy_helper
+from jax.nn import softplus
 
-
-def _asarray(proto):
-    return numpy_helper.to_array(proto).reshape(tuple(proto.dims))
-
-
-# pylint: disable=E1101
-attr_types = dict(onnx.AttributeProto.AttributeType.items())
-attribute_handlers = {
-    attr_types["FLOAT"]: lambda a: a.f,
-    attr_types["INT"]: lambda a: a.i,
-    attr_types["STRING"]: lambda a: a.s,
-    attr_types["TENSOR"]: lambda a: _asarray(a.t),
-    attr_types["FLOATS"]: lambda a: a.floats,
-    attr_types["INTS"]: lambda a: a.ints,
-    attr_types["STRINGS"]: lambda a: a.strings,
-    attr_types["TENSORS"]: lambda a: [_asarray(x) for x in a.tensors],
-}
+from .optimize import optimize_graph
 
 
 def onnx_maxpool(x, kernel_shape, pads=None, strides=None):
@@ -126,11 +110,22 @@ onnx_ops = {
     "Neg": lambda x: [-x],
     "Exp": lambda x: [jnp.exp(x)],
     "Log": lambda x: [jnp.log(x)],
+    "Identity": lambda x: [x],
+    "Softplus": lambda x: [softplus(x)],
 }
 
 
+def _to_device(value):
+    """Move a constant to the device, also when called while tracing a function."""
+    with jax.ensure_compile_time_eval():
+        return jnp.asarray(value)
+
+
 def interpret_onnx(graph, *args):
-    """Transform model in onnx to pytensor.
+    """Transform model in onnx to JAX.
+
+    The graph is simplified by `optimize_graph` the first time it is interpreted, and
+    the optimized graph is reused afterwards.
 
     Parameters
     ----------
@@ -143,14 +138,14 @@ def interpret_onnx(graph, *args):
     -------
         The result of the computation.
     """
+    optimized = optimize_graph(graph)
     vals = dict(
-        {n.name: a for n, a in zip(graph.input, args)},
-        **{n.name: _asarray(n) for n in graph.initializer},
+        {name: a for name, a in zip(optimized.inputs, args)},
+        **optimized.constants_for("jax", _to_device),
     )
-    for node in graph.node:
-        args = (vals[name] for name in node.input)
-        attrs = {a.name: attribute_handlers[a.type](a) for a in node.attribute}
-        outputs = onnx_ops[node.op_type](*args, **attrs)
-        for name, output in zip(node.output, outputs):
+    for node in optimized.nodes:
+        args = (vals[name] for name in node.inputs)
+        outputs = onnx_ops[node.op_type](*args, **node.attrs)
+        for name, output in zip(node.outputs, outputs):
             vals[name] = output
-    return [vals[n.name] for n in graph.output]
+    return [vals[name] for name in optimized.outputs]
@@ -0,0 +1,409 @@
+"""A preprocessing pass that simplifies ONNX graphs before they are interpreted.
+
+Both `interpret_onnx` and `pt_interpret_onnx` walk the nodes of an ONNX graph. The
+graphs exported for LANs contain work that does not depend on the inputs, such as
+reading initializers and transposing weight matrices, and chains of ops that can be
+expressed with fewer, more stable ops. This module performs that work once per graph:
+
+- Initializers and `Constant` nodes are converted to numpy arrays once.
+- Nodes whose inputs are all constants are evaluated ahead of time.
+- `Identity` nodes and no-op `Reshape` nodes are removed.
+- The `alpha`, `beta` and `transB` attributes of `Gemm` nodes are folded into their
+  constant weights and biases.
+- `MatMul` followed by `Add` with a constant bias is fused into `Gemm`.
+- `Log(Add(Exp(x), 1))` is fused into `Softplus(x)`, and `Neg(Neg(x))` is removed.
+- Nodes whose outputs are not used are dropped.
+
+The optimized graph is cached by the content of the original graph, together with the
+constants converted to arrays of the backend that interprets it.
+"""
+
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+import numpy as np
+import onnx
+from onnx import numpy_helper
+
+
+def _asarray(proto):
+    return numpy_helper.to_array(proto).reshape(tuple(proto.dims))
+
+
+# pylint: disable=E1101
+attr_types = dict(onnx.AttributeProto.AttributeType.items())
+attribute_handlers = {
+    attr_types["FLOAT"]: lambda a: a.f,
+    attr_types["INT"]: lambda a: a.i,
+    attr_types["STRING"]: lambda a: a.s,
+    attr_types["TENSOR"]: lambda a: _asarray(a.t),
+    attr_types["FLOATS"]: lambda a: a.floats,
+    attr_types["INTS"]: lambda a: a.ints,
+    attr_types["STRINGS"]: lambda a: a.strings,
+    attr_types["TENSORS"]: lambda a: [_asarray(x) for x in a.tensors],
+}
+
+
+def _numpy_gemm(
+    a, b, c=0.0, alpha=1.0, beta=1.0, transA=0, transB=0
+):  # pylint: disable=C0103
+    """Numpy implementation of the ONNX Gemm op."""
+    a = np.transpose(a) if transA else a
+    b = np.transpose(b) if transB else b
+
+    return [alpha * np.matmul(a, b) + beta * c]
+
+
+# Numpy implementations used to evaluate nodes whose inputs are all constants
+_numpy_ops: dict[str, Callable[..., list[np.ndarray]]] = {
+    "Add": lambda a, b: [np.add(a, b)],
+    "MatMul": lambda x, y: [np.matmul(x, y)],
+    "Gemm": _numpy_gemm,
+    "Relu": lambda x: [np.maximum(x, 0)],
+    "Reshape": lambda x, shape: [np.reshape(x, shape)],
+    "Tanh": lambda x: [np.tanh(x)],
+    "Neg": lambda x: [-x],
+    "Exp": lambda x: [np.exp(x)],
+    "Log": lambda x: [np.log(x)],
+    "Softplus": lambda x: [np.logaddexp(x, 0)],
+}
+
+
+@dataclass
+class OptimizedNode:
+    """A node of an optimized graph with its attributes already parsed."""
+
+    op_type: str
+    inputs: list[str]
+    outputs: list[str]
+    attrs: dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class OptimizedGraph:
+    """An ONNX graph after constant folding and fusion of its nodes."""
+
+    inputs: list[str]
+    outputs: list[str]
+    constants: dict[str, np.ndarray]
+    nodes: list[OptimizedNode]
+    # Constants converted to arrays of a backend, keyed by the name of the backend
+    backend_constants: dict[str, dict[str, Any]] = field(default_factory=dict)
+
+    def constants_for(self, backend: str, convert) -> dict[str, Any]:
+        """Return the constants converted with `convert`, converting them only once.
+
+        Parameters
+        ----------
+        backend
+            The name of the backend, used as the key of the cache.
+        convert
+            A function that converts a numpy array to an array of the backend.
+
+        Returns
+        -------
+        dict[str, Any]
+            The converted constants keyed by their names.
+        """
+        if backend not in self.backend_constants:
+            self.backend_constants[backend] = {
+                name: convert(value) for name, value in self.constants.items()
+            }
+        return self.backend_constants[backend]
+
+
+# Optimized graphs keyed by the digest of the serialized original graph, so that a
+# graph is never served the result of another graph and the original graphs are not
+# kept alive. The least recently used graphs are evicted.
+_MAX_OPTIMIZED_GRAPHS = 16
+_optimized_graphs: OrderedDict[bytes, OptimizedGraph] = OrderedDict()
+
+
+def optimize_graph(graph: onnx.GraphProto) -> OptimizedGraph:
+    """Optimize an ONNX graph, or return the cached result for the same graph.
+
+    Parameters
+    ----------
+    graph
+        The computation graph.
+
+    Returns
+    -------
+    OptimizedGraph
+        The optimized graph.
+    """
+    key = hashlib.sha256(graph.SerializeToString(deterministic=True)).digest()
+    optimized = _optimized_graphs.get(key)
+    if optimized is not None:
+        _optimized_graphs.move_to_end(key)
+        return optimized
+
+    optimized = _optimize_graph(graph)
+    _optimized_graphs[key] = optimized
+    if len(_optimized_graphs) > _MAX_OPTIMIZED_GRAPHS:
+        _optimized_graphs.popitem(last=False)
+
+    return optimized
+
+
+def _optimize_graph(graph: onnx.GraphProto) -> OptimizedGraph:
+    """Run all passes on an ONNX graph."""
+    constants = {n.name: _asarray(n) for n in graph.initializer}
+    # Maps the outputs of removed nodes to the names that hold the same values
+    aliases: dict[str, str] = {}
+    nodes: list[OptimizedNode] = []
+
+    def resolve(name: str) -> str:
+        while name in aliases:
+            name = aliases[name]
+        return name
+
+    for node in graph.node:
+        inputs = [resolve(name) for name in node.input]
+        attrs = {a.name: attribute_handlers[a.type](a) for a in node.attribute}
+        outputs = list(node.output)
+
+        if node.op_type == "Constant":
+            constants[outputs[0]] = attrs["value"]
+        elif node.op_type == "Identity":
+            aliases[outputs[0]] = inputs[0]
+        elif node.op_type in _numpy_ops and all(name in constants for name in inputs):
+            results = _numpy_ops[node.op_type](
+                *(constants[name] for name in inputs), **attrs
+            )
+            constants.update(zip(outputs, results))
+        elif node.op_type == "Gemm" and inputs[1] in constants:
+            nodes.append(_fold_gemm_constants(inputs, outputs, attrs, constants))
+        else:
+            nodes.append(OptimizedNode(node.op_type, inputs, outputs, attrs))
+
+    graph_outputs = [resolve(n.name) for n in graph.output]
+    nodes = _fuse_matmul_add(nodes, constants, graph_outputs)
+    nodes = _remove_noop_reshape(nodes, constants, graph_outputs)
+    nodes = _fuse_softplus(nodes, constants, graph_outputs)
+    nodes = _remove_double_neg(nodes, graph_outputs)
+    nodes = _remove_unused(nodes, graph_outputs)
+
+    used = {name for node in nodes for name in node.inputs} | set(graph_outputs)
+    return OptimizedGraph(
+        inputs=[n.name for n in graph.input],
+        outputs=graph_outputs,
+        constants={name: value for name, value in constants.items() if name in used},
+        nodes=nodes,
+    )
+
+
+def _fold_gemm_constants(
+    inputs: list[str],
+    outputs: list[str],
+    attrs: dict[str, Any],
+    constants: dict[str, np.ndarray],
+) -> OptimizedNode:
+    """Apply `alpha`, `beta` and `transB` of a Gemm node to its constant inputs."""
+    weight = constants[inputs[1]]
+    if attrs.get("transB", 0):
+        weight = np.transpose(weight)
+    alpha = attrs.get("alpha", 1.0)
+    if alpha != 1.0:
+        weight = (alpha * weight).astype(weight.dtype)
+    weight_name = f"{outputs[0]}::weight"
+    constants[weight_name] = np.ascontiguousarray(weight)
+    new_inputs = [inputs[0], weight_name]
+
+    if len(inputs) > 2 and inputs[2]:
+        bias_name = inputs[2]
+        beta = attrs.get("beta", 1.0)
+        if beta != 1.0 and bias_name in constants:
+            bias = constants[bias_name]
+            bias_name = f"{outputs[0]}::bias"
+            constants[bias_name] = (beta * bias).astype(bias.dtype)
+            beta = 1.0
+        new_inputs.append(bias_name)
+        new_attrs = {} if beta == 1.0 else {"beta": beta}
+    else:
+        new_attrs = {}
+
+    if attrs.get("transA", 0):
+        new_attrs["transA"] = attrs["transA"]
+
+    return OptimizedNode("Gemm", new_inputs, outputs, new_attrs)
+
+
+def _remove_noop_reshape(
+    nodes: list[OptimizedNode],
+    constants: dict[str, np.ndarray],
+    graph_outputs: list[str],
+) -> list[OptimizedNode]:
+    """Remove Reshape nodes that keep a matrix produced by a Gemm or MatMul as it is.
+
+    The number of rows is not known before the graph is interpreted, so only the
+    number of columns of the matrix, which is the number of columns of the constant
+    weights, is compared with a target shape of the form `[-1, k]` or `[0, k]`.
+    """
+    producers = {name: node for node in nodes for name in node.outputs}
+    aliases: dict[str, str] = {}
+    removed: set[int] = set()
+
+    for node in nodes:
+        if (
+            node.op_type != "Reshape"
+            or node.outputs[0] in graph_outputs
+            or node.inputs[1] not in constants
+        ):
+            continue
+        shape = np.asarray(constants[node.inputs[1]]).tolist()
+        producer = producers.get(node.inputs[0])
+        if (
+            len(shape) != 2
+            or shape[0] not in (-1, 0)
+            or producer is None
+            or producer.op_type not in ("Gemm", "MatMul")
+            or producer.attrs.get("transA", 0)
+            or producer.inputs[1] not in constants
+        ):
+            continue
+        weight = constants[producer.inputs[1]]
+        if weight.ndim == 2 and weight.shape[1] == shape[1]:
+            aliases[node.outputs[0]] = node.inputs[0]
+            removed.add(id(node))
+
+    return _apply_aliases(nodes, aliases, removed)
+
+
+def _count_uses(nodes: list[OptimizedNode], graph_outputs: list[str]) -> dict:
+    """Count how many times each value is used by the nodes or as a graph output."""
+    uses: dict[str, int] = {name: 1 for name in graph_outputs}
+    for node in nodes:
+        for name in node.inputs:
+            uses[name] = uses.get(name, 0) + 1
+    return uses
+
+
+def _fuse_matmul_add(
+    nodes: list[OptimizedNode],
+    constants: dict[str, np.ndarray],
+    graph_outputs: list[str],
+) -> list[OptimizedNode]:
+    """Fuse a MatMul with constant weights followed by an Add of a constant bias."""
+    uses = _count_uses(nodes, graph_outputs)
+    producers = {name: node for node in nodes for name in node.outputs}
+    fused: set[int] = set()
+    result = []
+
+    for node in nodes:
+        if node.op_type == "Add":
+            matmul_idx = next(
+                (i for i, name in enumerate(node.inputs) if name in producers), None
+            )
+            if matmul_idx is not None:
+                matmul = producers[node.inputs[matmul_idx]]
+                bias = node.inputs[1 - matmul_idx]
+                if (
+                    matmul.op_type == "MatMul"
+                    and uses[matmul.outputs[0]] == 1
+                    and matmul.inputs[1] in constants
+                    and constants[matmul.inputs[1]].ndim == 2
+                    and bias in constants
+                    and constants[bias].ndim <= 1
+                ):
+                    fused.add(id(matmul))
+                    result.append(
+                        OptimizedNode("Gemm", matmul.inputs + [bias], node.outputs)
+                    )
+                    continue
+        result.append(node)
+
+    return [node for node in result if id(node) not in fused]
+
+
+def _fuse_softplus(
+    nodes: list[OptimizedNode],
+    constants: dict[str, np.ndarray],
+    graph_outputs: list[str],
+) -> list[OptimizedNode]:
+    """Fuse `Log(Add(Exp(x), 1))` into the numerically stable `Softplus(x)`."""
+    uses = _count_uses(nodes, graph_outputs)
+    producers = {name: node for node in nodes for name in node.outputs}
+    removed: set[int] = set()
+    result = []
+
+    for node in nodes:
+        if node.op_type == "Log" and node.inputs[0] in producers:
+            add = producers[node.inputs[0]]
+            if add.op_type == "Add" and uses[add.outputs[0]] == 1:
+                exp_name = next(
+                    (name for name in add.inputs if name in producers), None
+                )
+                one = next((name for name in add.inputs if name in constants), None)
+                if (
+                    exp_name is not None
+                    and one is not None
+                    and np.size(constants[one]) == 1
+                    and np.all(constants[one] == 1)
+                    and producers[exp_name].op_type == "Exp"
+                    and uses[exp_name] == 1
+                ):
+                    exp = producers[exp_name]
+                    removed.update({id(add), id(exp)})
+                    result.append(OptimizedNode("Softplus", exp.inputs, node.outputs))
+                    continue
+        result.append(node)
+
+    return [node for node in result if id(node) not in removed]
+
+
+def _remove_double_neg(
+    nodes: list[OptimizedNode], graph_outputs: list[str]
+) -> list[OptimizedNode]:
+    """Replace `Neg(Neg(x))` with `x`, when the inner Neg is not used elsewhere."""
+    uses = _count_uses(nodes, graph_outputs)
+    producers = {name: node for node in nodes for name in node.outputs}
+    aliases: dict[str, str] = {}
+    removed: set[int] = set()
+
+    for node in nodes:
+        if node.op_type != "Neg" or node.outputs[0] in graph_outputs:
+            continue
+        inner = producers.get(node.inputs[0])
+        if inner is not None and inner.op_type == "Neg" and uses[inner.outputs[0]] == 1:
+            aliases[node.outputs[0]] = inner.inputs[0]
+            removed.update({id(node), id(inner)})
+
+    return _apply_aliases(nodes, aliases, removed)
+
+
+def _apply_aliases(
+    nodes: list[OptimizedNode], aliases: dict[str, str], removed: set[int]
+) -> list[OptimizedNode]:
+    """Drop the removed nodes and rename the inputs that refer to their outputs."""
+
+    def resolve(name: str) -> str:
+        while name in aliases:
+            name = aliases[name]
+        return name
+
+    return [
+        OptimizedNode(
+            node.op_type,
+            [resolve(name) for name in node.inputs],
+            node.outputs,
+            node.attrs,
+        )
+        for node in nodes
+        if id(node) not in removed
+    ]
+
+
+def _remove_unused(
+    nodes: list[OptimizedNode], graph_outputs: list[str]
+) -> list[OptimizedNode]:
+    """Drop the nodes whose outputs are neither used nor outputs of the graph."""
+    needed = set(graph_outputs)
+    result = []
+    for node in reversed(nodes):
+        if any(name in needed for name in node.outputs):
+            needed.update(node.inputs)
+            result.append(node)
+    return result[::-1]
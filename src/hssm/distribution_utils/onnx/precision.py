@@ -0,0 +1,234 @@
+"""Reduced-precision evaluation of LANs that are dense multilayer perceptrons.
+
+The matrix multiplications of a LAN dominate the cost of fitting large data sets.
+This module provides JAX versions of the forward pass of a dense MLP in which the
+matrix multiplications are computed in bfloat16, float16, or with int8-quantized
+weights and activations. The products are always accumulated in float32 (int32 for
+int8), and the activations and the outputs are computed in float32, so that the
+summed log-likelihood is accumulated in float32.
+
+Because the loss of precision depends on the network, `check_precision` compares the
+reduced-precision outputs to the full-precision outputs over a sample of inputs and
+rejects the mode if the error is too large.
+"""
+
+from functools import partial
+from typing import Callable, Literal, get_args
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from .mlp import _JAX_ACTIVATIONS, Layer, extract_mlp_layers
+from .onnx2xla import interpret_onnx
+
+Precision = Literal["bfloat16", "float16", "int8"]
+
+# The default maximum absolute error of the element-wise log-likelihoods. An error of
+# 0.05 in the log-likelihood of a trial is a relative error of about 5% in its
+# likelihood, below the median error of about 0.07 of the ddm LAN with respect to the
+# analytical likelihood, so reduced precision adds less error than the LAN itself.
+DEFAULT_PRECISION_ATOL = 0.05
+
+
+def _quantize(x: jnp.ndarray, axis: int) -> tuple[jnp.ndarray, jnp.ndarray]:
+    """Quantize an array to int8 with one symmetric scale along `axis`."""
+    scale = jnp.max(jnp.abs(x), axis=axis, keepdims=True) / 127.0
+    scale = jnp.where(scale > 0, scale, 1.0)
+    return jnp.round(x / scale).astype(jnp.int8), scale
+
+
+def _make_dense(weight: np.ndarray, precision: Precision) -> Callable:
+    """Make the matrix multiplication of a dense layer in reduced precision."""
+    weight_f32 = jnp.asarray(weight, dtype=jnp.float32)
+
+    if precision != "int8":
+        weight_low = jnp.asarray(weight, dtype=precision)
+
+        def dense(h):
+            return jnp.dot(
+                h.astype(precision), weight_low, preferred_element_type=jnp.float32
+            )
+
+        return dense
+
+    weight_int8, weight_scale = _quantize(weight_f32, axis=0)
+
+    # The rounding of the activations has a zero derivative, so the gradient is
+    # computed with the full-precision weights (straight-through estimator).
+    @jax.custom_vjp
+    def dense_int8(h):
+        h_int8, h_scale = _quantize(h, axis=1)
+        product = jnp.dot(h_int8, weight_int8, preferred_element_type=jnp.int32)
+        return product.astype(jnp.float32) * h_scale * weight_scale
+
+    def dense_int8_fwd(h):
+        return dense_int8(h), None
+
+    def dense_int8_bwd(_, g):
+        return (g @ weight_f32.T,)
+
+    dense_int8.defvjp(dense_int8_fwd, dense_int8_bwd)
+
+    return dense_int8
+
+
+def make_reduced_precision_network(
+    graph, precision: Precision
+) -> Callable[[jnp.ndarray], jnp.ndarray]:
+    """Make a JAX forward pass of a LAN with reduced-precision matrix multiplications.
+
+    Parameters
+    ----------
+    graph
+        The computation graph of the LAN.
+    precision
+        The precision of the matrix multiplications. One of `"bfloat16"`, `"float16"`,
+        or `"int8"`.
+
+    Returns
+    -------
+    Callable
+        A function that takes the `(n_rows, n_inputs)` input matrix and returns the
+        `(n_rows,)` outputs in float32. It can be differentiated with JAX.
+    """
+    if precision not in get_args(Precision):
+        raise ValueError(
+            f"Unsupported precision '{precision}', must be one of "
+            + f"{list(get_args(Precision))}."
+        )
+
+    layers: list[Layer] | None = extract_mlp_layers(graph)
+    if layers is None:
+        raise ValueError(
+            "Reduced precision is only supported for LANs that are dense multilayer "
+            + "perceptrons."
+        )
+
+    dense_indices = [
+        i for i, (op_type, _, _) in enumerate(layers) if op_type == "Dense"
+    ]
+    functions: list[Callable] = []
+    for i, (op_type, weight, bias) in enumerate(layers):
+        if op_type == "Dense":
+            assert weight is not None
+            # The first and the last layers are small, and the inputs of the first
+            # layer are at different scales, so they are kept in full precision.
+            dense: Callable
+            if i in (dense_indices[0], dense_indices[-1]):
+                dense = partial(jnp.dot, b=jnp.asarray(weight, dtype=jnp.float32))
+            else:
+                dense = _make_dense(weight, precision)
+            if bias is not None:
+                bias_f32 = jnp.asarray(bias, dtype=jnp.float32)
+                functions.append(lambda h, dense=dense, b=bias_f32: dense(h) + b)
+            else:
+                functions.append(dense)
+        else:
+            functions.append(_JAX_ACTIVATIONS[op_type])
+
+    def network(input_matrix: jnp.ndarray) -> jnp.ndarray:
+        h = input_matrix.astype(jnp.float32)
+        for function in functions:
+            h = function(h)
+        return h.reshape((input_matrix.shape[0],))
+
+    return network
+
+
+def make_precision_grid(
+    param_bounds: list[tuple[float, float]],
+    data: np.ndarray | None = None,
+    n_samples: int = 2000,
+    seed: int = 0,
+) -> np.ndarray:
+    """Sample LAN inputs for `check_precision`.
+
+    The parameters are drawn with Latin hypercube sampling: the range of each
+    parameter is split into `n_samples` intervals of equal width, and each interval
+    contains the value of exactly one sample. This covers the bounds of every
+    parameter evenly with a number of samples that does not grow with the number of
+    parameters.
+
+    Parameters
+    ----------
+    param_bounds
+        The lower and upper bounds of each parameter. The bounds must be finite.
+    data : optional
+        The `(n_trials, n_columns)` data, including any extra fields before the
+        response columns, that follow the parameters in the input matrix. A random
+        trial is paired with each sample. Defaults to None, in which case the input
+        matrix only contains the parameters.
+    n_samples : optional
+        The number of samples. Defaults to 2000.
+    seed : optional
+        The seed of the random number generator. Defaults to 0.
+
+    Returns
+    -------
+    np.ndarray
+        The `(n_samples, n_columns)` input matrix.
+    """
+    bounds = np.asarray(param_bounds, dtype=float)
+    if not np.all(np.isfinite(bounds)):
+        raise ValueError(
+            "Checking the reduced precision requires finite bounds for all parameters."
+        )
+
+    rng = np.random.default_rng(seed)
+    # A random permutation of the intervals for each parameter, and a uniform
+    # position within each interval
+    intervals = rng.permuted(np.tile(np.arange(n_samples), (len(bounds), 1)), axis=1)
+    unit = (intervals.T + rng.random((n_samples, len(bounds)))) / n_samples
+    samples = bounds[:, 0] + unit * (bounds[:, 1] - bounds[:, 0])
+
+    if data is None:
+        return samples
+
+    trials = np.asarray(data)[rng.integers(0, len(data), size=n_samples)]
+    return np.column_stack([samples, trials])
+
+
+def check_precision(
+    graph,
+    precision: Precision,
+    input_matrix: np.ndarray,
+    atol: float = DEFAULT_PRECISION_ATOL,
+) -> float:
+    """Compare the reduced-precision outputs of a LAN to the full-precision outputs.
+
+    Parameters
+    ----------
+    graph
+        The computation graph of the LAN.
+    precision
+        The precision to check.
+    input_matrix
+        The inputs at which the outputs are compared, typically made with
+        `make_precision_grid`.
+    atol : optional
+        The maximum absolute error allowed. Defaults to `DEFAULT_PRECISION_ATOL`.
+
+    Returns
+    -------
+    float
+        The maximum absolute error of the reduced-precision outputs.
+
+    Raises
+    ------
+    ValueError
+        If the maximum absolute error is larger than `atol`.
+    """
+    input_matrix = np.asarray(input_matrix, dtype=np.float32)
+    reduced = jax.jit(make_reduced_precision_network(graph, precision))(input_matrix)
+    full = interpret_onnx(graph, input_matrix)[0].reshape(-1)
+    error = float(jnp.max(jnp.abs(reduced - full)))
+
+    if not error <= atol:
+        raise ValueError(
+            f"The {precision} LAN outputs differ from the full-precision outputs by up "
+            + f"to {error:.4g}, more than the tolerance of {atol}. Please use a higher "
+            + "precision."
+        )
+
+    return error
@@ -6,11 +6,14 @@ sequential sampling models.
 This file defines the entry class HSSM.
 """
 
+import importlib.util
 import logging
+import os
+from contextlib import ExitStack, contextmanager
 from copy import deepcopy
 from inspect import isclass
 from os import PathLike
-from typing import Any, Callable, Literal
+from typing import Any, Callable, Iterator, Literal, cast
 
 import arviz as az
 import bambi as bmb
@@ -31,6 +34,7 @@ from hssm.defaults import (
     LoglikKind,
     MissingDataNetwork,
     SupportedModels,
+    default_model_config,
     missing_data_networks_suffix,
 )
 from hssm.distribution_utils import (
@@ -40,13 +44,20 @@ from hssm.distribution_utils import (
     make_likelihood_callable,
     make_missing_data_callable,
 )
+from hssm.distribution_utils.dist import _make_simulation_executor
+from hssm.distribution_utils.onnx.precision import make_precision_grid
 from hssm.param import (
     Param,
     _make_default_prior,
 )
 from hssm.utils import (
     HSSMModelGraph,
+    _append_to_netcdf,
+    _compress_data,
+    _generate_random_indices,
     _get_alias_dict,
+    _get_param_groups,
+    _import_h5netcdf,
     _print_prior,
     _process_param_in_kwargs,
     _random_sample,
@@ -88,9 +99,22 @@ class HSSM:
             order.
         - `"backend"`: Only used when `loglik_kind` is `approx_differentiable` and
             an onnx file is supplied for the likelihood approximation network (LAN).
-            Valid values are `"jax"` or `"pytensor"`. It determines whether the LAN in
-            ONNX should be converted to `"jax"` or `"pytensor"`. If not provided,
-            `jax` will be used for maximum performance.
+            Valid values are `"jax"`, `"pytensor"` or `"onnxruntime"`. It determines
+            whether the LAN in ONNX should be converted to `"jax"` or `"pytensor"`, or
+            run by onnxruntime without gradients. If not provided, `jax` will be used
+            for maximum performance.
+        - `"precision"`: Optional. Only used with the `jax` backend. Can be
+            `"bfloat16"`, `"float16"`, or `"int8"` to compute the matrix
+            multiplications of the LAN in reduced precision, with the products
+            accumulated in float32. The outputs are first compared to the full-precision
+            outputs over a sample of parameters within their bounds, and an error is
+            raised if they differ too much. Parameters without finite bounds use the
+            bounds of the default LAN of the model, and an error is raised if there
+            are none.
+        - `"chunk_size"`: Optional. Only used with the `jax` backend. If provided, the
+            LAN is evaluated in blocks of `chunk_size` trials, and the activations of
+            each block are recomputed for the gradient, so that the memory used does
+            not grow with the number of trials. The results are the same.
         - `"default_priors"`: A `dict` indicating the default priors for each parameter.
         - `"bounds"`: A `dict` indicating the boundaries for each parameter. In the case
             of LAN, these bounds are training boundaries.
@@ -131,7 +155,9 @@ class HSSM:
             function. It is differentiable and can be used with samplers that requires
             differentiation.
         - `"blackbox"`: a black box likelihood function. It is typically NOT
-            differentiable.
+            differentiable. An Op created with `make_blackbox_op(...,
+            grad_method="finite_differences")` has an approximate gradient and can
+            be sampled with the PyMC NUTS sampler.
         - `None`, in which a default will be used. For `ddm` type of models, the default
             will be `analytical`. For other models supported, it will be
             `approx_differentiable`. If the model is a custom one, a ValueError
@@ -189,6 +215,16 @@ class HSSM:
         how to specify the likelihood function this parameter. If nothing is provided,
         a default likelihood function will be used. This parameter is required only if
         either `missing_data` or `deadline` is not `False`. Defaults to `None`.
+    compress_data : optional
+        If `True`, rows of the data that are exact duplicates of each other (in all
+        columns) are collapsed into unique rows, and the log-likelihood of each unique
+        row is multiplied by the number of times it occurs. This gives the same
+        posterior with fewer likelihood evaluations when, e.g., response times are
+        recorded at millisecond resolution and the covariates are discrete. The
+        posterior predictive samples, the log-likelihoods, and the observed data in the
+        `InferenceData` are expanded back to the original rows, while the per-trial
+        deterministic variables in the posterior are kept at the unique rows. Cannot be
+        used with a `pm.Distribution` passed as `loglik`. Defaults to `False`.
     **kwargs
         Additional arguments passed to the `bmb.Model` object.
 
@@ -242,9 +278,11 @@ class HSSM:
         loglik_missing_data: (
             str | PathLike | Callable | pytensor.graph.Op | None
         ) = None,
+        compress_data: bool = False,
         **kwargs,
     ):
         self.data = data.copy()
+        self.compress_data = compress_data
         self._inference_obj = None
         self.hierarchical = hierarchical
 
@@ -373,7 +411,7 @@ class HSSM:
 
         self.model = bmb.Model(
             self.formula,
-            data=self.data,
+            data=self._model_data,
             family=self.family,
             priors=self.priors,
             extra_namespace=self.additional_namespace,
@@ -403,8 +441,10 @@ class HSSM:
         ----------
         sampler
             The sampler to use. Can be one of "mcmc", "nuts_numpyro",
-            "nuts_blackjax", "laplace", or "vi". If using `blackbox` likelihoods,
-            this cannot be "nuts_numpyro" or "nuts_blackjax". By default it is None, and
+            "nuts_blackjax", "laplace", or "vi". If using `blackbox` likelihoods or
+            the `onnxruntime` backend, this cannot be "nuts_numpyro" or
+            "nuts_blackjax", and the Slice sampler is used unless the likelihood Op has
+            a gradient. By default it is None, and
             sampler will automatically be chosen: when the model uses the
             `approx_differentiable` likelihood, and `jax` backend, "nuts_numpyro" will
             be used. Otherwise, "mcmc" (the default PyMC NUTS sampler) will be used.
@@ -439,13 +479,17 @@ class HSSM:
                 f"Unsupported sampler '{sampler}', must be one of {supported_samplers}"
             )
 
-        if self.loglik_kind == "blackbox":
+        if self.loglik_kind == "blackbox" or self.model_config.backend == "onnxruntime":
             if sampler in ["nuts_blackjax", "nuts_numpyro"]:
                 raise ValueError(
-                    f"{sampler} sampler does not work with blackbox likelihoods."
+                    f"{sampler} sampler does not work with blackbox likelihoods "
+                    + "or the `onnxruntime` backend."
                 )
 
-            if "step" not in kwargs:
+            # Blackbox Ops created with `grad_method` can be used with PyMC NUTS.
+            if "step" not in kwargs and not getattr(
+                self.model_config.loglik, "has_grad", False
+            ):
                 kwargs |= {"step": pm.Slice(model=self.pymc_model)}
 
         if (
@@ -497,6 +541,9 @@ class HSSM:
             inference_method=sampler, init=init, **kwargs
         )
 
+        if isinstance(self._inference_obj, az.InferenceData):
+            self._expand_compressed_idata(self._inference_obj)
+
         return self.traces
 
     def sample_posterior_predictive(
@@ -507,6 +554,9 @@ class HSSM:
         include_group_specific: bool = True,
         kind: Literal["pps", "mean"] = "pps",
         n_samples: int | float | None = None,
+        n_workers: int | None = None,
+        draws_per_chunk: int | None = None,
+        output_path: str | PathLike | None = None,
     ) -> az.InferenceData | None:
         """Perform posterior predictive sampling from the HSSM model.
 
@@ -543,11 +593,31 @@ class HSSM:
             posterior predictive sampling.. If this proportion is very
             small, at least one sample will be used. When None, all posterior samples
             will be used. Defaults to None.
+        n_workers : optional
+            The number of processes used to simulate from the model. The simulation is
+            split into `n_workers` shards, each with a seed derived from the random
+            generator of the model. Defaults to None, in which case the simulation
+            runs in the current process.
+        draws_per_chunk : optional
+            The number of posterior draws from each chain simulated at a time. When
+            provided, the posterior predictive samples are simulated one chunk of draws
+            at a time and appended to the NetCDF file at `output_path`, so that only
+            one chunk is held in memory. The `posterior_predictive` group is then
+            loaded lazily from the file, in chunks of draws if dask is installed. Only
+            supported when `kind` is `"pps"`.
+            Defaults to None, in which case all draws are simulated at once.
+        output_path : optional
+            The path to the NetCDF file where the posterior predictive samples are
+            written when `draws_per_chunk` is provided. The file must not exist yet, so
+            that datasets already read lazily from it are not changed. Defaults to
+            None.
 
         Raises
         ------
         ValueError
-            If the model has not been sampled yet and idata is not provided.
+            If the model has not been sampled yet and idata is not provided, if only
+            one of `draws_per_chunk` and `output_path` is provided, or if a file
+            already exists at `output_path`.
 
         Returns
         -------
@@ -562,33 +632,145 @@ class HSSM:
                 )
             idata = self._inference_obj
 
+        if (draws_per_chunk is None) != (output_path is None):
+            raise ValueError(
+                "`draws_per_chunk` and `output_path` must be provided together."
+            )
+
+        with self._simulation_workers(n_workers):
+            if draws_per_chunk is not None:
+                assert output_path is not None
+                return self._stream_posterior_predictive(
+                    idata,
+                    data,
+                    inplace,
+                    include_group_specific,
+                    kind,
+                    n_samples,
+                    draws_per_chunk,
+                    output_path,
+                )
+            return self._sample_posterior_predictive(
+                idata, data, inplace, include_group_specific, kind, n_samples
+            )
+
+    def _sample_posterior_predictive(
+        self,
+        idata: az.InferenceData,
+        data: pd.DataFrame | None,
+        inplace: bool,
+        include_group_specific: bool,
+        kind: Literal["pps", "mean"],
+        n_samples: int | float | None,
+    ) -> az.InferenceData | None:
+        """Perform posterior predictive sampling, see `sample_posterior_predictive`."""
         if self._check_extra_fields(data):
             self._update_extra_fields(data)
 
+        predict_data = self._get_predict_data(data)
+
         if n_samples is not None:
-            # Make a copy of idata, set the `posterior` group to be a random sub-sample
-            # of the original (draw dimension gets sub-sampled)
-            idata_copy = idata.copy()
-            idata_random_sample = _random_sample(
-                idata_copy["posterior"], n_samples=n_samples
+            # Only the random sub-sample of the `posterior` group is copied. The
+            # other groups are shared with idata, since `predict()` only replaces
+            # the `posterior` and `posterior_predictive` groups.
+            posterior = cast(
+                xr.Dataset, _random_sample(idata["posterior"], n_samples=n_samples)
+            )
+            groups: dict[str, xr.Dataset] = (
+                {} if inplace else {group: idata[group] for group in idata.groups()}
+            )
+            idata_sample = az.InferenceData(**(groups | {"posterior": posterior}))
+            self.model.predict(
+                idata_sample, kind, predict_data, True, include_group_specific
             )
-            delattr(idata_copy, "posterior")
-            idata_copy.add_groups(posterior=idata_random_sample)
+            if data is None:
+                self._expand_compressed_idata(idata_sample)
 
             # If the user specifies an inplace operation, we need to modify the original
             if inplace:
-                self.model.predict(idata_copy, kind, data, True, include_group_specific)
                 idata.add_groups(
-                    posterior_predictive=idata_copy["posterior_predictive"]
+                    posterior_predictive=idata_sample["posterior_predictive"]
                 )
-
                 return None
 
-            return self.model.predict(
-                idata_copy, kind, data, False, include_group_specific
+            return idata_sample
+
+        idata_pred = self.model.predict(
+            idata, kind, predict_data, inplace, include_group_specific
+        )
+
+        # Expand the other groups from the unique rows back to the original rows
+        if data is None:
+            self._expand_compressed_idata(idata if inplace else idata_pred)
+
+        return idata_pred
+
+    def _stream_posterior_predictive(
+        self,
+        idata: az.InferenceData,
+        data: pd.DataFrame | None,
+        inplace: bool,
+        include_group_specific: bool,
+        kind: Literal["pps", "mean"],
+        n_samples: int | float | None,
+        draws_per_chunk: int,
+        output_path: str | PathLike,
+    ) -> az.InferenceData | None:
+        """Simulate the posterior predictive samples in chunks of draws to a file.
+
+        See `sample_posterior_predictive` for the parameters.
+        """
+        if kind != "pps":
+            raise ValueError(
+                "Posterior predictive sampling in chunks is only supported when "
+                + "`kind` is 'pps'."
+            )
+        if draws_per_chunk < 1:
+            raise ValueError("`draws_per_chunk` must be >= 1.")
+        if os.path.exists(output_path):
+            raise ValueError(
+                f"The file {output_path} already exists. Please remove it or choose "
+                + "another `output_path`."
             )
+        _import_h5netcdf()
+
+        if self._check_extra_fields(data):
+            self._update_extra_fields(data)
+
+        posterior = idata["posterior"]
+        draws = _generate_random_indices(n_samples, posterior.sizes["draw"])
+        if draws is None:
+            draws = np.arange(posterior.sizes["draw"])
 
-        return self.model.predict(idata, kind, data, inplace, include_group_specific)
+        predict_data = self._get_predict_data(data)
+
+        for start in range(0, len(draws), draws_per_chunk):
+            chunk = az.InferenceData(
+                posterior=posterior.isel(draw=draws[start : start + draws_per_chunk])
+            )
+            self.model.predict(chunk, kind, predict_data, True, include_group_specific)
+            _append_to_netcdf(chunk["posterior_predictive"], output_path, dim="draw")
+
+        # The variables are read from the file when they are accessed. With dask, they
+        # are read in the same chunks of draws as they were written.
+        chunks = {"draw": draws_per_chunk} if importlib.util.find_spec("dask") else None
+        posterior_predictive = xr.open_dataset(
+            output_path, engine="h5netcdf", chunks=chunks, cache=False
+        )
+
+        if inplace:
+            if "posterior_predictive" in idata:
+                delattr(idata, "posterior_predictive")
+            idata.add_groups(posterior_predictive=posterior_predictive)
+            return None
+
+        groups: dict[str, xr.Dataset] = {
+            group: idata[group] for group in idata.groups()
+        }
+        if n_samples is not None:
+            groups["posterior"] = posterior.isel(draw=draws)
+        groups["posterior_predictive"] = posterior_predictive
+        return az.InferenceData(**groups)
 
     def plot_posterior_predictive(self, **kwargs) -> mpl.axes.Axes | sns.FacetGrid:
         """Produce a posterior predictive plot.
@@ -624,6 +806,7 @@ class HSSM:
         var_names: str | list[str] | None = None,
         omit_offsets: bool = True,
         random_seed: np.random.Generator | None = None,
+        n_workers: int | None = None,
     ) -> az.InferenceData:
         """Generate samples from the prior predictive distribution.
 
@@ -640,6 +823,9 @@ class HSSM:
             Whether to omit offset terms. Defaults to ``True``.
         random_seed
             Seed for the random number generator.
+        n_workers : optional
+            The number of processes used to simulate from the model. See
+            `sample_posterior_predictive`. Defaults to None.
 
         Returns
         -------
@@ -647,7 +833,34 @@ class HSSM:
             ``InferenceData`` object with the groups ``prior``, ``prior_predictive`` and
             ``observed_data``.
         """
-        return self.model.prior_predictive(draws, var_names, omit_offsets, random_seed)
+        with self._simulation_workers(n_workers):
+            return self.model.prior_predictive(
+                draws, var_names, omit_offsets, random_seed
+            )
+
+    @contextmanager
+    def _simulation_workers(self, n_workers: int | None) -> Iterator[None]:
+        """Set the number of processes used to simulate from the model, temporarily.
+
+        The pool of processes is shared by all the simulations in the context, and shut
+        down when the context exits.
+        """
+        rv_class = type(self.model_distribution.rv_op)
+        if n_workers is None or not hasattr(rv_class, "_n_workers"):
+            yield
+            return
+
+        previous = rv_class._n_workers, rv_class._executor
+        with ExitStack() as stack:
+            rv_class._n_workers = n_workers
+            if n_workers > 1:
+                rv_class._executor = stack.enter_context(
+                    _make_simulation_executor(n_workers)
+                )
+            try:
+                yield
+            finally:
+                rv_class._n_workers, rv_class._executor = previous
 
     @property
     def pymc_model(self) -> pm.Model:
@@ -1180,6 +1393,43 @@ class HSSM:
 
         return result_formula, result_priors, result_links
 
+    def _make_precision_grid(self) -> np.ndarray | None:
+        """Make the inputs at which the reduced-precision LAN is checked, if needed."""
+        if self.model_config.precision is None:
+            return None
+
+        # The deadline, if any, is not an input of the LAN
+        lan_columns = (self.extra_fields or []) + self.response[
+            : len(self.response) - int(self.deadline)
+        ]
+        observed = self.data.loc[self.data["rt"] != -999.0, lan_columns]
+
+        # The parameters without finite bounds are sampled within the bounds of the
+        # default LAN for the model, which cover the range it was trained on.
+        default_bounds: dict[str, tuple[float, float]] = {}
+        if self.model_name in default_model_config:
+            model_name = cast(SupportedModels, self.model_name)
+            likelihoods = default_model_config[model_name]["likelihoods"]
+            if "approx_differentiable" in likelihoods:
+                default_bounds = likelihoods["approx_differentiable"]["bounds"]
+        param_bounds = []
+        for name, param in self.params.items():
+            if name == "p_outlier":
+                continue
+            bounds = param.bounds
+            if bounds is None or not np.all(np.isfinite(bounds)):
+                bounds = default_bounds.get(name)
+            if bounds is None or not np.all(np.isfinite(bounds)):
+                raise ValueError(
+                    "The accuracy of the reduced-precision LAN cannot be checked "
+                    + f"because the parameter {name} has no finite bounds. Please "
+                    + "provide finite bounds for it, or remove `precision` from "
+                    + "`model_config`."
+                )
+            param_bounds.append(bounds)
+
+        return make_precision_grid(param_bounds, observed.to_numpy())
+
     def _make_model_distribution(self) -> type[pm.Distribution]:
         """Make a pm.Distribution for the model."""
         ### Logic for different types of likelihoods:
@@ -1194,6 +1444,14 @@ class HSSM:
         # If user has already provided a log-likelihood function as a distribution
         # Use it directly as the distribution
         if isclass(self.loglik) and issubclass(self.loglik, pm.Distribution):
+            if self.compress_data:
+                raise ValueError(
+                    "`compress_data` cannot be used when `loglik` is a "
+                    + "`pm.Distribution`."
+                )
+            self._model_data = self.data
+            self._data_counts = None
+            self._data_inverse_idx = None
             return self.loglik
 
         params_is_reg = [
@@ -1211,6 +1469,9 @@ class HSSM:
                     loglik_kind="approx_differentiable",
                     backend="jax",
                     params_is_reg=params_is_reg,
+                    precision=self.model_config.precision,
+                    precision_grid=self._make_precision_grid(),
+                    chunk_size=self.model_config.chunk_size,
                 )
             else:
                 likelihood_callable = make_likelihood_callable(
@@ -1227,6 +1488,20 @@ class HSSM:
 
         self.loglik = likelihood_callable
 
+        self.data = _rearrange_data(self.data)
+
+        # Collapse the duplicated rows, if requested. The missing data stay on top.
+        if self.compress_data:
+            (
+                self._model_data,
+                self._data_counts,
+                self._data_inverse_idx,
+            ) = _compress_data(self.data)
+        else:
+            self._model_data = self.data
+            self._data_counts = None
+            self._data_inverse_idx = None
+
         # Make the callable for missing data
         # And assemble it with the callable for the likelihood
         if self.missing_data_network != MissingDataNetwork.NONE:
@@ -1238,9 +1513,13 @@ class HSSM:
                 )
             params_only = self.missing_data_network == MissingDataNetwork.CPN
 
-            if self.model_config.backend != "pytensor":
+            if self.model_config.backend not in ("pytensor", "onnxruntime"):
                 missing_data_callable = make_missing_data_callable(
-                    self.loglik_missing_data, "jax", params_is_reg, params_only
+                    self.loglik_missing_data,
+                    "jax",
+                    params_is_reg,
+                    params_only,
+                    chunk_size=self.model_config.chunk_size,
                 )
             else:
                 missing_data_callable = make_missing_data_callable(
@@ -1252,15 +1531,27 @@ class HSSM:
 
             self.loglik_missing_data = missing_data_callable
 
+            # The missing-data network only depends on the parameters (and, for the
+            # OPN, the deadline), so it is evaluated once per group of missing trials
+            # with the same parameter values and deadline. The likelihood of the
+            # other trials depends on their data and is evaluated per trial.
+            n_missing = int((self._model_data["rt"] == -999.0).sum())
+            param_groups = _get_param_groups(
+                self._model_data.iloc[:n_missing],
+                self.params,
+                self.extra_fields,
+                deadline_name=None if params_only else self.deadline_name,
+            )
             self.loglik = assemble_callables(
                 self.loglik,
                 self.loglik_missing_data,
                 params_only,
                 has_deadline=self.deadline,
+                param_groups=param_groups,
+                n_missing=n_missing,
+                n_trials=len(self._model_data),
             )
 
-        self.data = _rearrange_data(self.data)
-
         return make_distribution(
             rv=self.model_config.rv or self.model_name,
             loglik=self.loglik,
@@ -1270,8 +1561,12 @@ class HSSM:
             extra_fields=(
                 None
                 if not self.extra_fields
-                else [deepcopy(self.data[field].values) for field in self.extra_fields]
+                else [
+                    deepcopy(self._model_data[field].values)
+                    for field in self.extra_fields
+                ]
             ),
+            weights=self._data_counts,
         )
 
     def _check_extra_fields(self, data: pd.DataFrame | None = None) -> bool:
@@ -1303,6 +1598,51 @@ class HSSM:
             new_data[field].values for field in self.extra_fields
         ]
 
+    def _get_predict_data(self, data: pd.DataFrame | None) -> pd.DataFrame | None:
+        """Get the data on which the posterior predictive samples are simulated.
+
+        When the data is compressed, the samples are simulated for the original rows
+        instead of the unique rows, so that duplicated rows get independent draws.
+        """
+        if data is None and self._data_inverse_idx is not None:
+            return self.data
+        return data
+
+    def _expand_compressed_idata(self, idata: az.InferenceData):
+        """Expand the groups of idata from the unique rows to the original rows.
+
+        Only has an effect when the data is compressed. The observed data are repeated
+        for the duplicated rows. The log-likelihoods of the unique rows, which are
+        multiplied by the counts, are divided by the counts before being repeated.
+        The posterior predictive samples are not expanded, because they are simulated
+        for the original rows.
+
+        Parameters
+        ----------
+        idata
+            The InferenceData object, modified in place.
+        """
+        if self._data_inverse_idx is None or self._data_counts is None:
+            return
+
+        obs_dim = f"{self.response_str}_obs"
+        n_unique = len(self._data_counts)
+        counts = xr.DataArray(self._data_counts, dims=obs_dim)
+
+        for group in ["log_likelihood", "observed_data"]:
+            if group not in idata:
+                continue
+            dataset = idata[group]
+            # Skip the groups that are already expanded
+            if dataset.sizes.get(obs_dim, None) != n_unique:
+                continue
+            if group == "log_likelihood":
+                dataset = dataset / counts
+            dataset = dataset.isel({obs_dim: self._data_inverse_idx}).assign_coords(
+                {obs_dim: np.arange(len(self._data_inverse_idx))}
+            )
+            setattr(idata, group, dataset)
+
     def _get_deterministic_var_names(self, idata) -> list[str]:
         """Filter out the deterministic variables in var_names."""
         var_names = [
@@ -1,11 +1,14 @@
 """Likelihood functions and distributions that use them."""
 
 from .analytical import DDM, DDM_SDV, logp_ddm, logp_ddm_sdv
+from .analytical_op import logp_ddm_fused, logp_ddm_sdv_fused
 from .blackbox import logp_ddm_bbox, logp_ddm_sdv_bbox, logp_full_ddm
 
 __all__ = [
     "logp_ddm",
     "logp_ddm_sdv",
+    "logp_ddm_fused",
+    "logp_ddm_sdv_fused",
     "DDM",
     "DDM_SDV",
     "logp_ddm_bbox",
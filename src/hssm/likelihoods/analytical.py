@@ -13,10 +13,12 @@ import pytensor
 import pytensor.tensor as pt
 from numpy import inf
 from pymc.distributions.dist_math import check_parameters
+from pytensor.compile.builders import OpFromGraph
 
 from ..distribution_utils.dist import make_distribution
 
-LOGP_LB = pm.floatX(-66.1)
+# A Python float, so that the graphs follow floatX even if it is set after import
+LOGP_LB = -66.1
 
 
 def k_small(rt: np.ndarray, err: float) -> np.ndarray:
@@ -111,11 +113,12 @@ def get_ks(k_terms: int, fast: bool) -> np.ndarray:
     return ks.astype(pytensor.config.floatX)
 
 
-def ftt01w_fast(tt: np.ndarray, w: float, k_terms: int) -> np.ndarray:
-    """Perform fast computation of ftt01w.
+def log_ftt01w_fast(tt: np.ndarray, w: float, k_terms: int) -> np.ndarray:
+    """Perform fast computation of the log of ftt01w.
 
-    Density function for lower-bound first-passage times with drift rate set to 0 and
-    upper bound set to 1, calculated using the fast-RT expansion.
+    Log-density function for lower-bound first-passage times with drift rate set to 0
+    and upper bound set to 1, calculated using the fast-RT expansion. The series is
+    summed in log space, so the result does not underflow in float32.
 
     Parameters
     ----------
@@ -129,21 +132,79 @@ def ftt01w_fast(tt: np.ndarray, w: float, k_terms: int) -> np.ndarray:
     Returns
     -------
     np.ndarray
-        The approximated function f(tt|0, 1, w).
+        The log of the approximated function f(tt|0, 1, w).
     """
     # Slightly changed the original code to mimic the paper and
     # ensure correctness
     k = get_ks(k_terms, fast=True)
 
-    # A log-sum-exp trick is used here
+    # A log-sum-exp trick is used here. The terms are scaled by the largest
+    # exponential and summed with their signs before taking the log.
     y = w + 2 * k.reshape((-1, 1))
     r = -pt.power(y, 2) / (2 * tt)
     c = pt.max(r, axis=0)
-    p = pt.exp(c) * pt.sum(y * pt.exp(r - c), axis=0)
+    s = pt.sum(y * pt.exp(r - c), axis=0)
+    s = pt.maximum(s, np.finfo(pytensor.config.floatX).tiny)
     # Normalize p
-    p = p / pt.sqrt(2 * np.pi * pt.power(tt, 3))
+    log_p = c + pt.log(s) - 0.5 * pt.log(2 * np.pi * pt.power(tt, 3))
+
+    return log_p
+
+
+def log_ftt01w_slow(tt: np.ndarray, w: float, k_terms: int) -> np.ndarray:
+    """Perform slow computation of the log of ftt01w.
+
+    Log-density function for lower-bound first-passage times with drift rate set to 0
+    and upper bound set to 1, calculated using the slow-RT expansion. The series is
+    summed in log space, so the result does not underflow in float32.
+
+    Parameters
+    ----------
+    tt
+        Flipped, normalized RTs. (0, inf).
+    w
+        Normalized decision starting point. (0, 1).
+    k_terms
+        number of terms to use to approximate the PDF.
+
+    Returns
+    -------
+    np.ndarray
+        The log of the approximated function f(tt|0, 1, w).
+    """
+    k = get_ks(k_terms, fast=False)
+    y = k * pt.sin(k * np.pi * w)
+    r = -pt.power(k, 2) * pt.power(np.pi, 2) * tt / 2
+    # The exponents decrease with k, so the first term has the largest exponent.
+    c = r[0]
+    s = pt.sum(y * pt.exp(r - c), axis=0)
+    s = pt.maximum(s, np.finfo(pytensor.config.floatX).tiny)
+    log_p = c + pt.log(np.pi * s)
+
+    return log_p
+
 
-    return p
+def ftt01w_fast(tt: np.ndarray, w: float, k_terms: int) -> np.ndarray:
+    """Perform fast computation of ftt01w.
+
+    Density function for lower-bound first-passage times with drift rate set to 0 and
+    upper bound set to 1, calculated using the fast-RT expansion.
+
+    Parameters
+    ----------
+    tt
+        Flipped, normalized RTs. (0, inf).
+    w
+        Normalized decision starting point. (0, 1).
+    k_terms
+        number of terms to use to approximate the PDF.
+
+    Returns
+    -------
+    np.ndarray
+        The approximated function f(tt|0, 1, w).
+    """
+    return pt.exp(log_ftt01w_fast(tt, w, k_terms))
 
 
 def ftt01w_slow(tt: np.ndarray, w: float, k_terms: int) -> np.ndarray:
@@ -166,12 +227,57 @@ def ftt01w_slow(tt: np.ndarray, w: float, k_terms: int) -> np.ndarray:
     np.ndarray
         The approximated function f(tt|0, 1, w).
     """
-    k = get_ks(k_terms, fast=False)
-    y = k * pt.sin(k * np.pi * w)
-    r = -pt.power(k, 2) * pt.power(np.pi, 2) * tt / 2
-    p = pt.sum(y * pt.exp(r), axis=0) * np.pi
+    return pt.exp(log_ftt01w_slow(tt, w, k_terms))
 
-    return p
+
+def log_ftt01w(
+    rt: np.ndarray,
+    a: float,
+    w: float,
+    err: float = 1e-7,
+    k_terms: int = 10,
+    partition: bool = False,
+) -> np.ndarray:
+    """Compute the log of the approximate density of f(tt|0,1,w).
+
+    Parameters
+    ----------
+    rt
+        Flipped Response Rates. (0, inf).
+    a
+        Value of decision upper bound. (0, inf).
+    w
+        Normalized decision starting point. (0, 1).
+    err
+        Error bound.
+    k_terms
+        number of terms to use to approximate the PDF. Ignored when `partition` is
+        True.
+    partition
+        If True, trials are split by the decision of `compare_k`, and each expansion
+        is only evaluated for the trials that need it. The number of terms is then
+        determined from `k_small` and `k_large` instead of `k_terms`. Because the
+        shapes of the intermediate arrays depend on the data, this mode is not
+        compatible with the JAX backend. Defaults to False.
+
+    Returns
+    -------
+    np.ndarray
+        The log of the approximated density of f(tt|0,1,w).
+    """
+    tt = rt / a**2.0
+
+    if partition:
+        return log_ftt01w_partitioned(tt, w, err)
+
+    lambda_rt = compare_k(tt, err)
+
+    log_p_fast = log_ftt01w_fast(tt, w, k_terms)
+    log_p_slow = log_ftt01w_slow(tt, w, k_terms)
+
+    log_p = pt.switch(lambda_rt, log_p_fast, log_p_slow)
+
+    return log_p
 
 
 def ftt01w(
@@ -180,6 +286,7 @@ def ftt01w(
     w: float,
     err: float = 1e-7,
     k_terms: int = 10,
+    partition: bool = False,
 ) -> np.ndarray:
     """Compute the approximate density of f(tt|0,1,w).
 
@@ -194,23 +301,163 @@ def ftt01w(
     err
         Error bound.
     k_terms
-        number of terms to use to approximate the PDF.
+        number of terms to use to approximate the PDF. Ignored when `partition` is
+        True.
+    partition
+        If True, only evaluate the selected series expansion for each trial. See
+        `log_ftt01w` for details. Defaults to False.
 
     Returns
     -------
     np.ndarray
         The Approximated density of f(tt|0,1,w).
     """
-    tt = rt / a**2.0
+    return pt.exp(log_ftt01w(rt, a, w, err, k_terms, partition))
 
-    lambda_rt = compare_k(tt, err)
 
-    p_fast = ftt01w_fast(tt, w, k_terms)
-    p_slow = ftt01w_slow(tt, w, k_terms)
+def log_ftt01w_partitioned(tt: np.ndarray, w: float, err: float) -> np.ndarray:
+    """Compute log f(tt|0,1,w) evaluating only the selected expansion for each trial.
+
+    Trials are partitioned by the decision of `compare_k`. The fast expansion is only
+    evaluated for the trials where it needs fewer terms, and the slow expansion for
+    the rest. The number of terms used for each partition is the largest number of
+    terms needed by any trial in that partition, as determined by `k_small` and
+    `k_large`.
+
+    Parameters
+    ----------
+    tt
+        Flipped, normalized RTs. (0, inf).
+    w
+        Normalized decision starting point. (0, 1).
+    err
+        Error bound.
+
+    Returns
+    -------
+    np.ndarray
+        The log of the approximated function f(tt|0, 1, w).
+    """
+    tt_all, w_all = pt.broadcast_arrays(
+        pt.as_tensor_variable(tt), pt.as_tensor_variable(w)
+    )
+
+    # The number of terms only determines the shapes of the intermediate arrays
+    # and should not be differentiated through.
+    tt_const = pytensor.gradient.disconnected_grad(tt_all)
+    ks = k_small(tt_const, err)
+    kl = k_large(tt_const, err)
+    lambda_rt = ks < kl
+
+    idx_fast = pt.nonzero(lambda_rt)[0]
+    idx_slow = pt.nonzero(pt.invert(lambda_rt))[0]
+
+    # The numbers of terms are NaN for the trials with tt <= 0, whose likelihoods are
+    # replaced by the caller, so they are excluded from the maxima below.
+    valid = tt_const > 0
+
+    # Taking the max over the full vector avoids reducing an empty array when all
+    # trials fall into one partition.
+    k_terms_fast = pt.ceil(pt.max(pt.switch(valid & lambda_rt, ks, 1.0)))
+    k_terms_slow = pt.ceil(pt.max(pt.switch(valid & ~lambda_rt, kl, 1.0)))
+
+    log_p_fast = log_ftt01w_fast(tt_all[idx_fast], w_all[idx_fast], k_terms_fast)
+    log_p_slow = log_ftt01w_slow(tt_all[idx_slow], w_all[idx_slow], k_terms_slow)
+
+    log_p = pt.zeros_like(tt_all)
+    log_p = pt.set_subtensor(log_p[idx_fast], log_p_fast)
+    log_p = pt.set_subtensor(log_p[idx_slow], log_p_slow)
+
+    return log_p
+
+
+class DDMLogpGraph(OpFromGraph):
+    """The graph of the log-likelihoods in `logp_ddm` and `logp_ddm_sdv`.
+
+    The graph is inlined when it is compiled with the C, Python, or Numba backends.
+    When it is compiled with JAX, e.g., by the JAX samplers, it is replaced with
+    `hssm.likelihoods.analytical_op.DDMLogpOp`, which computes the log-likelihoods
+    and their derivatives in one pass with XLA. Only the Ops made by
+    `_make_ddm_logp_graph` are replaced, and not the Ops of their gradients.
+    """
+
+    err: float | None = None
+    epsilon: float | None = None
+    k_terms: int | None = None
+
+
+def _make_ddm_logp_graph(
+    data, v, a, z, t, sv, err: float, k_terms: int, epsilon: float, partition: bool
+) -> pt.TensorVariable:
+    """Make the log-likelihoods of `logp_ddm` or, if `sv` is not None, `logp_ddm_sdv`.
+
+    The log-likelihoods are computed by a `DDMLogpGraph`, before the parameters are
+    checked.
+    """
+    inputs = [
+        pt.as_tensor_variable(x) for x in (data, v, a, z, t, 0.0 if sv is None else sv)
+    ]
+    inner_inputs = [x.type() for x in inputs]
+    data_, v_, a_, z_, t_, sv_ = inner_inputs
+    op = DDMLogpGraph(
+        inner_inputs,
+        [
+            _logp_ddm_graph(
+                data_,
+                v_,
+                a_,
+                z_,
+                t_,
+                None if sv is None else sv_,
+                err,
+                k_terms,
+                epsilon,
+                partition,
+            )
+        ],
+        inline=True,
+    )
+    op.err, op.epsilon, op.k_terms = err, epsilon, k_terms
+
+    return op(*inputs)
+
+
+def _logp_ddm_graph(data, v, a, z, t, sv, err, k_terms, epsilon, partition):
+    """Compute the log-likelihoods of the DDM, with `sv` if it is not None."""
+    data = pt.reshape(data, (-1, 2))
+    rt = pt.abs(data[:, 0])
+    response = data[:, 1]
+    flip = response > 0
+    a = a * 2.0
+    v_flipped = pt.switch(flip, -v, v)  # transform v if x is upper-bound response
+    z_flipped = pt.switch(flip, 1 - z, z)  # transform z if x is upper-bound response
+    rt = rt - t
 
-    p = pt.switch(lambda_rt, p_fast, p_slow)
+    log_p = pt.maximum(log_ftt01w(rt, a, z_flipped, err, k_terms, partition), LOGP_LB)
 
-    return p
+    if sv is None:
+        return pt.where(
+            rt <= epsilon,
+            LOGP_LB,
+            log_p
+            - v_flipped * a * z_flipped
+            - (v_flipped**2 * rt / 2.0)
+            - 2.0 * pt.log(a),
+        )
+
+    return pt.switch(
+        rt <= epsilon,
+        LOGP_LB,
+        log_p
+        + (
+            (a * z_flipped * sv) ** 2
+            - 2 * a * v_flipped * z_flipped
+            - (v_flipped**2) * rt
+        )
+        / (2 * (sv**2) * rt + 2)
+        - 0.5 * pt.log(sv**2 * rt + 1)
+        - 2 * pt.log(a),
+    )
 
 
 def logp_ddm(
@@ -222,6 +469,7 @@ def logp_ddm(
     err: float = 1e-15,
     k_terms: int = 20,
     epsilon: float = 1e-15,
+    partition: bool = False,
 ) -> np.ndarray:
     """Compute analytical likelihood for the DDM model with `sv`.
 
@@ -247,30 +495,20 @@ def logp_ddm(
     epsilon
         A small positive number to prevent division by zero or
         taking the log of zero.
+    partition
+        If True, only evaluate the selected series expansion for each trial. See
+        `ftt01w` for details. Defaults to False. This is a low-level option that
+        `HSSM` does not set. To use it in a model, pass
+        `functools.partial(logp_ddm, partition=True)` as `loglik` with
+        `loglik_kind="analytical"`.
 
     Returns
     -------
     np.ndarray
         The analytical likelihoods for DDM.
     """
-    data = pt.reshape(data, (-1, 2))
-    rt = pt.abs(data[:, 0])
-    response = data[:, 1]
-    flip = response > 0
-    a = a * 2.0
-    v_flipped = pt.switch(flip, -v, v)  # transform v if x is upper-bound response
-    z_flipped = pt.switch(flip, 1 - z, z)  # transform z if x is upper-bound response
-    rt = rt - t
-
-    p = pt.maximum(ftt01w(rt, a, z_flipped, err, k_terms), pt.exp(LOGP_LB))
-
-    logp = pt.where(
-        rt <= epsilon,
-        LOGP_LB,
-        pt.log(p)
-        - v_flipped * a * z_flipped
-        - (v_flipped**2 * rt / 2.0)
-        - 2.0 * pt.log(a),
+    logp = _make_ddm_logp_graph(
+        data, v, a, z, t, None, err, k_terms, epsilon, partition
     )
 
     checked_logp = check_parameters(logp, a >= 0, msg="a >= 0")
@@ -289,6 +527,7 @@ def logp_ddm_sdv(
     err: float = 1e-15,
     k_terms: int = 20,
     epsilon: float = 1e-15,
+    partition: bool = False,
 ) -> np.ndarray:
     """Compute the log-likelihood of the drift diffusion model f(t|v,a,z).
 
@@ -314,6 +553,12 @@ def logp_ddm_sdv(
         number of terms to use to approximate the PDF.
     epsilon
         A small positive number to prevent division by zero or taking the log of zero.
+    partition
+        If True, only evaluate the selected series expansion for each trial. See
+        `ftt01w` for details. Defaults to False. This is a low-level option that
+        `HSSM` does not set. To use it in a model, pass
+        `functools.partial(logp_ddm_sdv, partition=True)` as `loglik` with
+        `loglik_kind="analytical"`.
 
     Returns
     -------
@@ -322,37 +567,147 @@ def logp_ddm_sdv(
         of sv.
     """
     if sv == 0:
-        return logp_ddm(data, v, a, z, t, err, k_terms, epsilon)
+        return logp_ddm(data, v, a, z, t, err, k_terms, epsilon, partition)
+
+    logp = _make_ddm_logp_graph(data, v, a, z, t, sv, err, k_terms, epsilon, partition)
+
+    checked_logp = check_parameters(logp, a >= 0, msg="a >= 0")
+    checked_logp = check_parameters(checked_logp, z >= 0, msg="z >= 0")
+    checked_logp = check_parameters(checked_logp, z <= 1, msg="z <= 1")
+    checked_logp = check_parameters(checked_logp, sv > 0, msg="sv > 0")
+    return checked_logp
+
 
+def logp_full_ddm_analytical(
+    data: np.ndarray,
+    v: float,
+    a: float,
+    z: float,
+    t: float,
+    sv: float,
+    sz: float,
+    st: float,
+    err: float = 1e-15,
+    k_terms: int = 20,
+    epsilon: float = 1e-15,
+    n_sz: int = 5,
+    n_st: int = 5,
+) -> np.ndarray:
+    """Compute the log-likelihood of the full drift diffusion model.
+
+    The starting point is uniformly distributed on [z - sz / 2, z + sz / 2] and the
+    non-decision time is uniformly distributed on [t - st / 2, t + st / 2], as in HDDM.
+    The likelihood of the DDM with `sv` is integrated over both distributions with
+    Gauss-Legendre quadrature. The range of the integral over the non-decision time is
+    truncated at the response time, where the integrand becomes 0. Because the
+    integrand is sharply peaked for response times very close to t - st / 2, the
+    quadrature is less accurate for these trials, whose log-likelihoods are typically
+    already very small.
+
+    Parameters
+    ----------
+    data
+        2-column numpy array of (response time, response)
+    v
+        Mean drift rate. (-inf, inf).
+    a
+        Value of decision upper bound. (0, inf).
+    z
+        Normalized decision starting point. (0, 1).
+    t
+        Non-decision time [0, inf).
+    sv
+        Standard deviation of the drift rate [0, inf).
+    sz
+        Range of the starting point [0, inf).
+    st
+        Range of the non-decision time [0, inf).
+    err
+        Error bound.
+    k_terms
+        number of terms to use to approximate the PDF.
+    epsilon
+        A small positive number to prevent division by zero or taking the log of zero.
+    n_sz
+        Number of quadrature nodes for the integral over the starting point.
+    n_st
+        Number of quadrature nodes for the integral over the non-decision time.
+
+    Returns
+    -------
+    np.ndarray
+        The log likelihood of the full drift diffusion model.
+    """
+    v_, a_, z_, t_, sv_, sz_, st_ = [
+        pt.as_tensor_variable(pm.floatX(param)) for param in (v, a, z, t, sv, sz, st)
+    ]
     data = pt.reshape(data, (-1, 2))
     rt = pt.abs(data[:, 0])
     response = data[:, 1]
-    flip = response > 0
-    a = a * 2.0
-    v_flipped = pt.switch(flip, -v, v)  # transform v if x is upper-bound response
-    z_flipped = pt.switch(flip, 1 - z, z)  # transform z if x is upper-bound response
-    rt = rt - t
 
-    p = pt.maximum(ftt01w(rt, a, z_flipped, err, k_terms), pt.exp(LOGP_LB))
-
-    logp = pt.switch(
-        rt <= epsilon,
+    x_sz, w_sz = np.polynomial.legendre.leggauss(n_sz)
+    x_st, w_st = np.polynomial.legendre.leggauss(n_st)
+    # Normalized weights of all (n_sz * n_st) nodes, with the nodes of z changing
+    # the slowest
+    log_w = pm.floatX(np.log(np.outer(w_sz, w_st).reshape((-1, 1)) / 4))
+    x_sz = pm.floatX(x_sz.reshape((-1, 1, 1)))
+    x_st = pm.floatX(x_st.reshape((1, -1, 1)))
+
+    # The integral over the non-decision time only covers the part of its range
+    # where it is smaller than the response time.
+    t_lower = t_ - st_ / 2
+    t_upper = pt.minimum(t_ + st_ / 2, rt)
+    t_frac = pt.switch(st_ > 0, (t_upper - t_lower) / pt.switch(st_ > 0, st_, 1.0), 1.0)
+    t_covered = t_frac > 0
+    t_frac = pt.switch(t_covered, t_frac, 1.0)
+
+    z_nodes = z_ + sz_ / 2 * x_sz
+    t_nodes = t_lower + (t_upper - t_lower) * (x_st + 1) / 2
+
+    shape = pt.as_tensor([n_sz, n_st, rt.shape[0]])
+    z_nodes = pt.broadcast_to(z_nodes, shape).flatten()
+    rt_nodes = pt.broadcast_to(rt - t_nodes, shape).flatten()
+    flip = pt.broadcast_to(pt.gt(response, 0), shape).flatten()
+    v_nodes = pt.broadcast_to(v_, shape).flatten()
+    a_nodes = pt.broadcast_to(a_ * 2.0, shape).flatten()
+    sv_nodes = pt.broadcast_to(sv_, shape).flatten()
+
+    v_flipped = pt.switch(flip, -v_nodes, v_nodes)
+    z_flipped = pt.switch(flip, 1 - z_nodes, z_nodes)
+
+    log_p = pt.maximum(log_ftt01w(rt_nodes, a_nodes, z_flipped, err, k_terms), LOGP_LB)
+
+    logp_nodes = pt.switch(
+        rt_nodes <= epsilon,
         LOGP_LB,
-        pt.log(p)
+        log_p
         + (
-            (a * z_flipped * sv) ** 2
-            - 2 * a * v_flipped * z_flipped
-            - (v_flipped**2) * rt
+            (a_nodes * z_flipped * sv_nodes) ** 2
+            - 2 * a_nodes * v_flipped * z_flipped
+            - (v_flipped**2) * rt_nodes
         )
-        / (2 * (sv**2) * rt + 2)
-        - 0.5 * pt.log(sv**2 * rt + 1)
-        - 2 * pt.log(a),
+        / (2 * (sv_nodes**2) * rt_nodes + 2)
+        - 0.5 * pt.log(sv_nodes**2 * rt_nodes + 1)
+        - 2 * pt.log(a_nodes),
     )
+    logp_nodes = pt.reshape(logp_nodes, (n_sz * n_st, rt.shape[0]))
 
-    checked_logp = check_parameters(logp, a >= 0, msg="a >= 0")
-    checked_logp = check_parameters(checked_logp, z >= 0, msg="z >= 0")
-    checked_logp = check_parameters(checked_logp, z <= 1, msg="z <= 1")
-    checked_logp = check_parameters(checked_logp, sv > 0, msg="sv > 0")
+    logp = pt.logsumexp(logp_nodes + log_w, axis=0) + pt.log(t_frac)
+    logp = pt.switch(t_covered, pt.maximum(logp, LOGP_LB), LOGP_LB)
+
+    checked_logp = check_parameters(logp, a_ >= 0, msg="a >= 0")
+    checked_logp = check_parameters(checked_logp, sv_ >= 0, msg="sv >= 0")
+    checked_logp = check_parameters(checked_logp, sz_ >= 0, msg="sz >= 0")
+    checked_logp = check_parameters(checked_logp, st_ >= 0, msg="st >= 0")
+    checked_logp = check_parameters(
+        checked_logp, z_ - sz_ / 2 >= 0, msg="z - sz/2 >= 0"
+    )
+    checked_logp = check_parameters(
+        checked_logp, z_ + sz_ / 2 <= 1, msg="z + sz/2 <= 1"
+    )
+    checked_logp = check_parameters(
+        checked_logp, t_ - st_ / 2 >= 0, msg="t - st/2 >= 0"
+    )
     return checked_logp
 
 
@@ -363,9 +718,11 @@ ddm_bounds = {
     "t": (0.0, inf),
 }
 ddm_sdv_bounds = ddm_bounds | {"sv": (0.0, inf)}
+full_ddm_bounds = ddm_sdv_bounds | {"sz": (0.0, inf), "st": (0.0, inf)}
 
 ddm_params = ["v", "a", "z", "t"]
 ddm_sdv_params = ddm_params + ["sv"]
+full_ddm_params = ddm_sdv_params + ["sz", "st"]
 
 DDM: Type[pm.Distribution] = make_distribution(
     "ddm",
@@ -380,3 +737,10 @@ DDM_SDV: Type[pm.Distribution] = make_distribution(
     list_params=ddm_sdv_params,
     bounds=ddm_sdv_bounds,
 )
+
+FULL_DDM: Type[pm.Distribution] = make_distribution(
+    "full_ddm",
+    logp_full_ddm_analytical,
+    list_params=full_ddm_params,
+    bounds=full_ddm_bounds,
+)
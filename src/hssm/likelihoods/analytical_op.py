@@ -0,0 +1,620 @@
+"""Fused log-likelihood and gradient Op for the analytical DDM likelihoods.
+
+The `analytical` likelihoods in `hssm.likelihoods.analytical` are pytensor graphs, and
+their gradients are obtained via pytensor autodiff through the series expansions. This
+module provides a pytensor Op that computes the log-likelihoods of the DDM and their
+closed-form derivatives with respect to all parameters in a single pass in numpy.
+
+The Op also has a native JAX implementation, which is registered via `jax_funcify`, so
+that the likelihood is compiled with XLA when sampling with the JAX samplers.
+
+The defaults of the `ddm` and `ddm_sdv` models, `logp_ddm` and `logp_ddm_sdv`, remain
+pytensor graphs when they are compiled by the C backend of PyMC. When they are compiled
+with JAX, e.g., with the "nuts_numpyro" and "nuts_blackjax" samplers, a rewrite that
+only runs in the JAX mode replaces their graphs with `DDMLogpOp`. `logp_ddm_fused` and
+`logp_ddm_sdv_fused` use `DDMLogpOp` with all backends.
+"""
+
+from typing import cast
+
+import jax.numpy as jnp
+import numpy as np
+import pytensor
+import pytensor.tensor as pt
+from jax import lax, value_and_grad
+from pymc.distributions.dist_math import check_parameters
+from pytensor.compile import optdb
+from pytensor.gradient import DisconnectedType, grad_not_implemented
+from pytensor.graph import Apply, Op
+from pytensor.graph.rewriting.basic import in2out, node_rewriter
+from pytensor.link.jax.dispatch import jax_funcify
+
+from .analytical import LOGP_LB, DDMLogpGraph
+
+
+def _k_small(tt: np.ndarray, err: float) -> np.ndarray:
+    """Determine number of terms needed for small-t expansion in numpy.
+
+    See `hssm.likelihoods.analytical.k_small` for details.
+    """
+    bound = 2 * np.sqrt(2 * np.pi * tt) * err
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ks = 2 + np.sqrt(-2 * tt * np.log(bound))
+    ks = np.maximum(ks, np.sqrt(tt) + 1)
+
+    return np.where(bound < 1, ks, 2.0)
+
+
+def _k_large(tt: np.ndarray, err: float) -> np.ndarray:
+    """Determine number of terms needed for large-t expansion in numpy.
+
+    See `hssm.likelihoods.analytical.k_large` for details.
+    """
+    lower = 1.0 / (np.pi * np.sqrt(tt))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        kl = np.sqrt(-2 * np.log(np.pi * tt * err) / (np.pi**2 * tt))
+    kl = np.maximum(kl, lower)
+
+    return np.where(np.pi * tt * err < 1, kl, lower)
+
+
+def _ftt01w_fast_derivs(
+    tt: np.ndarray, w: np.ndarray, k_terms: int
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Compute log f(tt|0,1,w) and its derivatives with the fast-RT expansion.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray]
+        log f, d(log f)/d(tt), and d(log f)/d(w).
+    """
+    k = np.arange(-np.floor((k_terms - 1) / 2), np.ceil((k_terms - 1) / 2) + 1)
+    y = w + 2 * k.reshape((-1, 1))
+    r = -(y**2) / (2 * tt)
+    c = np.max(r, axis=0)
+    e = np.exp(r - c)
+
+    s0 = np.sum(y * e, axis=0)
+    s_tt = np.sum(y**3 * e, axis=0) / (2 * tt**2)
+    s_w = np.sum((1 - y**2 / tt) * e, axis=0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        log_f = c + np.log(s0) - 0.5 * np.log(2 * np.pi * tt**3)
+
+    return log_f, s_tt / s0 - 1.5 / tt, s_w / s0
+
+
+def _ftt01w_slow_derivs(
+    tt: np.ndarray, w: np.ndarray, k_terms: int
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Compute log f(tt|0,1,w) and its derivatives with the slow-RT expansion.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray]
+        log f, d(log f)/d(tt), and d(log f)/d(w).
+    """
+    k = np.arange(1, k_terms + 1).reshape((-1, 1))
+    # The terms are scaled by the exponential of the first term to avoid underflow
+    c = -(np.pi**2) * tt / 2
+    e = np.exp((k**2 - 1) * c)
+    sin_kw = np.sin(k * np.pi * w)
+
+    s0 = np.sum(k * sin_kw * e, axis=0)
+    s_tt = -np.sum(k**3 * sin_kw * e, axis=0) * np.pi**2 / 2
+    s_w = np.sum(k**2 * np.cos(k * np.pi * w) * e, axis=0) * np.pi
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        log_f = c + np.log(np.pi * s0)
+
+    return log_f, s_tt / s0, s_w / s0
+
+
+def ftt01w_derivs(
+    tt: np.ndarray, w: np.ndarray, err: float
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Compute log f(tt|0,1,w) and its derivatives with respect to tt and w.
+
+    For each trial, only the expansion selected by comparing `k_small` and `k_large` is
+    evaluated, with the number of terms being the largest number needed by any trial
+    that uses the same expansion.
+
+    Parameters
+    ----------
+    tt
+        Flipped, normalized RTs. (0, inf).
+    w
+        Normalized decision starting point. (0, 1).
+    err
+        Error bound.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray]
+        log f, d(log f)/d(tt), and d(log f)/d(w). The log-density is clamped at
+        `LOGP_LB`, where the derivatives are set to 0.
+    """
+    ks = _k_small(tt, err)
+    kl = _k_large(tt, err)
+    use_fast = ks < kl
+
+    log_f = np.empty_like(tt)
+    d_tt = np.empty_like(tt)
+    d_w = np.empty_like(tt)
+
+    for mask, k, kernel in [
+        (use_fast, ks, _ftt01w_fast_derivs),
+        (~use_fast, kl, _ftt01w_slow_derivs),
+    ]:
+        if not np.any(mask):
+            continue
+        k_terms = int(np.ceil(np.max(k[mask])))
+        log_f[mask], d_tt[mask], d_w[mask] = kernel(tt[mask], w[mask], k_terms)
+
+    clamped = ~(log_f > LOGP_LB)
+    log_f[clamped] = LOGP_LB
+    d_tt[clamped] = 0.0
+    d_w[clamped] = 0.0
+
+    return log_f, d_tt, d_w
+
+
+def logp_ddm_and_grads(
+    data: np.ndarray,
+    v: float | np.ndarray,
+    a: float | np.ndarray,
+    z: float | np.ndarray,
+    t: float | np.ndarray,
+    sv: float | np.ndarray = 0.0,
+    err: float = 1e-15,
+    epsilon: float = 1e-15,
+) -> list[np.ndarray]:
+    """Compute the log-likelihoods of the DDM and their derivatives in numpy.
+
+    Computes the log-likelihood of the drift diffusion model f(t|v,a,z,sv) using the
+    method of Navarro & Fuss, 2009, together with its closed-form derivatives with
+    respect to all parameters. When `sv` is 0, this is the likelihood of the DDM
+    without drift rate variability.
+
+    Parameters
+    ----------
+    data
+        2-column numpy array of (response time, response)
+    v
+        Mean drift rate. (-inf, inf).
+    a
+        Value of decision upper bound. (0, inf).
+    z
+        Normalized decision starting point. (0, 1).
+    t
+        Non-decision time [0, inf).
+    sv
+        Standard deviation of the drift rate [0, inf).
+    err
+        Error bound.
+    epsilon
+        A small positive number to prevent division by zero or taking the log of zero.
+
+    Returns
+    -------
+    list[np.ndarray]
+        The element-wise log-likelihoods, followed by their derivatives with respect to
+        v, a, z, t, and sv.
+    """
+    data = np.reshape(data, (-1, 2)).astype(np.float64)
+    size = data.shape[0]
+    v, a, z, t, sv = [
+        np.broadcast_to(np.asarray(param, dtype=np.float64), size)
+        for param in (v, a, z, t, sv)
+    ]
+
+    rt = np.abs(data[:, 0]) - t
+    flip = data[:, 1] > 0
+    sign = np.where(flip, -1.0, 1.0)
+    v_flipped = sign * v
+    z_flipped = np.where(flip, 1 - z, z)
+    a = a * 2.0
+
+    logp = np.full(size, LOGP_LB)
+    grads = [np.zeros(size) for _ in range(5)]
+
+    valid = rt > epsilon
+    if not np.any(valid):
+        return [logp, *grads]
+
+    rt, a, v_flipped, z_flipped, sv, sign = [
+        x[valid] for x in (rt, a, v_flipped, z_flipped, sv, sign)
+    ]
+
+    tt = rt / a**2
+    log_f, dlogf_dtt, dlogf_dw = ftt01w_derivs(tt, z_flipped, err)
+
+    sv2 = sv**2
+    q = sv2 * rt + 1
+    numerator = (a * z_flipped * sv) ** 2 - 2 * a * v_flipped * z_flipped
+    numerator = numerator - v_flipped**2 * rt
+
+    logp[valid] = log_f + numerator / (2 * q) - 0.5 * np.log(q) - 2 * np.log(a)
+
+    d_v = -(a * z_flipped + v_flipped * rt) / q
+    d_a = (
+        -2 * rt / a**3 * dlogf_dtt
+        + (a * z_flipped**2 * sv2 - v_flipped * z_flipped) / q
+        - 2 / a
+    )
+    d_z = dlogf_dw + (a**2 * z_flipped * sv2 - a * v_flipped) / q
+    d_rt = (
+        dlogf_dtt / a**2
+        - v_flipped**2 / (2 * q)
+        - numerator * sv2 / (2 * q**2)
+        - 0.5 * sv2 / q
+    )
+    d_sv = (a * z_flipped) ** 2 * sv / q - numerator * sv * rt / q**2 - sv * rt / q
+
+    grads[0][valid] = sign * d_v
+    grads[1][valid] = 2 * d_a
+    grads[2][valid] = sign * d_z
+    grads[3][valid] = -d_rt
+    grads[4][valid] = d_sv
+
+    return [logp, *grads]
+
+
+class DDMLogpOp(Op):
+    """Computes the DDM log-likelihoods together with their derivatives.
+
+    The first output of this Op is the element-wise log-likelihoods. The rest are the
+    element-wise derivatives with respect to v, a, z, t, and sv, which are used to
+    compute the gradient of the first output. Because the value and the derivatives
+    are produced by the same Apply node, they are only computed once when both the
+    log-likelihood and its gradient are requested.
+
+    The numpy implementation determines the number of terms of the series from `err`.
+    The JAX implementation needs static shapes, so it uses `k_terms` terms.
+    """
+
+    __props__ = ("err", "epsilon", "k_terms")
+
+    def __init__(self, err: float = 1e-15, epsilon: float = 1e-15, k_terms: int = 20):
+        self.err = err
+        self.epsilon = epsilon
+        self.k_terms = k_terms
+
+    def make_node(self, data, v, a, z, t, sv):
+        """Take the inputs to the Op and puts them in a list.
+
+        Also specifies the output types in a list, then feed them to the Apply node.
+
+        Parameters
+        ----------
+        data
+            A two-column numpy array with response time and response.
+        v, a, z, t, sv
+            The parameters of the DDM. Each can be a scalar or a vector.
+        """
+        inputs = [pt.as_tensor_variable(x) for x in (data, v, a, z, t, sv)]
+        outputs = [pt.vector(dtype=pytensor.config.floatX) for _ in range(6)]
+
+        return Apply(self, inputs, outputs)
+
+    def perform(self, node, inputs, output_storage):
+        """Perform the Apply node.
+
+        Parameters
+        ----------
+        inputs
+            This is a list of data from which the values stored in
+            output_storage are to be computed using non-symbolic language.
+        output_storage
+            This is a list of storage cells where the output
+            is to be stored. A storage cell is a one-element list. It is
+            forbidden to change the length of the list(s) contained in
+            output_storage. There is one storage cell for each output of
+            the Op.
+        """
+        results = logp_ddm_and_grads(*inputs, err=self.err, epsilon=self.epsilon)
+
+        for i, result in enumerate(results):
+            output_storage[i][0] = np.asarray(result, dtype=node.outputs[i].dtype)
+
+    def grad(self, inputs, output_gradients):
+        """Perform the pytensor.grad() operation.
+
+        Parameters
+        ----------
+        inputs
+            The same as the inputs produced in `make_node`.
+        output_gradients
+            Holds the results of the perform `perform` method.
+        """
+        if any(not isinstance(g.type, DisconnectedType) for g in output_gradients[1:]):
+            return [grad_not_implemented(self, i, x) for i, x in enumerate(inputs)]
+
+        gz = output_gradients[0]
+        derivatives = self(*inputs)[1:]
+
+        grads = [grad_not_implemented(self, 0, inputs[0])]
+        for param, derivative in zip(inputs[1:], derivatives):
+            g = gz * derivative
+            if param.ndim == 0:
+                g = pt.sum(g)
+            elif param.type.broadcastable[0]:
+                g = pt.sum(g, keepdims=True)
+            grads.append(g.astype(param.dtype))
+
+        return grads
+
+
+def _log_ftt01w_jax(tt: jnp.ndarray, w: jnp.ndarray, err: float, k_terms: int):
+    """Compute log f(tt|0,1,w) in JAX.
+
+    Both expansions are computed with `k_terms` terms so that all shapes are static,
+    and the one selected by comparing `k_small` and `k_large` is returned. The
+    log-density is clamped at `LOGP_LB`.
+    """
+    tt_const = lax.stop_gradient(tt)
+    bound_small = 2 * jnp.sqrt(2 * jnp.pi * tt_const) * err
+    bound_large = jnp.pi * tt_const * err
+    lower_large = 1.0 / (jnp.pi * jnp.sqrt(tt_const))
+    ks = jnp.maximum(
+        2 + jnp.sqrt(-2 * tt_const * jnp.log(jnp.minimum(bound_small, 1.0))),
+        jnp.sqrt(tt_const) + 1,
+    )
+    ks = jnp.where(bound_small < 1, ks, 2.0)
+    kl = jnp.maximum(
+        jnp.sqrt(
+            -2 * jnp.log(jnp.minimum(bound_large, 1.0)) / (jnp.pi**2 * tt_const)
+        ),
+        lower_large,
+    )
+    kl = jnp.where(bound_large < 1, kl, lower_large)
+    use_fast = ks < kl
+
+    # Fast-RT expansion, with the log-sum-exp trick
+    k = jnp.arange(-((k_terms - 1) // 2), k_terms // 2 + 1, dtype=tt.dtype)
+    y = w + 2 * k.reshape((-1, 1))
+    r = -(y**2) / (2 * tt)
+    c = jnp.max(r, axis=0)
+    s_fast = jnp.sum(y * jnp.exp(r - c), axis=0)
+
+    # Slow-RT expansion, scaled by the exponential of the first term
+    k = jnp.arange(1, k_terms + 1, dtype=tt.dtype).reshape((-1, 1))
+    c_slow = -(jnp.pi**2) * tt / 2
+    s_slow = jnp.sum(
+        k * jnp.sin(k * jnp.pi * w) * jnp.exp((k**2 - 1) * c_slow), axis=0
+    )
+
+    s = jnp.where(use_fast, s_fast, s_slow)
+    # Avoids NaNs in the gradients when the selected sum is not positive
+    positive = s > 0
+    s = jnp.where(positive, s, 1.0)
+
+    log_f = jnp.where(
+        use_fast,
+        c + jnp.log(s) - 0.5 * jnp.log(2 * jnp.pi * tt**3),
+        c_slow + jnp.log(jnp.pi * s),
+    )
+    log_f = jnp.where(positive, log_f, LOGP_LB)
+
+    return jnp.maximum(log_f, LOGP_LB)
+
+
+def logp_ddm_jax(
+    data: jnp.ndarray,
+    v: jnp.ndarray,
+    a: jnp.ndarray,
+    z: jnp.ndarray,
+    t: jnp.ndarray,
+    sv: jnp.ndarray,
+    err: float = 1e-15,
+    epsilon: float = 1e-15,
+    k_terms: int = 20,
+) -> jnp.ndarray:
+    """Compute the log-likelihoods of the DDM in JAX.
+
+    Parameters
+    ----------
+    data
+        2-column array of (response time, response)
+    v, a, z, t, sv
+        The parameters of the DDM as vectors of the same length as `data`.
+    err
+        Error bound.
+    epsilon
+        A small positive number to prevent division by zero or taking the log of zero.
+    k_terms
+        number of terms to use to approximate the PDF.
+
+    Returns
+    -------
+    jnp.ndarray
+        The element-wise log-likelihoods.
+    """
+    rt = jnp.abs(data[:, 0]) - t
+    flip = data[:, 1] > 0
+    v_flipped = jnp.where(flip, -v, v)
+    z_flipped = jnp.where(flip, 1 - z, z)
+    a = a * 2.0
+
+    valid = rt > epsilon
+    # Avoids NaNs in the gradients for the trials that are not valid
+    rt = jnp.where(valid, rt, 1.0)
+
+    log_f = _log_ftt01w_jax(rt / a**2, z_flipped, err, k_terms)
+
+    q = sv**2 * rt + 1
+    numerator = (a * z_flipped * sv) ** 2 - 2 * a * v_flipped * z_flipped
+    numerator = numerator - v_flipped**2 * rt
+    logp = log_f + numerator / (2 * q) - 0.5 * jnp.log(q) - 2 * jnp.log(a)
+
+    return jnp.where(valid, logp, LOGP_LB)
+
+
+def logp_ddm_and_grads_jax(
+    data: jnp.ndarray,
+    v: jnp.ndarray,
+    a: jnp.ndarray,
+    z: jnp.ndarray,
+    t: jnp.ndarray,
+    sv: jnp.ndarray,
+    err: float = 1e-15,
+    epsilon: float = 1e-15,
+    k_terms: int = 20,
+) -> list[jnp.ndarray]:
+    """Compute the log-likelihoods of the DDM and their derivatives in JAX.
+
+    This is the JAX counterpart of `logp_ddm_and_grads`, with `k_terms` terms of the
+    series as in `logp_ddm_jax`.
+
+    Returns
+    -------
+    list[jnp.ndarray]
+        The element-wise log-likelihoods, followed by their derivatives with respect to
+        v, a, z, t, and sv.
+    """
+    data = jnp.reshape(data, (-1, 2))
+    size = data.shape[0]
+    params = [jnp.broadcast_to(param, (size,)) for param in (v, a, z, t, sv)]
+
+    # Each log-likelihood only depends on the parameters of the same trial, so the
+    # gradient of the sum gives the element-wise derivatives.
+    def sum_logp(*params):
+        logp = logp_ddm_jax(data, *params, err=err, epsilon=epsilon, k_terms=k_terms)
+        return jnp.sum(logp), logp
+
+    (_, logp), grads = value_and_grad(sum_logp, argnums=(0, 1, 2, 3, 4), has_aux=True)(
+        *params
+    )
+
+    return [logp, *grads]
+
+
+@jax_funcify.register(DDMLogpOp)
+def ddm_logp_op_dispatch(op, **kwargs):  # pylint: disable=W0612,W0613
+    """Unwrap the JAX implementation of `DDMLogpOp` for sampling with JAX backend."""
+
+    def ddm_logp_op(data, v, a, z, t, sv):
+        return logp_ddm_and_grads_jax(
+            data, v, a, z, t, sv, err=op.err, epsilon=op.epsilon, k_terms=op.k_terms
+        )
+
+    return ddm_logp_op
+
+
+@node_rewriter([DDMLogpGraph])
+def local_ddm_logp_graph_to_op(fgraph, node):  # pylint: disable=W0613
+    """Replace the graph of the analytical DDM likelihoods with `DDMLogpOp`."""
+    if node.op.err is None:
+        return None
+    logp, *_ = DDMLogpOp(node.op.err, node.op.epsilon, node.op.k_terms)(*node.inputs)
+    return [logp.astype(node.outputs[0].dtype)]
+
+
+# Only included in the JAX mode, before the graphs are inlined
+optdb.register(
+    "jax_ddm_logp_op",
+    in2out(local_ddm_logp_graph_to_op),
+    "jax",
+    position=-0.02,
+)
+
+
+def logp_ddm_fused(
+    data: np.ndarray,
+    v: float,
+    a: float,
+    z: float,
+    t: float,
+    err: float = 1e-15,
+    epsilon: float = 1e-15,
+) -> np.ndarray:
+    """Compute analytical likelihood for the DDM model with a fused gradient.
+
+    Produces the same log-likelihoods as `hssm.likelihoods.analytical.logp_ddm`, but
+    the log-likelihoods and their gradients are computed together by `DDMLogpOp`.
+
+    Parameters
+    ----------
+    data
+        data: 2-column numpy array of (response time, response)
+    v
+        Mean drift rate. (-inf, inf).
+    a
+        Value of decision upper bound. (0, inf).
+    z
+        Normalized decision starting point. (0, 1).
+    t
+        Non-decision time [0, inf).
+    err
+        Error bound.
+    epsilon
+        A small positive number to prevent division by zero or
+        taking the log of zero.
+
+    Returns
+    -------
+    np.ndarray
+        The analytical likelihoods for DDM.
+    """
+    logp, *_ = cast(
+        list[pt.TensorVariable], DDMLogpOp(err, epsilon)(data, v, a, z, t, 0.0)
+    )
+
+    checked_logp = check_parameters(logp, a >= 0, msg="a >= 0")
+    checked_logp = check_parameters(checked_logp, z >= 0, msg="z >= 0")
+    checked_logp = check_parameters(checked_logp, z <= 1, msg="z <= 1")
+    return checked_logp
+
+
+def logp_ddm_sdv_fused(
+    data: np.ndarray,
+    v: float,
+    a: float,
+    z: float,
+    t: float,
+    sv: float,
+    err: float = 1e-15,
+    epsilon: float = 1e-15,
+) -> np.ndarray:
+    """Compute analytical likelihood for the DDM model with `sv` and a fused gradient.
+
+    Produces the same log-likelihoods as `hssm.likelihoods.analytical.logp_ddm_sdv`,
+    but the log-likelihoods and their gradients are computed together by `DDMLogpOp`.
+
+    Parameters
+    ----------
+    data
+        2-column numpy array of (response time, response)
+    v
+        Mean drift rate. (-inf, inf).
+    a
+        Value of decision upper bound. (0, inf).
+    z
+        Normalized decision starting point. (0, 1).
+    t
+        Non-decision time [0, inf).
+    sv
+        Standard deviation of the drift rate [0, inf).
+    err
+        Error bound.
+    epsilon
+        A small positive number to prevent division by zero or taking the log of zero.
+
+    Returns
+    -------
+    np.ndarray
+        The log likelihood of the drift diffusion model with the standard deviation
+        of sv.
+    """
+    if sv == 0:
+        return logp_ddm_fused(data, v, a, z, t, err, epsilon)
+
+    logp, *_ = cast(
+        list[pt.TensorVariable], DDMLogpOp(err, epsilon)(data, v, a, z, t, sv)
+    )
+
+    checked_logp = check_parameters(logp, a >= 0, msg="a >= 0")
+    checked_logp = check_parameters(checked_logp, z >= 0, msg="z >= 0")
+    checked_logp = check_parameters(checked_logp, z <= 1, msg="z <= 1")
+    checked_logp = check_parameters(checked_logp, sv > 0, msg="sv > 0")
+    return checked_logp
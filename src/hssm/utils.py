@@ -10,6 +10,9 @@ _parse_bambi().
 """
 
 import logging
+import os
+from os import PathLike
+from pathlib import Path
 from typing import Any, Iterable, Literal, NewType
 
 import bambi as bmb
@@ -18,8 +21,10 @@ import pandas as pd
 import pytensor
 import xarray as xr
 from bambi.terms import CommonTerm, GroupSpecificTerm, HSGPTerm, OffsetTerm
+from formulae import model_description
 from huggingface_hub import hf_hub_download
 from jax import config
+from jax.experimental.compilation_cache import compilation_cache
 from pymc.model_graph import ModelGraph
 from pytensor import function
 
@@ -289,6 +294,49 @@ def set_floatX(dtype: Literal["float32", "float64"], jax: bool = True):
         )
 
 
+def set_compilation_cache(
+    cache_dir: str | PathLike | None = None, min_compile_time_secs: float = 0.0
+):
+    """Persist compiled JAX likelihoods to a local directory.
+
+    With the JAX backend, the log-likelihoods of LANs and their gradients are compiled
+    by XLA the first time a model is evaluated. This function writes the compiled
+    executables to `cache_dir`, so that they are reused by later models and by other
+    processes without tracing and compiling the functions again. The executables of
+    the LAN likelihoods are keyed by the hash of the ONNX model, the parameters that
+    are regressions, the dtypes and the shapes of the inputs, and the versions of JAX
+    and the host CPU. The persistent compilation cache of JAX, which only caches
+    executables on GPU and TPU in the supported versions of JAX, is also enabled in
+    the same directory for the other JAX computations.
+
+    Parameters
+    ----------
+    cache_dir : optional
+        The directory of the cache. Defaults to None, in which case `hssm/jax` in the
+        user cache directory (`$XDG_CACHE_HOME` or `~/.cache`) is used.
+    min_compile_time_secs : optional
+        Only computations that take at least this long to compile are cached.
+        Defaults to 0.0, so that all computations are cached.
+    """
+    if cache_dir is None:
+        cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+        cache_dir = Path(cache_home) / "hssm" / "jax"
+
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    config.update("jax_compilation_cache_dir", str(cache_dir))
+    config.update("jax_persistent_cache_min_compile_time_secs", min_compile_time_secs)
+    # The cache is initialized by the first compilation, so it is reset in case
+    # something was compiled before the directory was set.
+    compilation_cache.reset_cache()
+
+    # Imported here to avoid a circular import
+    from .distribution_utils.onnx.cache import set_cache_dir  # pylint: disable=C0415
+
+    set_cache_dir(Path(cache_dir) / "lan")
+
+    _logger.info("Caching compiled JAX functions in %s.", cache_dir)
+
+
 def _print_prior(term: CommonTerm | GroupSpecificTerm) -> str:
     """Make the output string of a term.
 
@@ -425,6 +473,61 @@ def _random_sample(
     return data.isel(draw=sampling_indices)
 
 
+def _import_h5netcdf():
+    """Import h5netcdf, which writes the NetCDF files appended to in chunks."""
+    try:
+        import h5netcdf  # pylint: disable=C0415
+        import h5py  # noqa: F401  # pylint: disable=C0415,W0611
+    except ImportError as e:
+        e.msg = (
+            "Writing the posterior predictive samples in chunks requires the python "
+            + "libraries h5netcdf and h5py. You can install them by running\n\n"
+            + "\tpip install h5netcdf h5py"
+        )
+        raise e
+
+    return h5netcdf
+
+
+def _append_to_netcdf(
+    dataset: xr.Dataset, path: str | PathLike, dim: str = "draw"
+) -> None:
+    """Append a Dataset to a NetCDF file along a dimension.
+
+    The file is created if it does not exist, with `dim` as an unlimited dimension, so
+    that the variables are stored in chunks and can be extended without rewriting the
+    file.
+
+    Parameters
+    ----------
+    dataset
+        The Dataset to be appended. It must have the same variables and the same sizes
+        of the dimensions other than `dim` as the Dataset that created the file.
+    path
+        The path to the NetCDF file.
+    dim : optional
+        The dimension along which the Dataset is appended. Defaults to "draw".
+    """
+    h5netcdf = _import_h5netcdf()
+
+    if not os.path.exists(path):
+        dataset.to_netcdf(path, engine="h5netcdf", unlimited_dims=[dim])
+        return
+
+    with h5netcdf.File(path, "a") as file:
+        start = file.dimensions[dim].size
+        file.resize_dimension(dim, start + dataset.sizes[dim])
+        for name, variable in dataset.variables.items():
+            if dim not in variable.dims:
+                continue
+            axis = variable.dims.index(dim)
+            key = tuple(
+                slice(start, None) if i == axis else slice(None)
+                for i in range(variable.ndim)
+            )
+            file.variables[name][key] = variable.values
+
+
 def _rearrange_data(data: pd.DataFrame | np.ndarray) -> pd.DataFrame | np.ndarray:
     """Rearrange a dataframe so that missing values are on top.
 
@@ -452,3 +555,88 @@ def _rearrange_data(data: pd.DataFrame | np.ndarray) -> pd.DataFrame | np.ndarra
     split_not_missing = data[~missing_indices, :]
 
     return np.concatenate([split_missing, split_not_missing])
+
+
+def _get_param_groups(
+    data: pd.DataFrame,
+    params: dict[str, Param],
+    extra_fields: list[str] | None = None,
+    deadline_name: str | None = None,
+) -> np.ndarray | None:
+    """Find the groups of trials that share the same parameter values.
+
+    The values of the regression parameters only depend on the variables in their
+    formulas, so trials with the same values of all these variables (and of the extra
+    fields) share the same parameter values. The groups are used to evaluate the
+    missing-data networks once per unique row of the parameters and, for the OPN,
+    of the deadline.
+
+    Parameters
+    ----------
+    data
+        The data, in the order in which it is passed to the likelihood.
+    params
+        A dictionary of the parameters of the model.
+    extra_fields : optional
+        The names of the extra fields passed to the likelihood.
+    deadline_name : optional
+        The name of the deadline column. If provided, trials in the same group also
+        share the same deadline.
+
+    Returns
+    -------
+    np.ndarray | None
+        A 1D integer array with the group of each trial, or None if neither the
+        parameters nor the deadline vary by trial, if all trials are in different
+        groups, or if any variable in the formulas is not a column of the data.
+    """
+    regressions = [param for param in params.values() if param.is_regression]
+    if not regressions and not extra_fields and deadline_name is None:
+        return None
+
+    columns: set[str] = set(extra_fields or [])
+    for param in regressions:
+        rhs = str(param.formula).split("~")[1]
+        columns |= model_description(rhs).var_names
+    if deadline_name is not None:
+        columns.add(deadline_name)
+
+    # The variables that are not in the data, e.g., arrays defined in the
+    # environment, can differ between trials in ways that cannot be resolved here.
+    if not columns <= set(data.columns):
+        return None
+
+    if not columns:
+        return np.zeros(len(data), dtype=int)
+
+    param_groups = (
+        data.groupby(sorted(columns), sort=False, dropna=False).ngroup().to_numpy()
+    )
+    if param_groups.max() + 1 == len(data):
+        return None
+
+    return param_groups
+
+
+def _compress_data(data: pd.DataFrame) -> tuple[pd.DataFrame, np.ndarray, np.ndarray]:
+    """Collapse the rows of the data that are exact duplicates of each other.
+
+    Parameters
+    ----------
+    data
+        The data.
+
+    Returns
+    -------
+    tuple[pd.DataFrame, np.ndarray, np.ndarray]
+        The unique rows of the data in the order of their first occurrence, the number
+        of times each unique row occurs in the data, and the index of the unique row
+        of each row of the data.
+    """
+    inverse_idx = (
+        data.groupby(list(data.columns), sort=False, dropna=False).ngroup().to_numpy()
+    )
+    _, unique_idx = np.unique(inverse_idx, return_index=True)
+    counts = np.bincount(inverse_idx)
+
+    return data.iloc[unique_idx, :], counts, inverse_idx
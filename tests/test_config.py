@@ -79,3 +79,15 @@ def test_update_config():
 
     assert v_prior.name == "Normal"
     assert v_bounds == (-np.inf, np.inf)
+
+
+def test_update_config_precision():
+    """Tests that a reduced precision is only valid with the jax backend."""
+    config = Config.from_defaults("ddm", "approx_differentiable")
+    config.update_config(ModelConfig(backend="jax", precision="float16"))
+    assert config.precision == "float16"
+    config.validate()
+
+    config.update_config(ModelConfig(backend="pytensor"))
+    with pytest.raises(ValueError, match="requires the `jax` backend"):
+        config.validate()
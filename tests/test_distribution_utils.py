@@ -1,17 +1,24 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
 import bambi as bmb
+import cloudpickle
 import numpy as np
 import pymc as pm
+import pytensor
 import pytest
 import pytensor.tensor as pt
 
 import hssm
 from hssm import distribution_utils
+from hssm.distribution_utils import blackbox
 from hssm.distribution_utils.dist import (
     apply_param_bounds_to_loglik,
     make_distribution,
     ensure_positive_ndt,
 )
 from hssm.likelihoods.analytical import logp_ddm, DDM
+from hssm.likelihoods.blackbox import logp_ddm_bbox
 
 hssm.set_floatX("float32")
 
@@ -54,6 +61,50 @@ def test_make_ssm_rv():
         wfpt_rv.rng_fn(rng, *true_values, size=499)
 
 
+def test_make_ssm_rv_parallel():
+    """Tests that the simulations split across processes are reproducible."""
+    wfpt_rv = distribution_utils.make_ssm_rv("ddm", ["v", "a", "z", "t"], n_workers=2)
+
+    # The trials are split across processes
+    v = np.tile([3.0, -3.0], (2, 3, 50))
+    random_sample = wfpt_rv.rng_fn(np.random.default_rng(1), v, 1.5, 0.5, 0.3, None)
+    assert random_sample.shape == (2, 3, 100, 2)
+    assert np.mean(random_sample[..., ::2, 1] == 1.0) > 0.9
+    assert np.mean(random_sample[..., 1::2, 1] == -1.0) > 0.9
+
+    np.testing.assert_array_equal(
+        random_sample,
+        wfpt_rv.rng_fn(np.random.default_rng(1), v, 1.5, 0.5, 0.3, None),
+    )
+
+    # The samples are split across processes
+    random_sample = wfpt_rv.rng_fn(
+        np.random.default_rng(1), 0.5, 1.5, 0.5, 0.3, size=500
+    )
+    assert random_sample.shape == (500, 2)
+    assert len(np.unique(random_sample[:, 0])) == 500
+    np.testing.assert_array_equal(
+        random_sample,
+        wfpt_rv.rng_fn(np.random.default_rng(1), 0.5, 1.5, 0.5, 0.3, size=500),
+    )
+
+    # An executor set on the class is used instead of a pool for each call
+    submitted = []
+
+    class RecordingExecutor(ProcessPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            submitted.append(fn)
+            return super().submit(fn, *args, **kwargs)
+
+    with RecordingExecutor(2, mp_context=get_context("spawn")) as executor:
+        wfpt_rv._executor = executor
+        np.testing.assert_array_equal(
+            random_sample,
+            wfpt_rv.rng_fn(np.random.default_rng(1), 0.5, 1.5, 0.5, 0.3, size=500),
+        )
+    assert len(submitted) == 2
+
+
 def test_lapse_distribution():
     lapse_dist = bmb.Prior("Uniform", lower=0.0, upper=1.0)
     rv = distribution_utils.make_ssm_rv("ddm", ["v", "a", "z", "t"], lapse=lapse_dist)
@@ -84,6 +135,65 @@ def test_lapse_distribution():
     np.testing.assert_array_equal(random_sample_a, random_sample_b)
 
 
+def test_lapse_mixture():
+    """Tests the lapse mixture when the likelihoods underflow."""
+    lapse = bmb.Prior("Uniform", lower=0.0, upper=10.0)
+
+    def very_negative_logp(data, param1):
+        """Return log-likelihoods that underflow on the probability scale."""
+        return pt.zeros_like(data[:, 0]) - 1000.0 * param1
+
+    data = np.column_stack([np.random.uniform(0.1, 5.0, size=100), np.ones(100)])
+
+    Dist = make_distribution(
+        "fake", loglik=very_negative_logp, list_params=["param1"], lapse=lapse
+    )
+
+    np.testing.assert_allclose(
+        Dist.logp(data, 1.0, 0.05).eval(), np.log(0.05) + np.log(0.1), rtol=1e-6
+    )
+    np.testing.assert_allclose(Dist.logp(data, 1.0, 0.0).eval(), -1000.0)
+    np.testing.assert_allclose(
+        Dist.logp(data, 0.0, 0.05).eval(),
+        np.log(0.95 + 0.05 * 0.1),
+        rtol=1e-6,
+    )
+
+
+def test_lapse_mixture_gradient_at_bounds():
+    """Tests that the lapse mixture has finite gradients at p_outlier = 0 and 1.
+
+    The gradients with respect to p_outlier come from the weight of the remaining
+    component, so that a sampler started at the bounds can move away from them.
+    """
+    lapse = bmb.Prior("Uniform", lower=0.0, upper=10.0)
+
+    def linear_logp(data, param1):
+        return pt.zeros_like(data[:, 0]) - param1
+
+    data = np.column_stack([np.random.uniform(0.1, 5.0, size=10), np.ones(10)])
+    Dist = make_distribution(
+        "fake", loglik=linear_logp, list_params=["param1"], lapse=lapse
+    )
+
+    param1 = pt.scalar("param1")
+    p_outlier = pt.scalar("p_outlier")
+    logp = Dist.logp(data, param1, p_outlier).sum()
+    f = pytensor.function(
+        [param1, p_outlier], [logp, *pytensor.grad(logp, [param1, p_outlier])]
+    )
+
+    logp_0, dparam1_0, dp_0 = f(2.0, 0.0)
+    np.testing.assert_allclose(logp_0, -20.0)
+    np.testing.assert_allclose(dparam1_0, -10.0)
+    np.testing.assert_allclose(dp_0, -10.0)
+
+    logp_1, dparam1_1, dp_1 = f(2.0, 1.0)
+    np.testing.assert_allclose(logp_1, 10 * np.log(0.1), rtol=1e-6)
+    np.testing.assert_allclose(dparam1_1, 0.0)
+    np.testing.assert_allclose(dp_1, 10.0)
+
+
 def test_apply_param_bounds_to_loglik():
     """Tests the function in separation."""
     logp = np.random.normal(size=1000)
@@ -168,6 +278,200 @@ def test_make_distribution():
     )
 
 
+@pytest.mark.parametrize(
+    ("n_workers", "chunk_size", "parallel"),
+    [(None, None, "thread"), (3, None, "thread"), (2, 17, "process")],
+)
+def test_make_blackbox_op(data_ddm, n_workers, chunk_size, parallel):
+    """Tests the chunked and parallel blackbox Op against the wrapped function."""
+    v = np.random.normal(0.5, 0.1, size=data_ddm.shape[0])
+    true_values = (1.5, 0.5, 0.3)
+    data = data_ddm.values
+
+    blackbox_op = distribution_utils.make_blackbox_op(
+        logp_ddm_bbox, n_workers=n_workers, chunk_size=chunk_size, parallel=parallel
+    )
+
+    np.testing.assert_allclose(
+        blackbox_op(data, v, *true_values).eval(),
+        logp_ddm_bbox(data, v, *true_values),
+        rtol=1e-6,
+    )
+
+
+def test_evaluate_chunk_shared_closes_old_blocks(data_ddm):
+    """Tests that workers only keep the latest shared-memory block attached."""
+    data = data_ddm.values
+    logp_pickled = cloudpickle.dumps(logp_ddm_bbox)
+    blocks = [blackbox._SharedData(data), blackbox._SharedData(data)]
+    try:
+        for block in blocks:
+            result = blackbox._evaluate_chunk_shared(
+                logp_pickled,
+                block.shm.name,
+                data.shape,
+                data.dtype.str,
+                slice(0, 10),
+                [0.5, 1.5, 0.5, 0.3],
+            )
+            np.testing.assert_allclose(
+                result, logp_ddm_bbox(data[:10], 0.5, 1.5, 0.5, 0.3)
+            )
+            assert list(blackbox._attached_shared_memory) == [block.shm.name]
+    finally:
+        for attached in blackbox._attached_shared_memory.values():
+            attached.close()
+        blackbox._attached_shared_memory.clear()
+        for block in blocks:
+            block.release()
+
+
+def test_make_blackbox_op_grad(data_ddm):
+    """Tests the finite-difference gradients of the blackbox Op."""
+    data = data_ddm.values.astype(np.float64)
+    v = pt.dvector("v")
+    a, z, t = pt.dscalars("a", "z", "t")
+    x = np.full(data.shape[0], 2.0)
+
+    def logp_ddm_scaled(data, v, a, z, t, x):
+        return logp_ddm_bbox(data, v, a, z, t) * x
+
+    blackbox_op = distribution_utils.make_blackbox_op(
+        logp_ddm_scaled, grad_method="finite_differences"
+    )
+    assert blackbox_op.has_grad
+
+    params = [v, a, z, t]
+    values = [np.random.normal(0.5, 0.1, size=data.shape[0]), 1.5, 0.5, 0.3]
+    logp_bbox = pt.sum(blackbox_op(data, *params, x))
+    logp_analytical = pt.sum(logp_ddm(data, *params) * x)
+
+    grad_bbox = pytensor.function(params, pytensor.grad(logp_bbox, params))
+    grad_analytical = pytensor.function(params, pytensor.grad(logp_analytical, params))
+
+    for actual, expected in zip(grad_bbox(*values), grad_analytical(*values)):
+        np.testing.assert_allclose(actual, expected, rtol=1e-3, atol=1e-3)
+
+    with pytest.raises(ValueError):
+        distribution_utils.make_blackbox_op(logp_ddm_bbox, grad_method="autodiff")
+
+
+def test_make_blackbox_op_grad_process(data_ddm):
+    """Tests the finite-difference gradients computed in worker processes."""
+    data = data_ddm.values.astype(np.float64)
+    v = pt.dvector("v")
+    a = pt.dscalar("a")
+    values = [np.random.normal(0.5, 0.1, size=data.shape[0]), 1.5]
+
+    grads = []
+    for kwargs in [{}, {"n_workers": 2, "parallel": "process"}]:
+        blackbox_op = distribution_utils.make_blackbox_op(
+            logp_ddm_bbox, grad_method="finite_differences", **kwargs
+        )
+        logp = pt.sum(blackbox_op(data, v, a, 0.5, 0.3))
+        grad_func = pytensor.function([v, a], pytensor.grad(logp, [v, a]))
+        grads.append(grad_func(*values))
+
+    # The data is copied into shared memory once for all gradient evaluations.
+    shm_name = blackbox_op._shared_data.shm.name
+    grad_func(values[0], 1.6)
+    assert blackbox_op._shared_data.shm.name == shm_name
+
+    for actual, expected in zip(*grads):
+        np.testing.assert_allclose(actual, expected, rtol=1e-6)
+
+
+def test_make_blackbox_op_cache(data_ddm):
+    """Tests the LRU cache of the blackbox Op results."""
+    data = data_ddm.values
+    n_calls = 0
+
+    def logp_ddm_counted(data, v, a, z, t):
+        nonlocal n_calls
+        n_calls += 1
+        return logp_ddm_bbox(data, v, a, z, t)
+
+    blackbox_op = distribution_utils.make_blackbox_op(logp_ddm_counted, cache_size=2)
+    v, a, z, t = pt.dscalars("v", "a", "z", "t")
+    logp_func = pytensor.function([v, a, z, t], blackbox_op(data, v, a, z, t))
+
+    values = [(0.5, 1.5, 0.5, 0.3), (0.6, 1.5, 0.5, 0.3), (0.7, 1.5, 0.5, 0.3)]
+    results = [logp_func(*value) for value in values]
+    np.testing.assert_allclose(logp_func(*values[1]), results[1])
+    np.testing.assert_allclose(logp_func(*values[2]), results[2])
+    assert (blackbox_op.cache_hits, blackbox_op.cache_misses) == (2, 3)
+    assert n_calls == 3
+
+    # The least recently used entry was evicted.
+    np.testing.assert_allclose(logp_func(*values[0]), results[0])
+    assert (blackbox_op.cache_hits, blackbox_op.cache_misses) == (2, 4)
+    assert n_calls == 4
+
+    blackbox_op.clear_cache()
+    assert (blackbox_op.cache_hits, blackbox_op.cache_misses) == (0, 0)
+
+
+def test_make_blackbox_op_incremental(data_ddm):
+    """Tests that only the trials whose parameters changed are re-evaluated."""
+    data = data_ddm.values
+    n_trials = data.shape[0]
+    participant = np.arange(n_trials) % 10
+    n_evaluated = []
+
+    def logp_ddm_counted(data, v, a, z, t):
+        n_evaluated.append(len(data))
+        return logp_ddm_bbox(data, v, a, z, t)
+
+    blackbox_op = distribution_utils.make_blackbox_op(
+        logp_ddm_counted, incremental=True
+    )
+    v_participant = pt.dvector("v_participant")
+    a = pt.dscalar("a")
+    logp_func = pytensor.function(
+        [v_participant, a],
+        blackbox_op(data, v_participant[participant], a, 0.5, 0.3),
+    )
+
+    v_values = np.random.normal(0.5, 0.1, size=10)
+    logp_func(v_values, 1.5)
+    v_values[3] += 0.1
+    result = logp_func(v_values, 1.5)
+    assert n_evaluated == [n_trials, (participant == 3).sum()]
+    np.testing.assert_allclose(
+        result, logp_ddm_bbox(data, v_values[participant], 1.5, 0.5, 0.3)
+    )
+
+    # Changing a parameter shared by all trials re-evaluates every trial.
+    logp_func(v_values, 1.6)
+    logp_func(v_values, 1.6)
+    assert n_evaluated[2:] == [n_trials]
+
+
+def test_make_blackbox_op_incremental_process(data_ddm):
+    """Tests the incremental evaluation in worker processes."""
+    data = data_ddm.values
+    participant = np.arange(data.shape[0]) % 10
+
+    blackbox_op = distribution_utils.make_blackbox_op(
+        logp_ddm_bbox, n_workers=2, parallel="process", incremental=True
+    )
+    v_participant = pt.dvector("v_participant")
+    logp_func = pytensor.function(
+        [v_participant], blackbox_op(data, v_participant[participant], 1.5, 0.5, 0.3)
+    )
+
+    v_values = np.random.normal(0.5, 0.1, size=10)
+    logp_func(v_values)
+    shm_name = blackbox_op._shared_data.shm.name
+    for i in range(3):
+        v_values[i] += 0.1
+        result = logp_func(v_values)
+        assert blackbox_op._shared_data.shm.name == shm_name
+        np.testing.assert_allclose(
+            result, logp_ddm_bbox(data, v_values[participant], 1.5, 0.5, 0.3)
+        )
+
+
 def test_extra_fields(data_ddm):
     ones = np.ones(data_ddm.shape[0])
     x = ones * 0.5
@@ -1,5 +1,8 @@
+from pathlib import Path
+
 import bambi as bmb
 import numpy as np
+import pandas as pd
 import pytest
 
 import hssm
@@ -131,6 +134,38 @@ def test_custom_model(data_ddm):
     assert model.list_params == ["v", "a", "z", "t", "p_outlier"]
 
 
+def test_precision_grid(data_ddm):
+    """Tests the parameter bounds at which the reduced-precision LAN is checked.
+
+    Parameters without finite bounds fall back to the bounds of the default LAN. If
+    there are none, an error is raised.
+    """
+    loglik = Path(__file__).parent / "fixtures" / "ddm.onnx"
+    model = HSSM(
+        data=data_ddm,
+        loglik=loglik,
+        loglik_kind="approx_differentiable",
+        model_config={"precision": "float16", "bounds": {"v": (-np.inf, np.inf)}},
+    )
+    grid = model._make_precision_grid()
+    assert np.all((grid[:, 0] >= -3.0) & (grid[:, 0] <= 3.0))
+
+    with pytest.raises(ValueError, match="parameter v has no finite bounds"):
+        HSSM(
+            data=data_ddm,
+            model="custom",
+            loglik=loglik,
+            loglik_kind="approx_differentiable",
+            model_config={
+                "list_params": ["v", "a", "z", "t"],
+                "bounds": {"a": (0.3, 2.5), "z": (0.1, 0.9), "t": (0.0, 2.0)},
+                "backend": "jax",
+                "precision": "float16",
+            },
+            v={"prior": {"name": "Normal", "mu": 0.0, "sigma": 1.0}},
+        )
+
+
 def test_model_definition_outside_include(data_ddm):
     model_with_one_param_fixed = HSSM(data_ddm, a=0.5)
 
@@ -194,6 +229,25 @@ def test_sample_prior_predictive(data_ddm_reg):
     )
 
 
+def test_simulation_workers(data_ddm):
+    """Tests that the simulation pool is owned and shut down by the model."""
+    model = HSSM(data=data_ddm.iloc[:10, :])
+    rv_class = type(model.model_distribution.rv_op)
+
+    with model._simulation_workers(2):
+        executor = rv_class._executor
+        assert rv_class._n_workers == 2
+        assert executor is not None
+        prior_predictive = model.sample_prior_predictive(draws=2)
+
+    assert prior_predictive.prior_predictive["rt,response"].shape == (1, 2, 10, 2)
+    assert rv_class._n_workers is None
+    assert rv_class._executor is None
+    # The pool is shut down when the context exits
+    with pytest.raises(RuntimeError):
+        executor.submit(print)
+
+
 def test_hierarchical(data_ddm):
     data_ddm = data_ddm.iloc[:10, :].copy()
     data_ddm["participant_id"] = np.arange(10)
@@ -267,3 +321,95 @@ def test_override_default_link(caplog, data_ddm_reg):
 
     assert "t" in caplog.records[0].message
     assert "strange" in caplog.records[0].message
+
+
+def test_compress_data(data_ddm, tmp_path):
+    """Tests the compression of duplicated trials and the expansion of the results."""
+    data = pd.concat([data_ddm, data_ddm.iloc[:20]], ignore_index=True)
+    data["x"] = np.tile([0, 1], data.shape[0] // 2)
+    data.loc[100:, "x"] = data.loc[:19, "x"].values
+    include = [{"name": "v", "formula": "v ~ 1 + x"}]
+
+    model = HSSM(data=data, include=include)
+    model_compressed = HSSM(data=data, include=include, compress_data=True)
+
+    assert len(model_compressed._model_data) < len(model_compressed.data)
+    assert model_compressed._data_counts.sum() == len(data)
+
+    initial_point = model.pymc_model.initial_point()
+    np.testing.assert_allclose(
+        model_compressed.pymc_model.compile_logp()(initial_point),
+        model.pymc_model.compile_logp()(initial_point),
+        rtol=1e-4,
+    )
+
+    with pytest.raises(ValueError):
+        HSSM(data=data, loglik=DDM, compress_data=True)
+
+    idata = model_compressed.sample(
+        draws=10, tune=10, chains=1, idata_kwargs={"log_likelihood": True}
+    )
+    assert idata.log_likelihood["rt,response"].shape == (1, 10, len(data))
+    np.testing.assert_array_equal(
+        idata.observed_data["rt,response"].values,
+        model_compressed.data[["rt", "response"]].values,
+    )
+
+    model_compressed.sample_posterior_predictive()
+    posterior_predictive = model_compressed.traces.posterior_predictive["rt,response"]
+    assert posterior_predictive.shape == (1, 10, len(data), 2)
+    # The duplicated rows are simulated independently of the rows they duplicate
+    assert not np.any(
+        np.all(
+            posterior_predictive.values[:, :, 100:]
+            == posterior_predictive.values[:, :, :20],
+            axis=-1,
+        )
+    )
+
+    # The same holds without regressions and when simulating in chunks
+    pytest.importorskip("h5netcdf")
+    model_compressed = HSSM(data=data, compress_data=True)
+    model_compressed.sample(draws=4, tune=10, chains=1)
+    idata_pred = model_compressed.sample_posterior_predictive(
+        inplace=False, draws_per_chunk=2, output_path=tmp_path / "pps.nc"
+    )
+    posterior_predictive = idata_pred.posterior_predictive["rt,response"].values
+    assert posterior_predictive.shape == (1, 4, len(data), 2)
+    assert not np.any(
+        np.all(posterior_predictive[:, :, 100:] == posterior_predictive[:, :, :20], -1)
+    )
+
+
+def test_sample_posterior_predictive_in_chunks(data_ddm, tmp_path):
+    """Tests posterior predictive sampling in chunks written to a netCDF file."""
+    pytest.importorskip("h5netcdf")
+    model = HSSM(data=data_ddm)
+    idata = model.sample(draws=10, tune=10, chains=2)
+    path = tmp_path / "pps.nc"
+
+    with pytest.raises(ValueError):
+        model.sample_posterior_predictive(draws_per_chunk=3)
+    with pytest.raises(ValueError):
+        model.sample_posterior_predictive(
+            kind="mean", draws_per_chunk=3, output_path=path
+        )
+
+    idata_pred = model.sample_posterior_predictive(
+        inplace=False, draws_per_chunk=3, output_path=path
+    )
+    assert "posterior_predictive" not in idata
+    posterior_predictive = idata_pred.posterior_predictive["rt,response"]
+    assert posterior_predictive.shape == (2, 10, len(data_ddm), 2)
+    np.testing.assert_array_equal(posterior_predictive.draw, idata.posterior.draw)
+    assert np.all(np.isfinite(posterior_predictive.values))
+
+    # An existing file, which idata_pred still reads from, is not overwritten
+    with pytest.raises(ValueError, match="already exists"):
+        model.sample_posterior_predictive(draws_per_chunk=3, output_path=path)
+    assert np.all(np.isfinite(posterior_predictive.values))
+
+    path = tmp_path / "pps_sub.nc"
+    model.sample_posterior_predictive(n_samples=4, draws_per_chunk=3, output_path=path)
+    assert idata.posterior_predictive["rt,response"].shape == (2, 4, len(data_ddm), 2)
+    assert idata.posterior.draw.size == 10
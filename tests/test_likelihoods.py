@@ -5,16 +5,35 @@ old implementation of WFPT from (https://github.com/hddm-devs/hddm)
 """
 
 import math
+from functools import partial
 
+import jax
 import numpy as np
+import pytensor
+import pytensor.tensor as pt
 import pytest
 from numpy.random import rand
+from pymc.sampling.jax import get_jaxified_graph
+from pytensor.compile.mode import JAX, get_default_mode
+from pytensor.graph import FunctionGraph
 
 import hssm
 
 # pylint: disable=C0413
-from hssm.likelihoods.analytical import compare_k, logp_ddm, logp_ddm_sdv
-from hssm.likelihoods.blackbox import logp_ddm_bbox, logp_ddm_sdv_bbox
+from hssm.likelihoods.analytical import (
+    compare_k,
+    logp_ddm,
+    logp_ddm_sdv,
+    logp_full_ddm_analytical,
+)
+from hssm.likelihoods.analytical_op import (
+    DDMLogpOp,
+    logp_ddm_and_grads,
+    logp_ddm_and_grads_jax,
+    logp_ddm_fused,
+    logp_ddm_sdv_fused,
+)
+from hssm.likelihoods.blackbox import logp_ddm_bbox, logp_ddm_sdv_bbox, logp_full_ddm
 
 hssm.set_floatX("float32")
 
@@ -121,3 +140,206 @@ def test_bbox(data_ddm):
         logp_ddm_sdv_bbox(data, *true_values_sdv),
         decimal=4,
     )
+
+
+@pytest.mark.parametrize("logp_func", [logp_ddm, logp_ddm_sdv])
+def test_partition(data_ddm, logp_func):
+    """Tests the partitioned evaluation of the series expansions.
+
+    It must return the same log-likelihoods and gradients as the default evaluation.
+    """
+    data = data_ddm.values
+    v = pt.as_tensor_variable(np.float32(0.5))
+    a = pt.as_tensor_variable(np.float32(1.5))
+    params = [v, a, 0.5, 0.1] + ([0.3] if logp_func is logp_ddm_sdv else [])
+
+    logp = logp_func(data, *params)
+    logp_partitioned = logp_func(data, *params, partition=True)
+
+    np.testing.assert_almost_equal(logp.eval(), logp_partitioned.eval(), decimal=4)
+
+    for param in [v, a]:
+        np.testing.assert_almost_equal(
+            pytensor.grad(logp.sum(), wrt=param).eval(),
+            pytensor.grad(logp_partitioned.sum(), wrt=param).eval(),
+            decimal=2,
+        )
+
+
+@pytest.mark.parametrize("logp_func", [logp_ddm, logp_ddm_sdv])
+def test_partition_t_above_min_rt(data_ddm, logp_func):
+    """Tests the partitioned evaluation when some trials have rt <= t."""
+    data = data_ddm.values
+    v = pt.as_tensor_variable(np.float32(0.5))
+    a = pt.as_tensor_variable(np.float32(1.5))
+    t = float(np.median(np.abs(data[:, 0])))
+    params = [v, a, 0.5, t] + ([0.3] if logp_func is logp_ddm_sdv else [])
+
+    logp = logp_func(data, *params).eval()
+    logp_partitioned = logp_func(data, *params, partition=True)
+
+    assert np.any(np.abs(data[:, 0]) <= t)
+    np.testing.assert_almost_equal(logp, logp_partitioned.eval(), decimal=4)
+
+    for param in [v, a]:
+        assert np.isfinite(pytensor.grad(logp_partitioned.sum(), wrt=param).eval())
+
+
+def test_partition_hssm(data_ddm):
+    """Tests that the partitioned evaluation can be used in an HSSM model.
+
+    `partition` is passed through `functools.partial`, and the model must have the
+    same log-probability as the default model.
+    """
+    model = hssm.HSSM(data=data_ddm)
+    model_partitioned = hssm.HSSM(
+        data=data_ddm,
+        loglik=partial(logp_ddm, partition=True),
+        loglik_kind="analytical",
+    )
+
+    point = model.pymc_model.initial_point()
+    np.testing.assert_allclose(
+        model_partitioned.pymc_model.compile_logp()(point),
+        model.pymc_model.compile_logp()(point),
+        rtol=1e-4,
+    )
+
+
+@pytest.mark.parametrize(
+    "logp_func, logp_func_fused",
+    [(logp_ddm, logp_ddm_fused), (logp_ddm_sdv, logp_ddm_sdv_fused)],
+)
+def test_fused(data_ddm, logp_func, logp_func_fused):
+    """Tests the fused Op against the pytensor implementation.
+
+    Both must return the same log-likelihoods and gradients.
+    """
+    data = data_ddm.values
+    v = pt.as_tensor_variable(np.random.normal(0.5, 0.1, size=len(data)))
+    params = [pt.as_tensor_variable(np.float32(p)) for p in [1.5, 0.4, 0.1]]
+    if logp_func is logp_ddm_sdv:
+        params.append(pt.as_tensor_variable(np.float32(0.3)))
+    params = [v, *params]
+
+    logp = logp_func(data, *params)
+    logp_fused = logp_func_fused(data, *params)
+
+    np.testing.assert_almost_equal(logp.eval(), logp_fused.eval(), decimal=4)
+
+    for param in params:
+        np.testing.assert_almost_equal(
+            pytensor.grad(logp.sum(), wrt=param).eval(),
+            pytensor.grad(logp_fused.sum(), wrt=param).eval(),
+            decimal=2,
+        )
+
+
+@pytest.mark.parametrize("sv", [0.0, 0.3])
+def test_fused_jax(data_ddm, sv):
+    """Tests the JAX implementation of the fused Op.
+
+    It must return the same log-likelihoods and derivatives as the numpy
+    implementation.
+    """
+    data = data_ddm.values.astype(np.float32)
+    v = np.random.normal(0.5, 0.1, size=len(data)).astype(np.float32)
+    params = [v, 1.5, 0.4, 0.1, sv]
+
+    results = logp_ddm_and_grads(data, *params)
+    results_jax = jax.jit(logp_ddm_and_grads_jax)(data, *params)
+
+    for result, result_jax in zip(results, results_jax):
+        np.testing.assert_allclose(result, np.asarray(result_jax), rtol=1e-3, atol=1e-3)
+
+
+@pytest.mark.parametrize("model", ["ddm", "ddm_sdv"])
+def test_default_ddm_jax(data_ddm, model):
+    """Tests that the default analytical likelihoods use the fused Op under JAX.
+
+    The fused Op must replace them when the model is compiled with JAX, as by the
+    JAX samplers, and only then.
+    """
+    pymc_model = hssm.HSSM(data=data_ddm, model=model).pymc_model
+    logp = pymc_model.logp()
+    value_vars = pymc_model.value_vars
+    initial_point = pymc_model.initial_point()
+
+    def has_fused_op(mode):
+        fgraph = FunctionGraph(value_vars, [logp], clone=True)
+        mode.optimizer.rewrite(fgraph)
+        return any(isinstance(node.op, DDMLogpOp) for node in fgraph.apply_nodes)
+
+    assert has_fused_op(JAX)
+    assert not has_fused_op(get_default_mode())
+
+    jax_logp = get_jaxified_graph(inputs=value_vars, outputs=[logp])
+    np.testing.assert_allclose(
+        jax_logp(*[initial_point[var.name] for var in value_vars])[0],
+        pymc_model.compile_logp()(initial_point),
+        rtol=1e-4,
+    )
+
+
+def test_default_ddm_jax_k_terms(data_ddm):
+    """Tests that the fused Op uses the `k_terms` of the default likelihood under JAX.
+
+    With a single term, the log-likelihoods compiled with JAX must match those
+    compiled with the default backend.
+    """
+    v = pt.scalar("v")
+    logp = logp_ddm(data_ddm.values, v, 1.5, 0.5, 0.1, k_terms=1)
+
+    np.testing.assert_allclose(
+        pytensor.function([v], logp, mode=JAX)(0.5),
+        pytensor.function([v], logp)(0.5),
+        rtol=1e-4,
+    )
+
+
+def test_full_ddm_analytical(data_ddm):
+    """Tests the analytical full_ddm likelihood.
+
+    It is compared against the blackbox likelihood and the ddm_sdv likelihood.
+    """
+    data = data_ddm.values
+    true_values = (0.5, 1.5, 0.5, 0.3, 0.3)
+
+    np.testing.assert_almost_equal(
+        logp_full_ddm_analytical(data, *true_values, 0.0, 0.0).eval(),
+        logp_ddm_sdv(data, *true_values).eval(),
+        decimal=4,
+    )
+
+    full_ddm_values = (*true_values, 0.2, 0.2)
+    logp = logp_full_ddm_analytical(data, *full_ddm_values).eval()
+    logp_bbox = logp_full_ddm(data, *full_ddm_values)
+
+    # The quadrature is less accurate at the very leading edge of the distribution
+    mask = logp_bbox > -10.0
+    np.testing.assert_allclose(logp[mask], logp_bbox[mask], rtol=1e-3, atol=1e-3)
+
+    st = pt.as_tensor_variable(np.float32(0.2))
+    grad = pytensor.grad(
+        logp_full_ddm_analytical(data, *true_values, 0.2, st).sum(), wrt=st
+    ).eval()
+    assert np.isfinite(grad)
+
+
+def test_logp_ddm_float32():
+    """Tests that the log-space series are accurate in float32.
+
+    Both fast and slow responses are checked.
+    """
+    rt = np.concatenate([np.linspace(0.31, 0.4, 50), np.linspace(0.4, 40.0, 200)])
+    response = np.where(np.arange(250) % 2, 1.0, -1.0)
+    data = np.column_stack([rt, response])
+
+    for params in [(0.5, 1.0, 0.5, 0.3), (3.0, 0.5, 0.5, 0.3), (-2.0, 4.0, 0.2, 0.3)]:
+        expected = logp_ddm_and_grads(data, *params)[0]
+        logp = logp_ddm(
+            pt.as_tensor_variable(data.astype(np.float32)),
+            *[pt.as_tensor_variable(np.float32(param)) for param in params],
+        )
+        assert logp.dtype == "float32"
+        np.testing.assert_allclose(logp.eval(), expected, atol=1e-3)
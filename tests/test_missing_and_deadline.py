@@ -5,8 +5,9 @@ import pytest
 import pytensor
 import pytensor.tensor as pt
 import numpy as np
+import pandas as pd
 
-from hssm.utils import _rearrange_data
+from hssm.utils import _get_param_groups, _rearrange_data
 from hssm.distribution_utils import (
     assemble_callables,
     make_likelihood_callable,
@@ -137,6 +138,21 @@ def test_make_missing_data_callable(data, fixture_path, cpn, is_vector):
         decimal=DECIMAL,
     )
 
+    # The data can also be split at a fixed index
+    assembled_loglik_jax_static = assemble_callables(
+        logp_callable_jax,
+        missing_callable_jax,
+        params_only=is_cpn,
+        has_deadline=is_deadline,
+        n_missing=int(n_missing),
+        n_trials=len(data),
+    )
+    np.testing.assert_array_almost_equal(
+        assembled_loglik_jax_static(data, *dist_params).eval(),
+        result_individual,
+        decimal=DECIMAL,
+    )
+
     # Then, test if the same happens in the pytensor case
     logp_callable_pytensor = make_likelihood_callable(
         likelihood_onnx_path,
@@ -174,6 +190,21 @@ def test_make_missing_data_callable(data, fixture_path, cpn, is_vector):
         decimal=DECIMAL,
     )
 
+    # The data can also be split at a fixed index
+    assembled_loglik_pytensor_static = assemble_callables(
+        logp_callable_pytensor,
+        missing_callable_pytensor,
+        params_only=is_cpn,
+        has_deadline=is_deadline,
+        n_missing=int(n_missing),
+        n_trials=len(data),
+    )
+    np.testing.assert_array_almost_equal(
+        assembled_loglik_pytensor_static(data, *dist_params).eval(),
+        result_individual,
+        decimal=DECIMAL,
+    )
+
     # Also test results from pytensor and jax are the same
     np.testing.assert_array_almost_equal(
         result_assembled_jax,
@@ -211,3 +242,99 @@ def test_make_missing_data_callable(data, fixture_path, cpn, is_vector):
     # ).eval()
 
     # np.testing.assert_array_almost_equal(v_grad_jax, v_grad_pytensor, decimal=DECIMAL)
+
+
+def test_assemble_callables_deadline_groups(fixture_path):
+    """Tests that evaluating the OPN once per unique deadline gives the same result."""
+    data = np.ones((100, 3), dtype=np.float32)
+    data[:, 0] = np.random.rand(100)
+    data[:, 2] = np.random.choice([0.3, 0.5, 0.7], 100)
+    data[data[:, 0] > data[:, 2], 0] = -999.0
+    data = _rearrange_data(data)
+    n_missing = int(np.sum(data[:, 0] == -999.0))
+
+    param_groups = _get_param_groups(
+        pd.DataFrame({"deadline": data[:n_missing, -1]}), {}, deadline_name="deadline"
+    )
+    assert len(np.unique(param_groups)) <= 3
+
+    dist_params = [pt.as_tensor_variable(np.float32(x)) for x in [0.5, 1.5, 0.3, 0.4]]
+
+    for backend in ["jax", "pytensor"]:
+        logp_callable = make_likelihood_callable(
+            fixture_path / "ddm.onnx",
+            loglik_kind="approx_differentiable",
+            backend=backend,
+            params_is_reg=[False] * 4,
+        )
+        missing_callable = make_missing_data_callable(
+            fixture_path / "ddm_opn.onnx",
+            backend=backend,
+            params_is_reg=[False] * 4,
+            params_only=False,
+        )
+        results = [
+            assemble_callables(
+                logp_callable,
+                missing_callable,
+                params_only=False,
+                has_deadline=True,
+                param_groups=groups,
+                n_missing=n_missing,
+                n_trials=len(data),
+            )(data, *dist_params).eval()
+            for groups in [None, param_groups]
+        ]
+        np.testing.assert_array_almost_equal(*results, decimal=DECIMAL)
+
+
+@pytest.mark.parametrize("params_only", [True, False])
+def test_assemble_callables_other_data(fixture_path, params_only):
+    """Tests the callables with data of another length.
+
+    The static split and the groups must only be used for the data they were
+    computed for.
+    """
+    data = np.ones((100, 3), dtype=np.float32)
+    data[:, 0] = np.random.rand(100)
+    data[:, 2] = np.random.choice([0.3, 0.5, 0.7], 100)
+    data[data[:, 0] > data[:, 2], 0] = -999.0
+    data = _rearrange_data(data)
+    n_missing = int(np.sum(data[:, 0] == -999.0))
+    if params_only:
+        data = data[:, :-1]
+
+    dist_params = [pt.as_tensor_variable(np.float32(x)) for x in [0.5, 1.5, 0.3, 0.4]]
+    logp_callable = make_likelihood_callable(
+        fixture_path / "ddm.onnx",
+        loglik_kind="approx_differentiable",
+        backend="pytensor",
+    )
+    missing_callable = make_missing_data_callable(
+        fixture_path / f"ddm_{'cpn' if params_only else 'opn'}.onnx",
+        backend="pytensor",
+        params_is_reg=[False] * 4,
+        params_only=params_only,
+    )
+    kwargs = dict(params_only=params_only, has_deadline=not params_only)
+    static_loglik = assemble_callables(
+        logp_callable,
+        missing_callable,
+        param_groups=_get_param_groups(
+            pd.DataFrame({"deadline": data[:n_missing, -1]}),
+            {},
+            deadline_name="deadline",
+        ),
+        n_missing=n_missing,
+        n_trials=len(data),
+        **kwargs,
+    )
+    loglik = assemble_callables(logp_callable, missing_callable, **kwargs)
+
+    # Fewer missing trials, and a shared variable of unknown static length
+    for other_data in [data[n_missing // 2 :], pytensor.shared(data[n_missing // 2 :])]:
+        np.testing.assert_array_almost_equal(
+            static_loglik(other_data, *dist_params).eval(),
+            loglik(other_data, *dist_params).eval(),
+            decimal=DECIMAL,
+        )
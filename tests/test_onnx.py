@@ -1,14 +1,23 @@
+import subprocess
+import sys
 from pathlib import Path
 
+import jax
 import numpy as np
 import onnx
 import onnxruntime
 import pytensor
 import pytensor.tensor as pt
 import pytest
+from onnx import TensorProto, helper, numpy_helper
 
 import hssm
 from hssm.distribution_utils.onnx import *
+from hssm.distribution_utils.onnx.cache import CachedJit, set_cache_dir
+from hssm.distribution_utils.onnx.mlp import MLPLogpOp, extract_mlp_layers
+from hssm.distribution_utils.onnx.onnx import LANLogpAndPartialsOp
+from hssm.distribution_utils.onnx.optimize import optimize_graph
+from hssm.distribution_utils.onnx.precision import check_precision, make_precision_grid
 
 hssm.set_floatX("float32")
 DECIMAL = 4
@@ -100,6 +109,124 @@ def test_make_jax_logp_funcs_from_onnx(fixture_path):
     )
 
 
+def test_make_jax_logp_funcs_from_onnx_cache(fixture_path):
+    """Tests that the jitted functions are reused for the same model and arguments."""
+    funcs = make_jax_logp_funcs_from_onnx(
+        str(fixture_path / "angle.onnx"), params_is_reg=[True] + [False] * 4
+    )
+
+    model = onnx.load(fixture_path / "angle.onnx")
+    assert make_jax_logp_funcs_from_onnx(model, [True] + [False] * 4) is funcs
+    assert make_jax_logp_funcs_from_onnx(model, [False] * 5) is not funcs
+
+
+_COMPILE_IN_SUBPROCESS = """
+import sys
+
+import jax
+import numpy as np
+
+import hssm
+from hssm.distribution_utils.onnx import make_jax_logp_funcs_from_onnx
+
+n_compiled = 0
+compile = jax.stages.Lowered.compile
+
+
+def counted_compile(*args, **kwargs):
+    global n_compiled
+    n_compiled += 1
+    return compile(*args, **kwargs)
+
+
+jax.stages.Lowered.compile = counted_compile
+
+hssm.set_compilation_cache(sys.argv[2])
+logp, logp_vjp, _ = make_jax_logp_funcs_from_onnx(sys.argv[1], [True] + [False] * 4)
+data = np.linspace(0.5, 1.5, 20, dtype=np.float32).reshape(10, 2)
+v = np.linspace(-1.0, 1.0, 10, dtype=np.float32)
+params = [np.float32(value) for value in (1.5, 0.5, 0.3, 0.2)]
+result = logp(data, v, *params)
+grads = logp_vjp(data, v, *params, gz=np.ones(10, dtype=np.float32))
+print(
+    n_compiled,
+    repr(np.asarray(result).tolist()),
+    repr(np.asarray(grads[0]).tolist()),
+)
+"""
+
+
+def test_compilation_cache_across_processes(fixture_path, tmp_path):
+    """Tests that a second process loads the compiled functions from the cache."""
+    script = tmp_path / "compile.py"
+    script.write_text(_COMPILE_IN_SUBPROCESS)
+    args = [sys.executable, str(script), str(fixture_path / "angle.onnx")]
+
+    outputs = [
+        subprocess.run(
+            args + [str(tmp_path / "cache")], capture_output=True, check=True, text=True
+        )
+        .stdout.splitlines()[-1]
+        .split(" ", 1)
+        for _ in range(2)
+    ]
+
+    # The forward pass and the VJP are compiled by the first process only.
+    assert [int(n_compiled) for n_compiled, _ in outputs] == [2, 0]
+    assert outputs[0][1] == outputs[1][1]
+    assert len(list((tmp_path / "cache" / "lan").glob("*.pkl"))) == 2
+
+
+def test_cached_jit(tmp_path, monkeypatch):
+    """Tests that CachedJit reuses executables and only reads private cache files."""
+    compile_calls = []
+    compile = jax.stages.Lowered.compile
+
+    def counted_compile(self, *args, **kwargs):
+        compile_calls.append(self)
+        return compile(self, *args, **kwargs)
+
+    monkeypatch.setattr(jax.stages.Lowered, "compile", counted_compile)
+
+    def fn(x, y):
+        return x * y
+
+    cache_dir = tmp_path / "lan"
+    set_cache_dir(cache_dir)
+    try:
+        assert cache_dir.stat().st_mode & 0o777 == 0o700
+
+        cached = CachedJit(fn, "fn")
+        x = np.ones(3, dtype=np.float32)
+        np.testing.assert_allclose(cached(x, np.float32(2.0)), 2.0)
+        np.testing.assert_allclose(cached(x, np.float32(3.0)), 3.0)
+        assert len(compile_calls) == 1
+
+        # A new shape falls back from the last executable to a new one.
+        np.testing.assert_allclose(cached(np.ones(4, dtype=np.float32), 2.0), 2.0)
+        assert len(compile_calls) == 2
+        np.testing.assert_allclose(cached(x, np.float32(2.0)), 2.0)
+        assert len(compile_calls) == 2
+
+        # The executables are loaded from the cache by a new function...
+        CachedJit(fn, "fn")(x, np.float32(2.0))
+        assert len(compile_calls) == 2
+
+        # ...but not from files that other users can write to.
+        for path in cache_dir.glob("*.pkl"):
+            path.chmod(0o666)
+        CachedJit(fn, "fn")(x, np.float32(2.0))
+        assert len(compile_calls) == 3
+
+        shared_dir = tmp_path / "shared"
+        shared_dir.mkdir()
+        shared_dir.chmod(0o777)
+        with pytest.raises(ValueError, match="must not be writable by other users"):
+            set_cache_dir(shared_dir)
+    finally:
+        set_cache_dir(None)
+
+
 def test_make_jax_logp_ops(fixture_path):
     """Tests whether the logp Op returned from make_jax_logp_ops with different backends
     work the same way.
@@ -162,3 +289,317 @@ def test_make_jax_logp_ops(fixture_path):
         pytensor.grad(pt_loglik.sum(), wrt=v).eval(),
         decimal=DECIMAL,
     )
+
+
+def test_make_jax_logp_funcs_from_onnx_params_only(fixture_path):
+    """Tests the batched params-only log-likelihood and its VJP.
+
+    The results are compared against interpret_onnx applied row by row.
+    """
+    model = onnx.load(fixture_path / "ddm_cpn.onnx")
+
+    jax_logp, jax_logp_vjp, _ = make_jax_logp_funcs_from_onnx(
+        model, params_is_reg=[True] + [False] * 3, params_only=True
+    )
+
+    v = np.random.rand(10).astype(np.float32)
+    other_params = np.random.rand(3).astype(np.float32)
+    result = jax_logp(v, *other_params)
+
+    assert result.shape == (10,)
+    expected = [
+        interpret_onnx(model.graph, np.array([[v_i, *other_params]]))[0].squeeze()
+        for v_i in v
+    ]
+    np.testing.assert_array_almost_equal(result, expected, decimal=DECIMAL)
+
+    grads = jax_logp_vjp(v, *other_params, gz=np.ones(10, dtype=np.float32))
+    assert grads[0].shape == (10,)
+    assert all(np.ndim(g) == 0 for g in grads[1:])
+
+
+def test_optimize_graph():
+    """Tests that the optimized graph is simplified.
+
+    The optimized graph must give the same results as the ONNX runtime.
+    """
+    rng = np.random.default_rng(1)
+    weight = rng.normal(size=(3, 4)).astype(np.float32)
+    bias = rng.normal(size=4).astype(np.float32)
+    nodes = [
+        helper.make_node("MatMul", ["x", "weight"], ["matmul"]),
+        helper.make_node("Add", ["matmul", "bias"], ["add"]),
+        helper.make_node("Identity", ["add"], ["identity"]),
+        helper.make_node("Reshape", ["identity", "shape"], ["reshape"]),
+        helper.make_node("Exp", ["reshape"], ["exp"]),
+        helper.make_node(
+            "Constant",
+            [],
+            ["one"],
+            value=numpy_helper.from_array(np.array(1.0, dtype=np.float32)),
+        ),
+        helper.make_node("Add", ["exp", "one"], ["add_one"]),
+        helper.make_node("Log", ["add_one"], ["y"]),
+    ]
+    graph = helper.make_graph(
+        nodes,
+        "test",
+        [helper.make_tensor_value_info("x", TensorProto.FLOAT, [None, 3])],
+        [helper.make_tensor_value_info("y", TensorProto.FLOAT, [None, 4])],
+        initializer=[
+            numpy_helper.from_array(weight, "weight"),
+            numpy_helper.from_array(bias, "bias"),
+            numpy_helper.from_array(np.array([-1, 4], dtype=np.int64), "shape"),
+        ],
+    )
+    model = helper.make_model(
+        graph, ir_version=8, opset_imports=[helper.make_opsetid("", 17)]
+    )
+
+    optimized = optimize_graph(model.graph)
+    assert [node.op_type for node in optimized.nodes] == ["Gemm", "Softplus"]
+    assert optimize_graph(model.graph) is optimized
+    # The cache is keyed by the content of the graph, not by its identity
+    assert optimize_graph(onnx.load_from_string(model.SerializeToString()).graph) is (
+        optimized
+    )
+    changed_model = onnx.load_from_string(model.SerializeToString())
+    changed_model.graph.initializer[1].CopyFrom(numpy_helper.from_array(-bias, "bias"))
+    assert optimize_graph(changed_model.graph) is not optimized
+
+    data = rng.normal(size=(5, 3)).astype(np.float32)
+    session = onnxruntime.InferenceSession(
+        model.SerializeToString(), providers=["CPUExecutionProvider"]
+    )
+    result_onnx = session.run(["y"], {"x": data})[0]
+
+    np.testing.assert_almost_equal(
+        np.asarray(interpret_onnx(model.graph, data)[0]), result_onnx, decimal=DECIMAL
+    )
+    np.testing.assert_almost_equal(
+        pt_interpret_onnx(model.graph, data)[0].eval(), result_onnx, decimal=DECIMAL
+    )
+
+
+def test_make_jax_fused_logp(fixture_path):
+    """Tests the fused Op against the LAN Op.
+
+    The fused Op must compute the same values and gradients with a single Apply
+    node, and the value-only Op must be used when no gradient is requested.
+    """
+    model = onnx.load(fixture_path / "ddm.onnx")
+    params_is_reg = [True, False, False, False]
+    jax_logp_op = make_jax_logp_ops(
+        *make_jax_logp_funcs_from_onnx(model, params_is_reg=params_is_reg)
+    )
+    fused_logp = make_jax_fused_logp(
+        *make_jax_logp_and_partials_from_onnx(model), jax_logp_op
+    )
+
+    data = np.random.rand(10, 2).astype(np.float32)
+    v = pt.vector("v")
+    a = pt.scalar("a")
+    values = [np.random.rand(10).astype(np.float32), np.float32(1.5)]
+
+    results = []
+    for logp in [fused_logp, jax_logp_op]:
+        loglik = logp(data, v, a, 0.5, 0.3).sum()
+        results.append(
+            pytensor.function([v, a], [loglik, *pytensor.grad(loglik, [v, a])])
+        )
+    for fused_result, result in zip(results[0](*values), results[1](*values)):
+        np.testing.assert_array_almost_equal(fused_result, result, decimal=DECIMAL)
+
+    fused_nodes = [
+        node
+        for node in results[0].maker.fgraph.toposort()
+        if isinstance(node.op, LANLogpAndPartialsOp)
+    ]
+    assert len(fused_nodes) == 1
+
+    value_only = pytensor.function([v, a], fused_logp(data, v, a, 0.5, 0.3))
+    assert not any(
+        isinstance(node.op, LANLogpAndPartialsOp)
+        for node in value_only.maker.fgraph.toposort()
+    )
+
+    loglik = fused_logp(data, v, a, 0.5, 0.3).sum()
+    jax_func = pytensor.function(
+        [v, a], [loglik, *pytensor.grad(loglik, [v, a])], mode="JAX"
+    )
+    for jax_result, result in zip(jax_func(*values), results[1](*values)):
+        np.testing.assert_array_almost_equal(jax_result, result, decimal=DECIMAL)
+
+
+def test_lan_ops_device_arrays(fixture_path):
+    """Tests that constant data is copied to the device once and reused."""
+    model = onnx.load(fixture_path / "ddm.onnx")
+    jax_logp_op = make_jax_logp_ops(
+        *make_jax_logp_funcs_from_onnx(model, params_is_reg=[True] + [False] * 3)
+    )
+
+    data = np.random.rand(10, 2).astype(np.float32)
+    v = pt.vector("v")
+    logp_func = pytensor.function([v], jax_logp_op(data, v, 1.5, 0.5, 0.3))
+
+    v_value = np.random.rand(10).astype(np.float32)
+    result = logp_func(v_value)
+    np.testing.assert_array_almost_equal(logp_func(v_value), result)
+
+    device_arrays = list(jax_logp_op._device_arrays._arrays.values())
+    assert len(device_arrays) == 1
+    assert isinstance(device_arrays[0][1], jax.Array)
+    np.testing.assert_array_equal(device_arrays[0][1], data)
+
+
+@pytest.mark.parametrize("model_name", ["ddm", "ddm_cpn"])
+def test_mlp_logp_op(fixture_path, model_name):
+    """Tests the fused MLP Op against the ONNX graph converted to pytensor ops.
+
+    Both must give the same values and gradients.
+    """
+    model = onnx.load(fixture_path / f"{model_name}.onnx")
+    layers = extract_mlp_layers(model.graph)
+    assert layers is not None
+
+    n_inputs = layers[0][1].shape[0]
+    x = pt.matrix("x")
+    x_value = np.random.rand(10, n_inputs).astype(np.float32)
+
+    mlp_output = MLPLogpOp(layers)(x)[0].sum()
+    pt_output = pt_interpret_onnx(model.graph, x)[0].sum()
+
+    mlp_func = pytensor.function([x], [mlp_output, pytensor.grad(mlp_output, x)])
+    pt_func = pytensor.function([x], [pt_output, pytensor.grad(pt_output, x)])
+
+    # The two graphs sum the float32 products in a different order, and the
+    # gradients of the ddm network are as large as ~1e2, so the differences are
+    # relative to the magnitude of the results.
+    for mlp_result, pt_result in zip(mlp_func(x_value), pt_func(x_value)):
+        np.testing.assert_allclose(mlp_result, pt_result, rtol=1e-4, atol=1e-4)
+
+    value_only = pytensor.function([x], mlp_output)
+    assert all(
+        not node.op.compute_grad
+        for node in value_only.maker.fgraph.toposort()
+        if isinstance(node.op, MLPLogpOp)
+    )
+
+
+def test_make_onnxruntime_logp(fixture_path):
+    """Tests the onnxruntime log-likelihood against interpret_onnx.
+
+    Both the case with data and the params-only case are checked.
+    """
+    model = onnx.load(fixture_path / "ddm.onnx")
+    ort_logp = make_onnxruntime_logp(model, intra_op_num_threads=1)
+
+    data = np.random.rand(10, 2).astype(np.float32)
+    v = np.random.rand(10).astype(np.float32)
+    other_params = np.random.rand(3).astype(np.float32)
+    result = ort_logp(data, v, *other_params)
+
+    assert result.shape == (10,)
+    input_matrix = np.column_stack(
+        [v, *[np.full(10, param) for param in other_params], data]
+    )
+    np.testing.assert_array_almost_equal(
+        result,
+        interpret_onnx(model.graph, input_matrix)[0].squeeze(),
+        decimal=DECIMAL,
+    )
+
+    cpn_model = onnx.load(fixture_path / "ddm_cpn.onnx")
+    ort_cpn_logp = make_onnxruntime_logp(cpn_model, params_only=True)
+    result = ort_cpn_logp(v, *other_params)
+
+    assert result.shape == (10,)
+    np.testing.assert_array_almost_equal(
+        result,
+        interpret_onnx(cpn_model.graph, input_matrix[:, :4])[0].squeeze(),
+        decimal=DECIMAL,
+    )
+
+
+def test_make_onnxruntime_logp_rank(fixture_path):
+    """Tests that models without a batch dimension are rejected."""
+    model = onnx.load(fixture_path / "ddm.onnx")
+    model.graph.input[0].type.tensor_type.shape.ClearField("dim")
+
+    with pytest.raises(ValueError, match="expects inputs of shape"):
+        make_onnxruntime_logp(model)
+
+
+@pytest.mark.parametrize("precision", ["bfloat16", "float16", "int8"])
+def test_reduced_precision(fixture_path, precision):
+    """Tests the reduced-precision log-likelihoods and the accuracy check."""
+    model = onnx.load(fixture_path / "ddm.onnx")
+    rng = np.random.default_rng(0)
+    data = np.column_stack([rng.uniform(0.3, 3.0, 100), rng.choice([-1.0, 1.0], 100)])
+    bounds = np.array([(-3, 3), (0.3, 2.5), (0.1, 0.9), (0, 2)])
+    grid = make_precision_grid(bounds, data)
+    assert grid.shape == (2000, 6)
+    # Each of the equal-width intervals of each parameter contains one sample
+    intervals = (grid[:, :4] - bounds[:, 0]) / (bounds[:, 1] - bounds[:, 0]) * 2000
+    for column in np.floor(intervals).astype(int).T:
+        np.testing.assert_array_equal(np.sort(column), np.arange(2000))
+    assert make_precision_grid([(0, 1)] * 10, n_samples=100).shape == (100, 10)
+
+    error = check_precision(model.graph, precision, grid, atol=np.inf)
+    assert 0 < error < 1
+    with pytest.raises(ValueError, match="differ from the full-precision"):
+        check_precision(model.graph, precision, grid, atol=error / 2)
+
+    jax_logp, jax_logp_vjp, _ = make_jax_logp_funcs_from_onnx(
+        model, params_is_reg=[True] * 4, precision=precision
+    )
+    full_logp, full_logp_vjp, _ = make_jax_logp_funcs_from_onnx(
+        model, params_is_reg=[True] * 4
+    )
+    inputs = [grid[:, 4:], *grid[:, :4].T]
+    result = jax_logp(*inputs)
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, full_logp(*inputs), atol=1.01 * error)
+
+    gz = np.ones(len(grid), dtype=np.float32)
+    for reduced_grad, full_grad in zip(
+        jax_logp_vjp(*inputs, gz=gz), full_logp_vjp(*inputs, gz=gz)
+    ):
+        # Quantization can shift the derivatives of a few trials
+        close = np.isclose(reduced_grad, full_grad, rtol=0.2, atol=0.2)
+        assert close.mean() > 0.95
+
+
+def test_make_jax_logp_funcs_from_onnx_chunked(fixture_path):
+    """Tests that evaluating the LAN in blocks of trials gives the same results."""
+    model = onnx.load(fixture_path / "ddm.onnx")
+
+    data = np.random.rand(1000, 2).astype(np.float32)
+    v = np.random.rand(1000).astype(np.float32)
+    other_params = np.random.rand(3).astype(np.float32)
+    gz = np.random.rand(1000).astype(np.float32)
+
+    logp, logp_vjp, _ = make_jax_logp_funcs_from_onnx(
+        model, params_is_reg=[True] + [False] * 3
+    )
+    chunked_logp, chunked_logp_vjp, _ = make_jax_logp_funcs_from_onnx(
+        model, params_is_reg=[True] + [False] * 3, chunk_size=128
+    )
+    np.testing.assert_allclose(
+        chunked_logp(data, v, *other_params), logp(data, v, *other_params), rtol=1e-6
+    )
+    for chunked_grad, grad in zip(
+        chunked_logp_vjp(data, v, *other_params, gz=gz),
+        logp_vjp(data, v, *other_params, gz=gz),
+    ):
+        np.testing.assert_allclose(chunked_grad, grad, rtol=1e-5)
+
+    logp_and_partials, _ = make_jax_logp_and_partials_from_onnx(model)
+    chunked_logp_and_partials, _ = make_jax_logp_and_partials_from_onnx(
+        model, chunk_size=128
+    )
+    for chunked_result, result in zip(
+        chunked_logp_and_partials(data, v, *other_params),
+        logp_and_partials(data, v, *other_params),
+    ):
+        np.testing.assert_allclose(chunked_result, result, rtol=1e-5)
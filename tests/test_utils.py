@@ -2,12 +2,18 @@ import numpy as np
 import pandas as pd
 import pytensor
 import pytest
+import xarray as xr
 from ssms.basic_simulators.simulator import simulator
 from jax import config
 
 import hssm
+from hssm.distribution_utils.onnx.cache import set_cache_dir
+from hssm.param import Param
 from hssm.utils import (
+    _append_to_netcdf,
+    set_compilation_cache,
     set_floatX,
+    _get_param_groups,
     _generate_random_indices,
     _random_sample,
 )
@@ -162,3 +168,103 @@ def test__random_sample(
 
     assertions(caplog, posterior, n_samples, expected)
     assertions(caplog, posterior_predictive, n_samples, expected)
+
+
+def test_set_compilation_cache(tmp_path):
+    """Tests that the JAX and LAN compilation caches are set up in the directory."""
+    from jax.experimental.compilation_cache import compilation_cache
+
+    cache_dir = tmp_path / "jax_cache"
+    try:
+        set_compilation_cache(cache_dir)
+        assert cache_dir.is_dir()
+        assert config.jax_compilation_cache_dir == str(cache_dir)
+        assert config.jax_persistent_cache_min_compile_time_secs == 0.0
+        assert (cache_dir / "lan").is_dir()
+    finally:
+        config.update("jax_compilation_cache_dir", None)
+        config.update("jax_persistent_cache_min_compile_time_secs", 1.0)
+        compilation_cache.reset_cache()
+        set_cache_dir(None)
+
+
+def test__get_param_groups():
+    """Tests that trials are grouped by the covariates of the parameters."""
+    data = pd.DataFrame(
+        {
+            "rt": np.random.uniform(size=12),
+            "response": np.ones(12),
+            "x": np.repeat([0.0, 1.0, 2.0], 4),
+            "subj": np.tile(["s1", "s2"], 6),
+            "y": np.random.uniform(size=12),
+        }
+    )
+
+    params = {"v": Param("v", prior=0.5), "a": Param("a", prior=1.5)}
+    assert _get_param_groups(data, params) is None
+
+    params["v"] = Param("v", formula="v ~ 1 + x + (1|subj)")
+    param_groups = _get_param_groups(data, params)
+    assert param_groups is not None
+    assert len(np.unique(param_groups)) == 6
+
+    # Trials in the same group have the same values of all covariates
+    for group in np.unique(param_groups):
+        assert (
+            len(data.loc[param_groups == group, ["x", "subj"]].drop_duplicates()) == 1
+        )
+
+    params["a"] = Param("a", formula="a ~ 1 + y")
+    assert _get_param_groups(data, params) is None
+
+    params["a"] = Param("a", formula="a ~ 1")
+    assert len(np.unique(_get_param_groups(data, params, ["x"]))) == 6
+
+    # Variables that are not data columns may differ between trials
+    params["a"] = Param("a", formula="a ~ 1 + z_env")
+    assert _get_param_groups(data, params) is None
+
+
+def test__get_param_groups_deadline():
+    """Tests that trials are grouped by their deadlines and parameter groups."""
+    data = pd.DataFrame(
+        {
+            "deadline": [0.5, 1.0, 0.5, 1.0, 0.5, 1.0],
+            "x": [0.0, 0.0, 0.0, 1.0, 1.0, 1.0],
+            "y": np.random.uniform(size=6),
+        }
+    )
+    params = {"v": Param("v", prior=0.5)}
+
+    groups = _get_param_groups(data, params, deadline_name="deadline")
+    assert len(np.unique(groups)) == 2
+    np.testing.assert_array_equal(groups[0::2], groups[0])
+
+    params["v"] = Param("v", formula="v ~ 1 + x")
+    groups = _get_param_groups(data, params, deadline_name="deadline")
+    assert len(np.unique(groups)) == 4
+    assert groups[0] == groups[2] and groups[3] == groups[5]
+
+    params["v"] = Param("v", formula="v ~ 1 + y")
+    assert _get_param_groups(data, params, deadline_name="deadline") is None
+    assert _get_param_groups(data.iloc[:2], {}, deadline_name="deadline") is None
+
+
+def test__append_to_netcdf(tmp_path):
+    """Tests that chunks appended to a netCDF file are concatenated."""
+    pytest.importorskip("h5netcdf")
+    path = tmp_path / "pps.nc"
+    rng = np.random.default_rng(0)
+    chunks = [
+        xr.Dataset(
+            {"rt,response": (("chain", "draw", "obs"), rng.normal(size=(2, n, 5)))},
+            coords={"draw": np.arange(start, start + n), "obs": np.arange(5)},
+        )
+        for start, n in [(0, 3), (3, 4), (7, 1)]
+    ]
+
+    for chunk in chunks:
+        _append_to_netcdf(chunk, path, dim="draw")
+
+    with xr.open_dataset(path, engine="h5netcdf") as dataset:
+        xr.testing.assert_equal(dataset.load(), xr.concat(chunks, dim="draw"))